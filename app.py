@@ -1,7 +1,12 @@
 import streamlit as st
 import pandas as pd
-import ast
 import altair as alt # Для графиков
+import os
+import yaml
+from results_output import DEFAULT_RESULTS_PARQUET_PATH
+from results_store import DEFAULT_RESULTS_STORE_PATH, ResultsStore
+
+PAGE_SIZES = [50, 100, 500, 1000]
 
 # --- Конфигурация страницы Streamlit ---
 st.set_page_config(
@@ -11,58 +16,69 @@ st.set_page_config(
 )
 
 # --- Загрузка и кэширование данных ---
-@st.cache_data
-def load_data(file_path="client_tags_results_csv.csv"):
+def load_config(config_path="config.yaml"):
     try:
-        df = pd.read_csv(file_path)
-        # df.to_csv("client_tags_results_csv.csv", index=False)
-        if not df.empty and 'TAGS' in df.columns:
-            # Преобразование колонки TAGS, если она сохранена как строка-список
-            if isinstance(df['TAGS'].iloc[0], str) and df['TAGS'].iloc[0].strip().startswith('['):
-                try:
-                    df['TAGS_List'] = df['TAGS'].apply(
-                        lambda x: ast.literal_eval(x) if pd.notna(x) and isinstance(x, str) and x.strip().startswith('[') and x.strip().endswith(']') else x
-                    )
-                except (ValueError, SyntaxError):
-                     df['TAGS_List'] = df['TAGS'].apply(
-                        lambda x: [tag.strip() for tag in x.split(',')] if pd.notna(x) and isinstance(x, str) else []
-                    )
-            elif isinstance(df['TAGS'].iloc[0], str):
-                 df['TAGS_List'] = df['TAGS'].apply(
-                        lambda x: [tag.strip() for tag in x.split(',')] if pd.notna(x) and isinstance(x, str) else []
-                    )
-            else:
-                df['TAGS_List'] = df['TAGS']
-            
-            df['TAGS_List'] = df['TAGS_List'].apply(lambda x: x if isinstance(x, list) else [])
-            # Создаем строку тегов для отображения в st.dataframe
-            df['TAGS_String'] = df['TAGS_List']#.apply(lambda x: ", ".join(x) if x else "Нет тегов")
-        else:
-             st.warning("Колонка 'TAGS' отсутствует или файл пуст.")
-             df['TAGS_List'] = pd.Series([[] for _ in range(len(df))])
-             df['TAGS_String'] = pd.Series(["Нет тегов" for _ in range(len(df))])
-        return df
-    except FileNotFoundError:
-        st.error(f"Ошибка: Файл '{file_path}' не найден.")
-        return pd.DataFrame(columns=['CLI_ID', 'CLN_NAME', 'TAGS_List', 'TAGS_String'])
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return yaml.safe_load(f) or {}
+    except OSError:
+        return {}
+
+
+@st.cache_resource(max_entries=2)
+def open_results_store(path, modified_at):
+    """
+    Соединение с хранилищем результатов; modified_at в ключе кэша — переоткрыть после нового прогона.
+    Соединение общее для сессий и явно не закрывается: вытесненное из кэша закроется сборщиком мусора,
+    когда его перестанут использовать сессии, открывшие страницу до нового прогона.
+    """
+    return ResultsStore(path)
+
+
+def load_data(config=None, legacy_csv_path="client_tags_results_csv.csv"):
+    """
+    Хранилище результатов, записанное pipeline.py. Если его еще нет, хранилище один раз строится
+    из Parquet результатов прогона или из CSV прошлых версий. Фильтры, подсчеты и страницы таблицы — запросы к хранилищу.
+    """
+    config = load_config() if config is None else config
+    path = (config.get("results_store") or {}).get("path", DEFAULT_RESULTS_STORE_PATH)
+    parquet_path = (config.get("results_output") or {}).get("parquet_path", DEFAULT_RESULTS_PARQUET_PATH)
+    try:
+        if not os.path.exists(path) and os.path.exists(parquet_path):
+            ResultsStore.import_parquet(parquet_path, path)
+        elif not os.path.exists(path) and os.path.exists(legacy_csv_path):
+            ResultsStore.import_csv(legacy_csv_path, path)
+        if not os.path.exists(path):
+            st.error(f"Ошибка: Хранилище результатов '{path}' не найдено. Запустите pipeline.py.")
+            return None
+        return open_results_store(path, os.path.getmtime(path))
     except Exception as e:
-        st.error(f"Ошибка при загрузке данных из Excel: {e}")
-        return pd.DataFrame(columns=['CLI_ID', 'CLN_NAME', 'TAGS_List', 'TAGS_String'])
+        st.error(f"Ошибка при загрузке результатов из '{path}': {e}")
+        return None
+
+
+def show_clients_page(store, key, columns, name=None, tags=(), total=None):
+    """Таблица клиентов постранично: из хранилища читается только выбранная страница."""
+    total = store.count(name, tags) if total is None else total
+    page_size_column, page_column = st.columns(2)
+    page_size = page_size_column.selectbox("Строк на странице:", PAGE_SIZES, index=1, key=f"{key}_page_size")
+    pages = max(1, -(-total // page_size))
+    page = page_column.number_input(f"Страница (из {pages}):", min_value=1, max_value=pages, value=1, key=f"{key}_page")
+    page_df = store.page(name, tags, limit=page_size, offset=(page - 1) * page_size)
+    st.dataframe(page_df[columns].rename(columns={'TAGS': 'Теги'}), hide_index=True, use_container_width=False)
 
 # --- Основная часть приложения ---
 st.title("📊 Анализ Тегов Клиентов МСБ")
 st.markdown("Интерактивное представление тегов, присвоенных клиентам малого и среднего бизнеса.")
 
-data_df = load_data()
+store = load_data()
+total_clients = store.count() if store is not None else 0
 
-if not data_df.empty:
+if total_clients:
     st.sidebar.header("Фильтры и Настройки")
 
     search_name = st.sidebar.text_input("Поиск по наименованию клиента (CLN_NAME):", "")
     
-    all_tags_list = []
-    if 'TAGS_List' in data_df.columns: # Используем TAGS_List для получения уникальных тегов
-        all_tags_list = sorted(list(set(tag for sublist in data_df['TAGS_List'] for tag in sublist)))
+    all_tags_list = store.tags() # Уникальные теги, отсортированы
 
     selected_tags_filter = st.sidebar.multiselect(
         "Фильтр по тегам (клиенты с ВСЕМИ выбранными тегами):",
@@ -70,31 +86,23 @@ if not data_df.empty:
         default=[]
     )
 
-    filtered_df = data_df.copy()
-    if search_name:
-        filtered_df = filtered_df[filtered_df['CLN_NAME'].str.contains(search_name, case=False, na=False)]
-    if selected_tags_filter:
-        filtered_df = filtered_df[filtered_df['TAGS_List'].apply(lambda client_tags: all(tag in client_tags for tag in selected_tags_filter))]
+    filtered_count = store.count(search_name, selected_tags_filter)
 
     st.header("Данные по Клиентам и Их Тегам")
 
-    if filtered_df.empty:
+    if not filtered_count:
         st.warning("По вашему запросу клиенты не найдены.")
     else:
-        st.info(f"Найдено клиентов: {len(filtered_df)}")
+        st.info(f"Найдено клиентов: {filtered_count}")
         show_cli_id = st.checkbox("Показывать CLI_ID", value=False, key="show_cli_id_checkbox")
         
-        columns_to_display_in_table = ['CLN_NAME', 'TAGS_String'] # Используем TAGS_String
+        columns_to_display_in_table = ['CLN_NAME', 'TAGS']
         if show_cli_id:
             columns_to_display_in_table.insert(0, 'CLI_ID')
         
-        # Переименовываем колонку для отображения
-        display_df_renamed = filtered_df[columns_to_display_in_table].rename(columns={'TAGS_String': 'Теги'})
-        
-        st.dataframe(
-            display_df_renamed,
-            hide_index=True,
-            use_container_width=False
+        show_clients_page(
+            store, "clients", columns_to_display_in_table,
+            name=search_name, tags=selected_tags_filter, total=filtered_count
         )
 
         st.sidebar.markdown("---")
@@ -102,8 +110,8 @@ if not data_df.empty:
 
         if st.sidebar.checkbox("Показать распределение тегов", value=True):
             st.header("Распределение Тегов по Клиентам")
-            if not filtered_df.empty and 'TAGS_List' in filtered_df.columns:
-                tag_counts_series = pd.Series([tag for sublist in filtered_df['TAGS_List'] for tag in sublist]).value_counts()
+            if filtered_count:
+                tag_counts_series = store.tag_counts(search_name, selected_tags_filter)
                 if not tag_counts_series.empty:
                     source = pd.DataFrame({'Тег': tag_counts_series.index, 'Количество': tag_counts_series.values})
                     max_tags_to_show = st.slider("Количество тегов на графике:", 5, len(source) if len(source)>5 else 6, min(20, len(source) if len(source)>0 else 1 ), key="tags_slider")
@@ -156,19 +164,19 @@ if not data_df.empty:
                 options=[""] + all_tags_list
             )
             if single_tag_select:
-                clients_with_single_tag_df = data_df[data_df['TAGS_List'].apply(lambda tags: single_tag_select in tags)]
-                if not clients_with_single_tag_df.empty:
-                    st.write(f"Клиенты с тегом '{single_tag_select}':")
-
-                    display_single_tag_df = clients_with_single_tag_df[['CLN_NAME', 'TAGS_String']].rename(columns={'TAGS_String': 'Теги'})
-                    st.dataframe(display_single_tag_df, hide_index=True, use_container_width=False)
+                single_tag_count = store.count(tags=[single_tag_select])
+                if single_tag_count:
+                    st.write(f"Клиенты с тегом '{single_tag_select}': {single_tag_count}")
+                    show_clients_page(
+                        store, "single_tag", ['CLN_NAME', 'TAGS'], tags=[single_tag_select], total=single_tag_count
+                    )
                 else:
                     st.write(f"Нет клиентов с тегом '{single_tag_select}'.")
 
     st.sidebar.markdown("---")
-    st.sidebar.info(f"Загружено {len(data_df)} записей о клиентах.")
+    st.sidebar.info(f"Загружено {total_clients} записей о клиентах.")
     if selected_tags_filter or search_name:
-        st.sidebar.info(f"Отображается {len(filtered_df)} клиентов после фильтрации.")
+        st.sidebar.info(f"Отображается {filtered_count} клиентов после фильтрации.")
 else:
     st.warning("Не удалось загрузить данные.")
 
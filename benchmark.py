@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Optional
+
+import yaml
+from loguru import logger
+
+from mock_openai import MockChatCompletions, MockOpenAIServer
+from synthetic_data import dataset_paths, generate_dataset, parse_scale
+from token_usage import UsageTracker
+
+SCENARIOS = ("ingest", "fetch_tags", "fetch_tags_streaming", "fetch_tags_packed", "find_new_tags", "find_new_tags_batched")
+
+
+def benchmark_config(base_config_path, work_dir, overrides=None) -> str:
+    """
+    Конфиг прогона бенчмарка: config.yaml без кэша LLM (иначе повторный прогон не делает запросов),
+    с кэшами, метриками и метками шаблонов внутри work_dir. Возвращает путь к записанному файлу.
+    """
+    with open(base_config_path, "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    config["llm_cache"] = {**(config.get("llm_cache") or {}), "enabled": False}
+    config["ingest_cache"] = {**(config.get("ingest_cache") or {}), "cache_dir": os.path.join(work_dir, "ingest")}
+    config["metrics"] = {"enabled": True, "path": os.path.join(work_dir, "metrics", "run_metrics"), "snapshot_every_seconds": None}
+    config["template_classification"] = {
+        **(config.get("template_classification") or {}), "path": os.path.join(work_dir, "template_labels.sqlite")
+    }
+    config["semantic_index"] = {**(config.get("semantic_index") or {}), "cache_dir": os.path.join(work_dir, "semantic")}
+    config["token_budget"] = {**(config.get("token_budget") or {}), "usage_report_path": None}
+    for key, value in (overrides or {}).items():
+        config[key] = {**(config.get(key) or {}), **value} if isinstance(value, dict) else value
+    path = os.path.join(work_dir, "config.yaml")
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True, sort_keys=False)
+    return path
+
+
+def mock_client(server):
+    from openai import OpenAI
+    return OpenAI(base_url=server.base_url, api_key="mock")
+
+
+def run_ingest(paths, server, work_dir, base_config_path, **_):
+    from fetch_tags import FetchTags
+    fetch_tags = FetchTags(benchmark_config(base_config_path, work_dir))
+    client_data = fetch_tags.load_client_data(paths["products"], paths["outgoing"], paths["incoming"], paths["contracts"])
+    if client_data is None:
+        raise RuntimeError(f"Не удалось прочитать синтетические данные: {paths}")
+    df_products, ops_index, _contracts_index = client_data
+    return {"clients": len(df_products), "clients_with_operations": len(ops_index), "metrics": fetch_tags.metrics.snapshot()}
+
+
+def run_fetch_tags(paths, server, work_dir, base_config_path, streaming=False, packed=False, **_):
+    from fetch_tags import FetchTags
+    overrides = {}
+    if streaming:
+        overrides["streaming"] = {"enabled": True}
+    if packed:
+        overrides["llm_packing"] = {"enabled": True}
+    fetch_tags = FetchTags(benchmark_config(base_config_path, work_dir, overrides))
+    fetch_tags.client = mock_client(server)
+    results = fetch_tags.process_excel_files(paths["products"], paths["outgoing"], paths["incoming"], paths["contracts"])
+    return {"clients": len(results or []), "metrics": fetch_tags.metrics.snapshot()}
+
+
+def run_find_new_tags(paths, server, work_dir, base_config_path, new_tags_clients=100, **_):
+    import find_new_tags
+    from ingest import IngestCache
+    find_new_tags.client = mock_client(server)
+    find_new_tags.usage_tracker = UsageTracker() # учет токенов модуля общий для процесса — по сценарию заново
+    processed_tags_file = os.path.join(work_dir, "mb_new_tags.md")
+    # Иначе клиенты прошлого прогона будут пропущены
+    for path in (processed_tags_file, find_new_tags.default_ledger_path(processed_tags_file)):
+        if os.path.exists(path):
+            os.remove(path)
+    # Построчный вывод по клиентам не нужен в отчете бенчмарка
+    with contextlib.redirect_stdout(io.StringIO()):
+        find_new_tags.analyze_clients_for_additional_single_tags(
+            paths["products"], paths["outgoing"], processed_tags_file,
+            num_clients_to_process=new_tags_clients, ingest_cache=IngestCache(enabled=False)
+        )
+    return {"clients": new_tags_clients, "usage": find_new_tags.usage_tracker.summary()}
+
+
+def run_find_new_tags_batched(paths, server, work_dir, base_config_path, new_tags_clients=100, **_):
+    import find_new_tags
+    from ingest import IngestCache
+    find_new_tags.client = mock_client(server)
+    find_new_tags.usage_tracker = UsageTracker()
+    suggestions_file = os.path.join(work_dir, "new_tag_suggestions.jsonl")
+    if os.path.exists(suggestions_file):
+        os.remove(suggestions_file) # иначе клиенты прошлого прогона будут пропущены
+    with contextlib.redirect_stdout(io.StringIO()):
+        catalogue = find_new_tags.discover_new_tags_batched(
+            paths["products"], paths["outgoing"], suggestions_file, os.path.join(work_dir, "new_tags_catalogue.md"),
+            num_clients_to_process=new_tags_clients, ingest_cache=IngestCache(enabled=False)
+        )
+    return {"clients": new_tags_clients, "catalogue_tags": len(catalogue or []), "usage": find_new_tags.usage_tracker.summary()}
+
+
+SCENARIO_RUNNERS = {
+    "ingest": run_ingest,
+    "fetch_tags": run_fetch_tags,
+    "fetch_tags_streaming": lambda *args, **kwargs: run_fetch_tags(*args, streaming=True, **kwargs),
+    "fetch_tags_packed": lambda *args, **kwargs: run_fetch_tags(*args, packed=True, **kwargs),
+    "find_new_tags": run_find_new_tags,
+    "find_new_tags_batched": run_find_new_tags_batched,
+}
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса (ru_maxrss: КБ в Linux, байты в macOS)."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_scenario(scenario, paths, completions, work_dir, base_config_path, **options) -> dict:
+    """
+    Выполняет сценарий против заглушки OpenAI: время, клиентов/сек, пик памяти Python-аллокаций (tracemalloc)
+    и пиковый RSS процесса, счетчики запросов заглушки и метрики прогона.
+    """
+    scenario_dir = os.path.join(work_dir, scenario)
+    os.makedirs(scenario_dir, exist_ok=True)
+    completions.reset()
+    with MockOpenAIServer(completions) as server:
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        try:
+            outcome = SCENARIO_RUNNERS[scenario](paths, server, scenario_dir, base_config_path, **options)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    clients = outcome.pop("clients")
+    return {
+        "scenario": scenario,
+        "clients": clients,
+        "seconds": round(elapsed, 3),
+        "clients_per_second": round(clients / elapsed, 3) if elapsed else 0.0,
+        "peak_traced_mb": round(peak_bytes / (1024 * 1024), 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "llm_calls": completions.stats(),
+        **outcome,
+    }
+
+
+def previous_result(history_path, result) -> Optional[dict]:
+    """Последняя запись истории с тем же сценарием, масштабом и параметрами заглушки."""
+    if not os.path.exists(history_path):
+        return None
+    previous = None
+    with open(history_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("scenario") == result["scenario"] and record.get("params") == result["params"]:
+                previous = record
+    return previous
+
+
+def check_regression(history_path, result, threshold) -> bool:
+    """True, если клиентов/сек упало больше чем на threshold (доля) относительно прошлого прогона."""
+    previous = previous_result(history_path, result)
+    if previous is None or not previous.get("clients_per_second"):
+        return False
+    change = result["clients_per_second"] / previous["clients_per_second"] - 1
+    message = (
+        f"{result['scenario']}: {result['clients_per_second']} клиентов/сек против {previous['clients_per_second']} "
+        f"в {previous.get('revision', '?')} ({change:+.1%})"
+    )
+    if change < -threshold:
+        logger.warning(f"Регрессия производительности — {message}")
+        return True
+    logger.info(message)
+    return False
+
+
+def append_history(history_path, result):
+    directory = os.path.dirname(history_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(history_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарки тегирования на синтетических данных и локальной заглушке OpenAI")
+    parser.add_argument("--scenario", nargs="+", default=["ingest", "fetch_tags"], choices=SCENARIOS)
+    parser.add_argument("--clients", default="1k", help="Число клиентов или масштаб: 1k, 100k, 1m")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--config", default="config.yaml", help="Базовый конфиг тегирования")
+    parser.add_argument("--work-dir", default=".cache/benchmark", help="Синтетические данные и служебные файлы прогона")
+    parser.add_argument("--history", default="benchmarks/history.jsonl", help="История результатов (JSONL, дописывается)")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Средняя задержка ответа заглушки")
+    parser.add_argument("--latency-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="Доля ответов с невалидными аргументами инструмента")
+    parser.add_argument("--new-tags-clients", type=int, default=100, help="Клиентов в сценариях find_new_tags*")
+    parser.add_argument("--regression-threshold", type=float, default=0.2,
+                        help="Допустимое падение клиентов/сек относительно прошлого прогона (доля)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Код возврата 1 при регрессии")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # FetchTags и find_new_tags создают клиент OpenAI до подмены на заглушку — ключ нужен только формально
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    clients = parse_scale(args.clients)
+    data_dir = os.path.join(args.work_dir, "data", f"{clients}_seed{args.seed}")
+    # Данные одного масштаба и seed генерируются один раз и переиспользуются прогонами
+    paths = dataset_paths(data_dir)
+    if not all(os.path.exists(path) for path in paths.values()):
+        paths = generate_dataset(data_dir, clients, seed=args.seed)
+    completions = MockChatCompletions(
+        latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+        rate_limit_rate=args.rate_limit_rate, invalid_rate=args.invalid_rate, seed=args.seed
+    )
+    params = {
+        "clients": clients, "seed": args.seed, "latency_ms": args.latency_ms,
+        "rate_limit_rate": args.rate_limit_rate, "invalid_rate": args.invalid_rate,
+    }
+    regressions = 0
+    for scenario in args.scenario:
+        logger.info(f"Сценарий {scenario}: клиентов {clients}")
+        result = run_scenario(
+            scenario, paths, completions, args.work_dir, args.config, new_tags_clients=args.new_tags_clients
+        )
+        result = {"timestamp": round(time.time(), 3), "revision": git_revision(), "params": params, **result}
+        print(json.dumps({key: value for key, value in result.items() if key not in ("metrics", "params")}, ensure_ascii=False))
+        regressions += check_regression(args.history, result, args.regression_threshold)
+        append_history(args.history, result)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
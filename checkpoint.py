@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+
+class CheckpointStore:
+    """
+    Контрольные точки тегирования в SQLite: результаты клиентов дописываются пачками по batch_size,
+    поэтому падение посреди прогона теряет не больше одной пачки.
+    Проверка «клиент уже обработан» — поиск по первичному ключу CLI_ID, без перечитывания результатов.
+    Рядом с тегами хранится отпечаток входных данных клиента: если он не изменился, теги переносятся
+    из прошлого прогона без пересчета.
+    """
+
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS client_results ("
+            " cli_id TEXT PRIMARY KEY,"
+            " cln_name TEXT,"
+            " tags TEXT NOT NULL,"
+            " fingerprint TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(client_results)")}
+        if "fingerprint" not in columns: # Файлы, созданные до появления отпечатков
+            self._conn.execute("ALTER TABLE client_results ADD COLUMN fingerprint TEXT")
+        self._conn.commit()
+
+    @classmethod
+    def from_config(cls, checkpoint_config: dict, path=None):
+        checkpoint_config = checkpoint_config or {}
+        return cls(
+            path or checkpoint_config.get("path", "checkpoints/client_tags.sqlite"),
+            batch_size=checkpoint_config.get("batch_size", 100),
+        )
+
+    def __contains__(self, cli_id):
+        with self._lock:
+            if any(result["CLI_ID"] == cli_id for result, _ in self._pending):
+                return True
+            row = self._conn.execute("SELECT 1 FROM client_results WHERE cli_id = ?", (str(cli_id),)).fetchone()
+        return row is not None
+
+    def fingerprint(self, cli_id):
+        """Сохраненный отпечаток клиента (None, если клиента нет или отпечаток не записан)."""
+        with self._lock:
+            for result, fingerprint in reversed(self._pending):
+                if result["CLI_ID"] == cli_id:
+                    return fingerprint
+            row = self._conn.execute(
+                "SELECT fingerprint FROM client_results WHERE cli_id = ?", (str(cli_id),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        with self._lock:
+            stored = self._conn.execute("SELECT COUNT(*) FROM client_results").fetchone()[0]
+            return stored + len(self._pending)
+
+    def add(self, result: dict, fingerprint=None):
+        """Добавляет результат клиента ({CLI_ID, CLN_NAME, TAGS}) и его отпечаток; запись на диск — пачками."""
+        with self._lock:
+            self._pending.append((result, fingerprint))
+            need_flush = len(self._pending) >= self.batch_size
+        if need_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO client_results (cli_id, cln_name, tags, fingerprint, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (str(result["CLI_ID"]), result.get("CLN_NAME"), json.dumps(result["TAGS"], ensure_ascii=False), fingerprint, now)
+                    for result, fingerprint in self._pending
+                ],
+            )
+            self._conn.commit()
+            self._pending = []
+
+    def get(self, cli_id):
+        self.flush()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cli_id, cln_name, tags FROM client_results WHERE cli_id = ?", (str(cli_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"CLI_ID": row[0], "CLN_NAME": row[1], "TAGS": json.loads(row[2])}
+
+    def results(self, cli_ids=None) -> list:
+        """Результаты в порядке cli_ids (клиенты без результата пропускаются) или все результаты."""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute("SELECT cli_id, cln_name, tags FROM client_results").fetchall()
+        by_id = {row[0]: {"CLI_ID": row[0], "CLN_NAME": row[1], "TAGS": json.loads(row[2])} for row in rows}
+        if cli_ids is None:
+            return list(by_id.values())
+        return [by_id[str(cli_id)] for cli_id in cli_ids if str(cli_id) in by_id]
+
+    def clear(self):
+        with self._lock:
+            self._pending = []
+            self._conn.execute("DELETE FROM client_results")
+            self._conn.commit()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+class ProgressMeter:
+    """Пишет в лог скорость обработки (клиентов/сек) и оценку оставшегося времени."""
+
+    def __init__(self, total, log_every_seconds=30.0, name="Тегирование"):
+        self.total = total
+        self.log_every_seconds = log_every_seconds
+        self.name = name
+        self.done = 0
+        self.started_at = time.monotonic()
+        self._last_log_at = self.started_at
+        self._lock = threading.Lock()
+
+    def update(self, count=1):
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self._last_log_at < self.log_every_seconds:
+                return
+            self._last_log_at = now
+        self.log()
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def log(self):
+        rate = self.rate()
+        remaining = max(self.total - self.done, 0)
+        eta_seconds = remaining / rate if rate > 0 else float("inf")
+        if eta_seconds == float("inf"):
+            eta = "н/д"
+        else:
+            minutes, seconds = divmod(int(eta_seconds), 60)
+            hours, minutes = divmod(minutes, 60)
+            eta = f"{hours}:{minutes:02d}:{seconds:02d}"
+        logger.info(f"{self.name}: {self.done}/{self.total} клиентов, {rate:.2f} клиентов/сек, осталось ~{eta}")
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+
+def normalize_cli_id(series: pd.Series) -> pd.Series:
+    """Приводит CLI_ID к строке без хвоста '.00', чтобы ключи совпадали между таблицами."""
+    return series.astype(str).str.replace(r'\.00$', '', regex=True)
+
+
+class ClientIndex:
+    """
+    Индекс строк таблицы по CLI_ID.
+
+    Таблица один раз сортируется по CLI_ID (стабильно, порядок строк внутри клиента
+    сохраняется), после чего для каждого клиента запоминается диапазон [start, end).
+    Доступ к строкам клиента — O(1) срез вместо полного сканирования таблицы.
+    """
+
+    def __init__(self, df: pd.DataFrame, key: str = 'CLI_ID'):
+        self.key = key
+        self.df = df.sort_values(key, kind='stable').reset_index(drop=True)
+        keys = self.df[key].to_numpy()
+        if len(keys):
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            ends = np.r_[starts[1:], len(keys)]
+            self._ranges = {keys[s]: (int(s), int(e)) for s, e in zip(starts, ends)}
+        else:
+            self._ranges = {}
+        self._columns_cache = {}
+        self._pattern_cumsums = {}
+
+    def __contains__(self, cli_id):
+        return cli_id in self._ranges
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def client_ids(self):
+        return self._ranges.keys()
+
+    def count(self, cli_id) -> int:
+        start, end = self._ranges.get(cli_id, (0, 0))
+        return end - start
+
+    def rows(self, cli_id) -> pd.DataFrame:
+        """Строки клиента (пустой DataFrame с теми же колонками, если клиента нет)."""
+        start, end = self._ranges.get(cli_id, (0, 0))
+        return self.df.iloc[start:end]
+
+    def values(self, cli_id, column: str) -> np.ndarray:
+        """Значения колонки для клиента без создания промежуточного DataFrame."""
+        if column not in self._columns_cache:
+            self._columns_cache[column] = self.df[column].to_numpy()
+        start, end = self._ranges.get(cli_id, (0, 0))
+        return self._columns_cache[column][start:end]
+
+    def descriptions(self, cli_id, column: str = 'ENTRY_DESCR') -> list:
+        """Непустые описания операций клиента в виде списка строк."""
+        return [str(value) for value in self.values(cli_id, column) if pd.notna(value)]
+
+    def pattern_count(self, cli_id, pattern: str, column: str = 'ENTRY_DESCR') -> int:
+        """Сколько строк клиента совпадает с регулярным выражением (без учета регистра)."""
+        if (column, pattern) not in self._pattern_cumsums:
+            matches = self.df[column].astype(str).str.contains(pattern, case=False, regex=True, na=False)
+            self._pattern_cumsums[(column, pattern)] = np.r_[0, np.cumsum(matches.to_numpy(dtype=np.int64))]
+        cumsum = self._pattern_cumsums[(column, pattern)]
+        start, end = self._ranges.get(cli_id, (0, 0))
+        return int(cumsum[end] - cumsum[start])
+
+
+class ClientOperationsAccumulator:
+    """
+    Потоковая альтернатива ClientIndex для операций, которые не помещаются в память.
+
+    Операции подаются частями (add_chunk), на клиента хранится только ограниченная выборка
+    описаний (первые sample_size в порядке поступления), число операций и число операций,
+    совпавших с cash_pattern. Память зависит от числа клиентов, а не от числа транзакций.
+    """
+
+    def __init__(self, sample_size: int = 50, cash_pattern: str = None):
+        self.sample_size = sample_size
+        self.cash_pattern = cash_pattern
+        self._samples = {}
+        self._counts = {}
+        self._cash_counts = {}
+        self._full_samples = set()
+
+    def add_chunk(self, chunk: pd.DataFrame, column: str = 'ENTRY_DESCR', key: str = 'CLI_ID'):
+        for cli_id, count in chunk[key].value_counts(sort=False).items():
+            self._counts[cli_id] = self._counts.get(cli_id, 0) + int(count)
+
+        if column not in chunk.columns:
+            return
+        described = chunk[chunk[column].notna()]
+        if self.cash_pattern:
+            is_cash = described[column].astype(str).str.contains(self.cash_pattern, case=False, regex=True, na=False)
+            for cli_id, cash_count in is_cash.groupby(described[key], sort=False).sum().items():
+                if cash_count:
+                    self._cash_counts[cli_id] = self._cash_counts.get(cli_id, 0) + int(cash_count)
+
+        # Досыпаем выборку только тем клиентам, у которых она еще не заполнена
+        if self._full_samples:
+            described = described[~described[key].isin(self._full_samples)]
+        head = described.groupby(key, sort=False).head(self.sample_size)
+        for cli_id, values in head.groupby(key, sort=False)[column]:
+            sample = self._samples.setdefault(cli_id, [])
+            sample.extend(str(value) for value in values.iloc[:self.sample_size - len(sample)])
+            if len(sample) >= self.sample_size:
+                self._full_samples.add(cli_id)
+
+    def __contains__(self, cli_id):
+        return cli_id in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def client_ids(self):
+        return self._counts.keys()
+
+    def count(self, cli_id) -> int:
+        return self._counts.get(cli_id, 0)
+
+    def descriptions(self, cli_id, column: str = 'ENTRY_DESCR') -> list:
+        return list(self._samples.get(cli_id, []))
+
+    def pattern_count(self, cli_id, pattern: str, column: str = 'ENTRY_DESCR') -> int:
+        if pattern != self.cash_pattern:
+            raise ValueError("В потоковом режиме считается только шаблон, заданный при создании накопителя")
+        return self._cash_counts.get(cli_id, 0)
+
+
+class ClientContractsAccumulator:
+    """Потоковая альтернатива ClientIndex для договоров: хранит различные CON_TYPE клиента."""
+
+    def __init__(self, column: str = 'CON_TYPE'):
+        self.column = column
+        self._types = {}
+
+    def add_chunk(self, chunk: pd.DataFrame, key: str = 'CLI_ID'):
+        if self.column not in chunk.columns:
+            return
+        for cli_id, values in chunk[[key, self.column]].dropna().drop_duplicates().groupby(key, sort=False)[self.column]:
+            self._types.setdefault(cli_id, set()).update(str(value) for value in values)
+
+    def rows(self, cli_id) -> pd.DataFrame:
+        return pd.DataFrame({self.column: sorted(self._types.get(cli_id, ()))})
+
+    def to_frame(self, key: str = 'CLI_ID') -> pd.DataFrame:
+        """Все накопленные пары (CLI_ID, CON_TYPE) одной таблицей."""
+        pairs = [(cli_id, value) for cli_id, values in self._types.items() for value in values]
+        return pd.DataFrame(pairs, columns=[key, self.column])
@@ -3,12 +3,35 @@ import pandas as pd
 from datetime import datetime, date
 from openai import OpenAI
 import openai
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, create_model
 from typing import List, Optional, Literal
 from dotenv import load_dotenv
 import json
+import hashlib
+import time
+import contextvars
+from functools import lru_cache
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 from loguru import logger
+from client_index import ClientContractsAccumulator, ClientIndex, ClientOperationsAccumulator, normalize_cli_id
+from llm_cache import LLMCache
+from ingest import IngestCache
+from checkpoint import ProgressMeter
+from preclassifier import KeywordPreClassifier
+from rule_tags import build_rule_tag_matrix, parse_boolean_flag, rule_tag_lists
+from sampler import representative_sample
+from template_store import TemplateStore, aggregate_template_labels, client_template_counts
+from semantic_index import SemanticTagger
+from token_usage import CURRENT_CLIENT, UsageTracker, count_request_tokens, count_tokens
+from metrics import Metrics
+from llm_scheduler import LLMRequestDropped, RequestScheduler
+from sharding import in_shard
+from llm_packing import build_packed_model, match_packed_items, pack_by_token_budget
+from openai_batch import (
+    COMBINED_REQUEST_GROUP, BatchRequestWriter, make_custom_id, read_batch_results, split_custom_id
+)
 
 class PaymentTypes(BaseModel):
     payments_to_suppliers: bool = Field(default=False, description="True, если есть платежи поставщикам (оплата по счету, за товары/услуги, за материалы)")
@@ -22,16 +45,160 @@ class CashOperations(BaseModel):
 class VedSigns(BaseModel):
     has_ved_signs: bool = Field(default=False, description="True, если найдены признаки ВЭД, иначе false.")
 
+class TemplateLabel(BaseModel):
+    index: int = Field(description="Номер шаблона операции из списка")
+    payments_to_suppliers: bool = Field(default=False, description="True, если это платеж поставщику (оплата по счету, за товары/услуги, за материалы)")
+    payments_salary_related: bool = Field(default=False, description="True, если это выплата, похожая на зарплату (перечисление зп, аванс)")
+    payments_tax: bool = Field(default=False, description="True, если это налоговый платеж (оплата налога, пени ФНС, взнос ПФР)")
+    cash_operation: bool = Field(default=False, description="True, если это операция с наличными (касса, банкомат, инкассация, выдача/взнос наличных)")
+    has_ved_signs: bool = Field(default=False, description="True, если есть признаки ВЭД (валюта, SWIFT, таможня, валютный контроль)")
+
+class TemplateLabels(BaseModel):
+    labels: List[TemplateLabel] = Field(description="Метки для каждого шаблона операции из списка")
+
+# Версия логики тегирования: увеличивается при изменениях кода, влияющих на теги,
+# чтобы инкрементальный прогон пересчитал всех клиентов
+TAGGER_VERSION = 1
+
+# Ключи конфига, от которых зависят теги (входят в отпечаток клиента)
+FINGERPRINT_CONFIG_KEYS = (
+    "openai_model",
+    "default_system_prompt",
+    "user_prompt_template",
+    "payments_context",
+    "tags_context_cash",
+    "tags_context_ved",
+    "llm_tag_groups",
+    "llm_combined_call",
+    "combined_context",
+    "combined_group_questions",
+    "keyword_preclassifier",
+    "description_sampling",
+    "template_classification",
+    "template_classification_context",
+    "semantic_index",
+    "token_budget",
+    "llm_packing",
+    "packed_context",
+    "packed_client_context",
+)
+
+# Ключ результата tag_client со списком LLM-групп без ответа (служебный, в выходные данные не попадает)
+INCOMPLETE_GROUPS_KEY = "_incomplete_llm_groups"
+
+# Описания операций, указывающие на работу с наличными
+CASH_DESCRIPTION_PATTERN = r"наличн|касс|банкомат|инкасс|atm"
+
+# Группы тегов, которые определяются через LLM: имя группы -> модель ответа
+LLM_TAG_GROUPS = {
+    "payments": PaymentTypes,
+    "cash": CashOperations,
+    "ved": VedSigns,
+}
+
+@lru_cache(maxsize=None)
+def build_combined_model(groups: tuple) -> type[BaseModel]:
+    """Составная модель ответа: по одному полю на каждую группу тегов."""
+    fields = {group: (LLM_TAG_GROUPS[group], Field(description=f"Ответ для группы '{group}'")) for group in groups}
+    return create_model("ClientTagGroups", **fields)
+
 class FetchTags:
     def __init__(self, config_path="config.yaml"): # Изменяем путь по умолчанию на .yaml
         load_dotenv(override=True)
         self.client = OpenAI()
+        self.config = {}
         try:
             with open(config_path, 'r', encoding='utf-8') as f:
                 self.config = yaml.safe_load(f) # Используем yaml.safe_load
         except Exception as e: # Общий обработчик на случай других проблем
             logger.error(f"Неожиданная ошибка при загрузке конфигурации '{config_path}': {e}. Используются значения по умолчанию.")
 
+        # Сколько запросов к LLM может выполняться одновременно (1 — последовательный режим)
+        self.llm_concurrency = max(1, int(self.config.get("llm_concurrency", 1)))
+        self._llm_pool = None # Пул для параллельных запросов по тегам внутри клиента
+
+        # Кэш ответов LLM на диске (None, если выключен в конфиге)
+        self.llm_cache = LLMCache.from_config(self.config.get("llm_cache"))
+        # Колоночный кэш исходных Excel-файлов
+        self.ingest_cache = IngestCache.from_config(self.config.get("ingest_cache"))
+        self.preclassifier = KeywordPreClassifier.from_config(self.config.get("keyword_preclassifier"))
+        # Локальная разметка шаблонов операций по ближайшим размеченным примерам (None, если выключена)
+        self.semantic_tagger = SemanticTagger.from_config(self.config.get("semantic_index"))
+        # Расход токенов по клиентам и группам тегов за прогон
+        self.usage = UsageTracker()
+        # Метрики прогона: длительности этапов, задержки LLM, ошибки по классам
+        self.metrics = Metrics()
+        # Планировщик запросов к LLM: квоты RPM/TPM, адаптивный лимит одновременных запросов (не выше llm_concurrency), повторы
+        self.scheduler = RequestScheduler.from_config(
+            self.config.get("llm_scheduler"), self.config.get("llm_quota"),
+            max_concurrency=self.llm_concurrency, metrics=self.metrics
+        )
+        # Шард прогона (sharding.Shard): обрабатываются только клиенты шарда, None — все клиенты
+        self.shard = None
+
+    def build_chat_request(self, tags_context: str, pydantic_model: type[BaseModel]) -> dict:
+        """
+        Параметры запроса chat.completions для контекста и Pydantic модели.
+        Использует шаблоны промптов из конфигурационного файла (self.config).
+        """
+        tool_name = pydantic_model.__name__ # Используем имя класса модели как имя функции
+
+        # self.config предполагается загруженным в __init__
+        system_prompt_content = self.config.get("default_system_prompt")
+        model_to_use = self.config.get("openai_model",)
+
+        # Формируем пользовательский промпт из шаблона в конфиге
+        user_prompt_template = self.config.get("user_prompt_template")
+        user_prompt_content_final = user_prompt_template.format(
+            tags_context=tags_context,
+            tool_name=tool_name
+        )
+        return {
+            "model": model_to_use,
+            "messages": [
+                {"role": "system", "content": system_prompt_content},
+                {"role": "user", "content": user_prompt_content_final}
+            ],
+            "tools": [openai.pydantic_function_tool(pydantic_model, name=tool_name)],
+            "tool_choice": {"type": "function", "function": {"name": tool_name}},
+            "temperature": 0.1,
+        }
+
+    def chat_request_cache_key(self, request: dict) -> str:
+        return LLMCache.make_key(
+            request["model"],
+            request["messages"][0]["content"],
+            request["messages"][1]["content"],
+            request["tools"][0],
+            temperature=request["temperature"]
+        )
+
+    def request_group(self, pydantic_model: type[BaseModel]) -> str:
+        """Группа тегов запроса для учета токенов: payments/cash/ved, combined или имя модели."""
+        for group, group_model in LLM_TAG_GROUPS.items():
+            if group_model is pydantic_model:
+                return group
+        if pydantic_model.__name__ == "ClientTagGroups":
+            return COMBINED_REQUEST_GROUP
+        return pydantic_model.__name__
+
+    def parse_tool_arguments(self, arguments_json_str: str, pydantic_model: type[BaseModel]) -> Optional[BaseModel]:
+        """Разбирает JSON аргументов вызова инструмента в Pydantic модель (None при ошибке)."""
+        try:
+            parsed_args_dict = json.loads(arguments_json_str)
+            return pydantic_model(**parsed_args_dict)
+        except json.JSONDecodeError as e_json_args:
+            self.metrics.increment("llm_errors_total", {"group": self.request_group(pydantic_model), "error": type(e_json_args).__name__})
+            logger.warning(f"Ошибка декодирования JSON аргументов функции от OpenAI: {e_json_args}. Аргументы: {arguments_json_str}")
+            return None
+        except Exception as e_pydantic: # Например, pydantic.ValidationError
+            self.metrics.increment("llm_errors_total", {"group": self.request_group(pydantic_model), "error": type(e_pydantic).__name__})
+            logger.warning(
+                f"Ошибка при создании Pydantic модели из аргументов: {e_pydantic}. Аргументы: "
+                f"{parsed_args_dict if 'parsed_args_dict' in locals() else 'Не удалось распарсить JSON аргументы'}"
+            )
+            return None
+
     def get_llm_structured_output_with_pydantic(
         self,
         tags_context: str, # Измененный параметр для контекста задачи
@@ -40,73 +207,72 @@ class FetchTags:
         """
         Отправляет промпт в OpenAI и ожидает структурированный ответ,
         соответствующий предоставленной Pydantic модели, используя 'tools'.
-        Использует шаблоны промптов из конфигурационного файла (self.config).
         """
+        group = self.request_group(pydantic_model)
         try:
-            tool_name = pydantic_model.__name__ # Используем имя класса модели как имя функции
-
-            # Получаем значения из конфига или используем переданные переопределения
-            # self.config предполагается загруженным в __init__
-            system_prompt_content = self.config.get("default_system_prompt")
-            model_to_use = self.config.get("openai_model",)
-
-            # Формируем пользовательский промпт из шаблона в конфиге
-            user_prompt_template = self.config.get("user_prompt_template")
-            user_prompt_content_final = user_prompt_template.format(
-                tags_context=tags_context,
-                tool_name=tool_name
-            )
-            completion = self.client.chat.completions.create(
-                model=model_to_use,
-                messages=[
-                    {"role": "system", "content": system_prompt_content},
-                    {"role": "user", "content": user_prompt_content_final}
-                ],
-                tools=[{"type": "function", "function": openai.pydantic_function_tool(pydantic_model, name=tool_name)}],
-                tool_choice={"type": "function", "function": {"name": tool_name}},
-                temperature=0.1,
+            tool_name = pydantic_model.__name__
+            request = self.build_chat_request(tags_context, pydantic_model)
+
+            cache_key = None
+            if self.llm_cache is not None:
+                cache_key = self.chat_request_cache_key(request)
+                cached_arguments = self.llm_cache.get(cache_key)
+                if cached_arguments is not None:
+                    try:
+                        structured_output = pydantic_model(**json.loads(cached_arguments))
+                        self.metrics.increment("llm_requests_total", {"group": group, "outcome": "cache_hit"})
+                        return structured_output
+                    except Exception as e_cache: # Схема могла измениться — идем в API
+                        logger.warning(f"Некорректная запись в кэше LLM для '{tool_name}': {e_cache}")
+
+            estimated_prompt_tokens = count_request_tokens(request)
+            expected_completion_tokens = (self.config.get("token_budget") or {}).get("expected_completion_tokens", 0)
+            # Задержку каждой попытки (llm_request_seconds) и ожидание бюджета пишет планировщик
+            completion = self.scheduler.create(
+                self.client, request, estimated_prompt_tokens + expected_completion_tokens, group=group
             )
+            self.usage.record(group, getattr(completion, "usage", None), estimated_prompt_tokens)
 
             message = completion.choices[0].message
             
             if message.tool_calls and message.tool_calls[0].function.name == tool_name:
                 arguments_json_str = message.tool_calls[0].function.arguments
-                try:
-                    parsed_args_dict = json.loads(arguments_json_str)
-                    return pydantic_model(**parsed_args_dict)
-                except json.JSONDecodeError as e_json_args:
-                    print(f"Ошибка декодирования JSON аргументов функции от OpenAI: {e_json_args}")
-                    print(f"Полученные аргументы (строка): {arguments_json_str}")
-                    return None
-                except Exception as e_pydantic: # Например, pydantic.ValidationError
-                    print(f"Ошибка при создании Pydantic модели из аргументов: {e_pydantic}")
-                    print(f"Распарсенные аргументы (словарь), вызвавшие ошибку Pydantic: {parsed_args_dict if 'parsed_args_dict' in locals() else 'Не удалось распарсить JSON аргументы'}")
-                    return None
+                structured_output = self.parse_tool_arguments(arguments_json_str, pydantic_model)
+                if structured_output is not None and cache_key is not None:
+                    # В кэш попадают только ответы, прошедшие валидацию
+                    self.llm_cache.set(cache_key, arguments_json_str)
+                outcome = "ok" if structured_output is not None else "invalid"
+                self.metrics.increment("llm_requests_total", {"group": group, "outcome": outcome})
+                return structured_output
             else:
                 error_message = f"LLM не вызвала ожидаемый инструмент '{tool_name}'."
                 if message.content:
                     error_message += f" Ответ LLM: {message.content}"
                 if message.tool_calls:
                     error_message += f" Вызванные инструменты: {[tc.function.name for tc in message.tool_calls]}"
-                print(error_message)
+                logger.warning(error_message)
+                self.metrics.increment("llm_errors_total", {"group": group, "error": "ToolNotCalled"})
+                self.metrics.increment("llm_requests_total", {"group": group, "outcome": "invalid"})
                 return None
 
+        except LLMRequestDropped as e: # Повторы исчерпаны или ошибка постоянная — запрос в отчете планировщика
+            self.metrics.increment("llm_errors_total", {"group": group, "error": type(e.error).__name__})
+            self.metrics.increment("llm_requests_total", {"group": group, "outcome": "dropped"})
+            return None
         except openai.APIError as e: # Более специфичная обработка ошибок API OpenAI
-            print(f"Ошибка OpenAI API: {e}")
+            logger.warning(f"Ошибка OpenAI API: {e}")
+            self.metrics.increment("llm_errors_total", {"group": group, "error": type(e).__name__})
+            self.metrics.increment("llm_requests_total", {"group": group, "outcome": "error"})
             return None
         except Exception as e: # Любые другие непредвиденные ошибки
-            print(f"Непредвиденная ошибка при обращении к OpenAI (Pydantic tools): {e}")
+            logger.warning(f"Непредвиденная ошибка при обращении к OpenAI (Pydantic tools): {e}")
+            self.metrics.increment("llm_errors_total", {"group": group, "error": type(e).__name__})
+            self.metrics.increment("llm_requests_total", {"group": group, "outcome": "error"})
             return None
 
     def parse_boolean_flag(self, value):
         """Преобразует значения флагов (1.00, 0.00, "да", "нет") в булевы."""
-        if pd.isna(value):
-            return False
-        if isinstance(value, (int, float)):
-            return bool(value)
-        if isinstance(value, str):
-            return value.lower() in ['да', 'yes', 'true', '1', '1.0']
-        return False
+        return parse_boolean_flag(value)
 
     def parse_date_value(self, value):
         """Преобразует значение в объект date, если возможно."""
@@ -150,21 +316,57 @@ class FetchTags:
                 tags.append("company_age_established")
         return tags
 
-    def get_payment_type_tags_llm(self, transactions_descriptions):
-        tags = []
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.config.get("openai_model"))
+
+    def sample_descriptions(self, transactions_descriptions, max_items, max_tokens=None) -> str:
+        """
+        Описания операций для промпта: представительная выборка шаблонов с числом повторов
+        (секция description_sampling) или первые max_items описаний по порядку.
+        max_tokens — бюджет выборки (по умолчанию description_sampling.max_tokens при включенной выборке).
+        """
+        sampling_config = self.config.get("description_sampling") or {}
+        if not sampling_config.get("enabled", False):
+            lines = transactions_descriptions[:max_items]
+            if max_tokens is not None:
+                line_tokens = [self.count_tokens(line) for line in lines]
+                while len(lines) > 1 and sum(line_tokens) > max_tokens:
+                    lines, line_tokens = lines[:-1], line_tokens[:-1]
+            return "\n".join(lines)
+        if max_tokens is None:
+            max_tokens = sampling_config.get("max_tokens")
+        return "\n".join(representative_sample(
+            transactions_descriptions, max_items=max_items, max_tokens=max_tokens, token_counter=self.count_tokens
+        ))
+
+    def fit_prompt(self, render, transactions_descriptions, max_items, pydantic_model: type[BaseModel]) -> str:
+        """
+        Контекст с выборкой описаний: render(выборка) -> контекст. Если весь запрос (промпты и схема
+        инструмента) больше token_budget.max_prompt_tokens, выборка ужимается на величину превышения.
+        """
+        sample = self.sample_descriptions(transactions_descriptions, max_items)
+        context = render(sample)
+        max_prompt_tokens = (self.config.get("token_budget") or {}).get("max_prompt_tokens")
+        if not max_prompt_tokens:
+            return context
+        excess = count_request_tokens(self.build_chat_request(context, pydantic_model)) - max_prompt_tokens
+        if excess <= 0:
+            return context
+        sample_budget = max(self.count_tokens(sample) - excess, 0)
+        logger.debug(f"Запрос {pydantic_model.__name__} больше бюджета на {excess} токенов, выборка ужата до {sample_budget}")
+        return render(self.sample_descriptions(transactions_descriptions, max_items, sample_budget))
+
+    def build_payments_context(self, transactions_descriptions) -> Optional[str]:
+        """Контекст для группы payments или None, если запрос к LLM не нужен."""
         if not transactions_descriptions:
-            return tags
-        
-        sample_descriptions = "\n".join(transactions_descriptions[:20])
-        
-        payments_context = self.config["payments_context"].format(sample_descriptions=sample_descriptions)
-        
-        # Pydantic модель PaymentTypes уже описана выше
-        structured_response: Optional[PaymentTypes] = self.get_llm_structured_output_with_pydantic(
-            tags_context=payments_context,
-            pydantic_model=PaymentTypes
+            return None
+        return self.fit_prompt(
+            lambda sample_descriptions: self.config["payments_context"].format(sample_descriptions=sample_descriptions),
+            transactions_descriptions, 20, PaymentTypes
         )
-        
+
+    def payment_tags_from_response(self, structured_response: Optional[PaymentTypes]):
+        tags = []
         if structured_response:
             if structured_response.payments_to_suppliers:
                 tags.append("payments_to_suppliers")
@@ -174,29 +376,46 @@ class FetchTags:
                 tags.append("payments_tax")
         return tags
 
-    def get_cash_operations_tags_llm(self, transactions_descriptions, kassa_comis_total):
-        tags = []
-        has_cash_indicators_from_data = bool(kassa_comis_total and kassa_comis_total > 0)
+    def get_payment_type_tags_llm(self, transactions_descriptions):
+        payments_context = self.build_payments_context(transactions_descriptions)
+        if payments_context is None:
+            return []
+
+        # Pydantic модель PaymentTypes уже описана выше
+        structured_response: Optional[PaymentTypes] = self.get_llm_structured_output_with_pydantic(
+            tags_context=payments_context,
+            pydantic_model=PaymentTypes
+        )
+        return self.payment_tags_from_response(structured_response)
 
-        if not transactions_descriptions and not has_cash_indicators_from_data:
-            tags.append("cash_operations_low")
-            return tags
+    def has_cash_indicators(self, kassa_comis_total):
+        return bool(kassa_comis_total and kassa_comis_total > 0)
 
-        sample_descriptions = "\n".join(transactions_descriptions[:10]) if transactions_descriptions else "Нет описаний транзакций для анализа."
-        
+    def build_cash_additional_info(self, kassa_comis_total, cash_operations_count=0):
+        has_cash_indicators_from_data = self.has_cash_indicators(kassa_comis_total)
         additional_cash_info_str = f"Дополнительная информация: {'есть данные о комиссиях по кассовым операциям на общую сумму ' + str(kassa_comis_total) if has_cash_indicators_from_data else ""}."
+        if cash_operations_count:
+            additional_cash_info_str += f" Операций с признаками наличных (касса, банкомат, инкассация): {cash_operations_count}."
+        return additional_cash_info_str
+
+    def build_cash_context(self, transactions_descriptions, kassa_comis_total, cash_operations_count=0) -> Optional[str]:
+        """Контекст для группы cash или None, если запрос к LLM не нужен."""
+        if not transactions_descriptions and not self.has_cash_indicators(kassa_comis_total):
+            return None
 
         # Формируем tags_context_cash:
-        tags_context_cash = self.config["tags_context_cash"].format(
+        render = lambda sample_descriptions: self.config["tags_context_cash"].format(
             sample_descriptions=sample_descriptions,
-            additional_cash_info_str=additional_cash_info_str
-        )
-        
-        structured_response: Optional[CashOperations] = self.get_llm_structured_output_with_pydantic(
-            user_prompt_content=tags_context_cash,
-            pydantic_model=CashOperations
+            additional_cash_info_str=self.build_cash_additional_info(kassa_comis_total, cash_operations_count)
         )
-        
+        if not transactions_descriptions:
+            return render("Нет описаний транзакций для анализа.")
+        return self.fit_prompt(render, transactions_descriptions, 10, CashOperations)
+
+    def cash_tags_from_response(self, structured_response: Optional[CashOperations], kassa_comis_total):
+        tags = []
+        has_cash_indicators_from_data = self.has_cash_indicators(kassa_comis_total)
+
         if structured_response:
             if structured_response.cash_activity_level == "high":
                 tags.append("cash_operations_high")
@@ -204,12 +423,23 @@ class FetchTags:
                 tags.append("cash_operations_low")
             elif not tags and has_cash_indicators_from_data: # Дополнительная логика, если LLM не определила четко
                 tags.append("cash_operations_high")
-        
+
         if not tags:
             tags.append("cash_operations_low" if not has_cash_indicators_from_data else "cash_operations_high")
 
         return tags
 
+    def get_cash_operations_tags_llm(self, transactions_descriptions, kassa_comis_total, cash_operations_count=0):
+        tags_context_cash = self.build_cash_context(transactions_descriptions, kassa_comis_total, cash_operations_count)
+
+        structured_response: Optional[CashOperations] = None
+        if tags_context_cash is not None:
+            structured_response = self.get_llm_structured_output_with_pydantic(
+                tags_context=tags_context_cash,
+                pydantic_model=CashOperations
+            )
+        return self.cash_tags_from_response(structured_response, kassa_comis_total)
+
     def get_geo_tags(self, city_value):
         tags = []
         if pd.notna(city_value):
@@ -222,43 +452,160 @@ class FetchTags:
 
     # Вспомогательная функция, если она нужна для is_ved_flag_value
     def parse_boolean_flag(self, value):
-        if pd.isna(value) if 'pd' in globals() else value is None: # Проверка на pandas, если используется
-            return False
-        if isinstance(value, (int, float)):
-            return bool(value)
-        if isinstance(value, str):
-            return value.lower() in ['да', 'yes', 'true', '1', '1.0']
-        return False
+        return parse_boolean_flag(value) # то же правило, что у колонок флагов в build_rule_tag_matrix
 
-    def get_ved_tags(self, is_ved_flag_value, transactions_descriptions=None):
-        tags = []
-        is_ved_explicitly_true = self.parse_boolean_flag(is_ved_flag_value)
+    def build_ved_context(self, is_ved_flag_value, transactions_descriptions=None) -> Optional[str]:
+        """Контекст для группы ved или None, если признак известен без LLM."""
+        if self.parse_boolean_flag(is_ved_flag_value) or not transactions_descriptions:
+            return None
+        return self.fit_prompt(
+            lambda sample_descriptions: self.config["tags_context_ved"].format(sample_descriptions=sample_descriptions),
+            transactions_descriptions, 10, VedSigns
+        )
 
-        if is_ved_explicitly_true:
-            tags.append("ved_active")
-            return tags
+    def ved_tags_from_response(self, structured_response: Optional[VedSigns], is_ved_flag_value):
+        if self.parse_boolean_flag(is_ved_flag_value):
+            return ["ved_active"]
+        if structured_response and structured_response.has_ved_signs:
+            return ["ved_active"]
+        return ["ved_absent"]
 
-        if transactions_descriptions:
-            sample_descriptions = "\n".join(transactions_descriptions[:10])
-            
-            tags_context_ved = self.config["tags_context_ved"].format(
-                sample_descriptions=sample_descriptions)
+    def get_ved_tags(self, is_ved_flag_value, transactions_descriptions=None):
+        tags_context_ved = self.build_ved_context(is_ved_flag_value, transactions_descriptions)
+
+        structured_response: Optional[VedSigns] = None
+        if tags_context_ved is not None:
             # TODO: Добавить возможность писать reason почему этот тэг
-            # Общий промпт сделать, вынести в конфиг, задать место в промпте для контекста
             # Передавать не только транзакции, но и профиль клиента
-            structured_response: Optional[VedSigns] = self.get_llm_structured_output_with_pydantic(
-                user_prompt_content=tags_context_ved,
+            structured_response = self.get_llm_structured_output_with_pydantic(
+                tags_context=tags_context_ved,
                 pydantic_model=VedSigns
             )
-            
-            if structured_response and structured_response.has_ved_signs:
-                tags.append("ved_active")
-            else:
-                tags.append("ved_absent")
-        else:
-            tags.append("ved_absent")
-            
-        return tags
+        return self.ved_tags_from_response(structured_response, is_ved_flag_value)
+
+    # --- Группы тегов, определяемые через LLM ---
+    def enabled_llm_tag_groups(self):
+        groups = self.config.get("llm_tag_groups", list(LLM_TAG_GROUPS))
+        return [group for group in groups if group in LLM_TAG_GROUPS]
+
+    def build_llm_contexts(self, evidence) -> dict:
+        """
+        Контексты для включенных групп, которым нужен запрос к LLM.
+        evidence — данные клиента: descriptions, kassa_comis_total, is_ved.
+        """
+        builders = {
+            "payments": lambda: self.build_payments_context(evidence["descriptions"]),
+            "cash": lambda: self.build_cash_context(
+                evidence["descriptions"], evidence["kassa_comis_total"], evidence.get("cash_operations_count", 0)
+            ),
+            "ved": lambda: self.build_ved_context(evidence["is_ved"], evidence["descriptions"]),
+        }
+        contexts = {}
+        for group in self.enabled_llm_tag_groups():
+            context = builders[group]()
+            if context is not None:
+                contexts[group] = context
+        return contexts
+
+    def count_llm_requests(self, contexts) -> int:
+        """Сколько запросов к LLM нужно для этих контекстов (с учетом llm_combined_call)."""
+        if self.config.get("llm_combined_call", False) and len(contexts) > 1:
+            return 1
+        return len(contexts)
+
+    def split_llm_groups(self, evidence):
+        """
+        Делит группы клиента на требующие LLM и определенные предклассификатором по ключевым словам.
+        Возвращает (контексты {группа: контекст} для LLM, ответы {группа: модель} без LLM).
+        """
+        contexts = self.build_llm_contexts(evidence)
+        if self.preclassifier is None or not contexts:
+            return contexts, {}
+        resolved = self.preclassifier.resolve(evidence, list(contexts))
+        responses = {group: LLM_TAG_GROUPS[group](**fields) for group, fields in resolved.items()}
+        remaining = {group: context for group, context in contexts.items() if group not in responses}
+        planned = self.count_llm_requests(contexts)
+        self.preclassifier.record(responses, planned, planned - self.count_llm_requests(remaining))
+        return remaining, responses
+
+    def log_preclassifier_stats(self):
+        if self.preclassifier is not None:
+            self.preclassifier.log_stats()
+
+    def llm_group_tags(self, group, structured_response, evidence):
+        """Переводит ответ модели группы (или None) в строковые теги."""
+        if group == "payments":
+            return self.payment_tags_from_response(structured_response)
+        if group == "cash":
+            return self.cash_tags_from_response(structured_response, evidence["kassa_comis_total"])
+        if group == "ved":
+            return self.ved_tags_from_response(structured_response, evidence["is_ved"])
+        return []
+
+    def build_combined_context(self, evidence, groups) -> str:
+        descriptions = evidence["descriptions"]
+        group_questions = "\n".join(
+            f"- {group}: {self.config['combined_group_questions'][group].strip()}" for group in groups
+        )
+        render = lambda sample_descriptions: self.config["combined_context"].format(
+            sample_descriptions=sample_descriptions,
+            additional_cash_info_str=self.build_cash_additional_info(
+                evidence["kassa_comis_total"], evidence.get("cash_operations_count", 0)
+            ),
+            group_questions=group_questions
+        )
+        if not descriptions:
+            return render("Нет описаний транзакций для анализа.")
+        return self.fit_prompt(render, descriptions, 20, build_combined_model(tuple(groups)))
+
+    def get_combined_llm_output(self, evidence, groups) -> Optional[dict]:
+        """
+        Один вызов инструмента с составной моделью из всех групп.
+        Возвращает словарь {группа: ответ модели группы} или None, если ответ не прошел валидацию.
+        """
+        combined_model = build_combined_model(tuple(groups))
+        structured_response = self.get_llm_structured_output_with_pydantic(
+            tags_context=self.build_combined_context(evidence, groups),
+            pydantic_model=combined_model
+        )
+        if structured_response is None:
+            return None
+        return {group: getattr(structured_response, group) for group in groups}
+
+    def get_llm_tags(self, evidence, llm_responses=None):
+        """
+        Теги всех LLM-групп клиента и список групп, для которых ответ LLM был нужен, но не получен
+        (запрос не выполнен или ответ невалиден) — их теги выставлены по умолчанию.
+        В режиме llm_combined_call группы запрашиваются одним вызовом, при неудаче — отдельными запросами по группам.
+        llm_responses — уже полученные ответы {группа: модель} (например, из батча), запросы не выполняются.
+        """
+        if llm_responses is not None:
+            return [
+                tag for group in self.enabled_llm_tag_groups()
+                for tag in self.llm_group_tags(group, llm_responses.get(group), evidence)
+            ], []
+
+        contexts, responses = self.split_llm_groups(evidence)
+
+        if self.config.get("llm_combined_call", False) and len(contexts) > 1:
+            combined_responses = self.get_combined_llm_output(evidence, list(contexts)) or {}
+            responses.update(combined_responses)
+            if not combined_responses:
+                self.metrics.increment("llm_combined_fallbacks_total")
+                logger.warning("Составной ответ LLM не получен или невалиден, выполняем запросы по группам.")
+
+        pending = [group for group in contexts if group not in responses]
+        group_responses = self.run_llm_taggers([
+            (self.get_llm_structured_output_with_pydantic, (contexts[group], LLM_TAG_GROUPS[group]))
+            for group in pending
+        ])
+        responses.update(zip(pending, group_responses))
+
+        tags = []
+        for group in self.enabled_llm_tag_groups():
+            tags.extend(self.llm_group_tags(group, responses.get(group), evidence))
+        incomplete_groups = [group for group in contexts if responses.get(group) is None]
+        return tags, incomplete_groups
 
     def get_acquiring_tags(self, is_acq_flag_value):
         tags = []
@@ -296,16 +643,25 @@ class FetchTags:
             tags.append("loyalty_long_term_client_smb")
         return tags
 
-    # --- Основная функция для обработки данных из Excel ---
-    def process_excel_files(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file):
+    # --- Загрузка данных из Excel ---
+    def load_client_data(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file):
         """
-        Читает данные из Excel, обрабатывает их и извлекает теги для каждого клиента.
+        Читает исходные файлы (через колоночный кэш) и строит индексы операций и договоров по CLI_ID.
+        Возвращает (df_products, ops_index, contracts_index) или None при ошибке чтения.
         """
+        streaming_config = self.config.get("streaming", {})
+        if streaming_config.get("enabled", False):
+            return self.load_client_data_streaming(
+                products_file, outgoing_ops_file, incoming_ops_file, contracts_file, streaming_config
+            )
         try:
-            df_products = pd.read_excel(products_file)
-            df_outgoing_ops = pd.read_excel(outgoing_ops_file)
-            df_incoming_ops = pd.read_excel(incoming_ops_file)
-            df_contracts = pd.read_excel(contracts_file) # Добавляем чтение договоров
+            with self.metrics.timer("stage_seconds", stage="read_products"):
+                df_products = self.ingest_cache.read(products_file, "products")
+            with self.metrics.timer("stage_seconds", stage="read_operations"):
+                df_outgoing_ops = self.ingest_cache.read(outgoing_ops_file, "operations")
+                df_incoming_ops = self.ingest_cache.read(incoming_ops_file, "operations")
+            with self.metrics.timer("stage_seconds", stage="read_contracts"):
+                df_contracts = self.ingest_cache.read(contracts_file, "contracts") # Добавляем чтение договоров
         except FileNotFoundError as e:
             logger.error(f"Ошибка: Файл не найден. {e}")
             return None
@@ -317,56 +673,832 @@ class FetchTags:
         df_all_ops = pd.concat([df_outgoing_ops, df_incoming_ops], ignore_index=True)
 
         # Убедимся, что CLI_ID имеет одинаковый тип для мержа
-        df_products['CLI_ID'] = df_products['CLI_ID'].astype(str).str.replace(r'\.00$', '', regex=True)
-        df_all_ops['CLI_ID'] = df_all_ops['CLI_ID'].astype(str).str.replace(r'\.00$', '', regex=True)
-        df_contracts['CLI_ID'] = df_contracts['CLI_ID'].astype(str).str.replace(r'\.00$', '', regex=True)
+        df_products['CLI_ID'] = normalize_cli_id(df_products['CLI_ID'])
+        df_all_ops['CLI_ID'] = normalize_cli_id(df_all_ops['CLI_ID'])
+        df_contracts['CLI_ID'] = normalize_cli_id(df_contracts['CLI_ID'])
 
+        if self.shard is not None:
+            df_products = in_shard(df_products, self.shard)
+            df_all_ops = in_shard(df_all_ops, self.shard)
+            df_contracts = in_shard(df_contracts, self.shard)
+            logger.info(f"Шард {self.shard}: клиентов {len(df_products)}, операций {len(df_all_ops)}")
 
-        results = [] # Список для хранения результатов (CLI_ID, теги)
+        # Один проход группировки вместо фильтрации всей таблицы на каждого клиента
+        with self.metrics.timer("stage_seconds", stage="build_indexes"):
+            ops_index = ClientIndex(df_all_ops)
+            contracts_index = ClientIndex(df_contracts)
+        return df_products, ops_index, contracts_index
 
-        # Итерация по уникальным клиентам из таблицы продуктов
-        for index, client_row in df_products.iterrows():
-            cli_id = client_row['CLI_ID']
-            logger.info(f"\n--- Обработка клиента CLI_ID: {cli_id} ({client_row.get('CLN_NAME', 'N/A')}) ---")
-            
-            client_tags = set()
+    def load_client_data_streaming(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file, streaming_config):
+        """
+        Потоковая загрузка: операции и договоры читаются частями, на клиента остается только
+        ограниченная выборка описаний, счетчики и признаки наличных. Пиковая память зависит
+        от числа клиентов, а не от числа операций.
+        """
+        chunksize = streaming_config.get("chunksize", 200000)
+        ops_index = ClientOperationsAccumulator(
+            sample_size=streaming_config.get("sample_size", 50),
+            cash_pattern=CASH_DESCRIPTION_PATTERN
+        )
+        contracts_index = ClientContractsAccumulator()
+        try:
+            with self.metrics.timer("stage_seconds", stage="read_products"):
+                df_products = self.ingest_cache.read(products_file, "products")
+            # Порядок как в обычном режиме: сначала исходящие, затем входящие операции
+            with self.metrics.timer("stage_seconds", stage="stream_operations"):
+                for ops_file in (outgoing_ops_file, incoming_ops_file):
+                    for chunk in self.ingest_cache.iter_chunks(ops_file, "operations", chunksize):
+                        ops_index.add_chunk(self.shard_rows(chunk))
+            with self.metrics.timer("stage_seconds", stage="stream_contracts"):
+                for chunk in self.ingest_cache.iter_chunks(contracts_file, "contracts", chunksize):
+                    contracts_index.add_chunk(self.shard_rows(chunk))
+        except FileNotFoundError as e:
+            logger.error(f"Ошибка: Файл не найден. {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка при потоковом чтении файлов: {e}")
+            return None
+
+        df_products['CLI_ID'] = normalize_cli_id(df_products['CLI_ID'])
+        df_products = self.shard_rows(df_products)
+        logger.info(f"Потоковая загрузка завершена: клиентов с операциями {len(ops_index)}")
+        return df_products, ops_index, contracts_index
+
+    def shard_rows(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Строки таблицы, относящиеся к шарду прогона (вся таблица, если шард не задан)."""
+        return df if self.shard is None else in_shard(df, self.shard)
+
+    def client_evidence(self, company_data, ops_index):
+        """Данные клиента, от которых зависят LLM-теги."""
+        kassa_comis_total_client = company_data.get('KASSA_COMIS', 0)
+        if pd.isna(kassa_comis_total_client): kassa_comis_total_client = 0
+        cli_id = company_data['CLI_ID']
+        with self.metrics.timer("client_grouping_seconds"):
+            return {
+                "descriptions": ops_index.descriptions(cli_id),
+                "operations_count": ops_index.count(cli_id),
+                "cash_operations_count": ops_index.pattern_count(cli_id, CASH_DESCRIPTION_PATTERN),
+                "kassa_comis_total": kassa_comis_total_client,
+                "is_ved": company_data.get("IS_VED"),
+            }
+
+    def config_version(self) -> str:
+        """Хэш версии логики и частей конфига, от которых зависят теги."""
+        relevant_config = {key: self.config.get(key) for key in FINGERPRINT_CONFIG_KEYS}
+        payload = json.dumps({"tagger_version": TAGGER_VERSION, "config": relevant_config}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-            # 1. Данные из таблицы "Продукты" (company_data)
+    def client_fingerprint(self, company_data, ops_index, contracts_index, config_version=None, rule_tags=None) -> str:
+        """
+        Отпечаток входных данных клиента: строка продуктов, выборка операций, типы договоров и версия конфига.
+        Возраст компании зависит от текущей даты, поэтому в отпечаток входят и теги по правилам.
+        """
+        evidence = self.client_evidence(company_data, ops_index)
+        contracts = contracts_index.rows(company_data['CLI_ID'])
+        contract_types = sorted(contracts['CON_TYPE'].dropna().astype(str).unique()) if 'CON_TYPE' in contracts else []
+        if rule_tags is None:
+            rule_tags = self.row_rule_tags(company_data, contracts)
+        payload = json.dumps(
+            {
+                "product": {key: None if pd.isna(value) else str(value) for key, value in company_data.items()},
+                "evidence": evidence,
+                "contract_types": contract_types,
+                "rule_tags": sorted(rule_tags),
+                "config_version": config_version or self.config_version(),
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # --- Основная функция для обработки данных из Excel ---
+    def process_excel_files(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file, checkpoint=None,
+                            results_writer=None):
+        """
+        Читает данные из Excel, обрабатывает их и извлекает теги для каждого клиента.
+        checkpoint — CheckpointStore: результаты пишутся в него пачками вместе с отпечатками входных данных.
+        Клиенты, чей отпечаток совпадает с сохраненным, не пересчитываются — их теги переносятся из хранилища.
+        results_writer — ResultsParquetWriter: результаты передаются в него по мере готовности
+        (перенесенные из хранилища клиенты — после пересчитанных).
+        """
+        self.start_metrics_snapshots()
+        try:
+            return self._process_excel_files(
+                products_file, outgoing_ops_file, incoming_ops_file, contracts_file, checkpoint, results_writer
+            )
+        finally:
+            self.metrics.stop_snapshots()
+            self.export_metrics()
+
+    def _process_excel_files(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file, checkpoint=None,
+                             results_writer=None):
+        client_data = self.load_client_data(products_file, outgoing_ops_file, incoming_ops_file, contracts_file)
+        if client_data is None:
+            return None
+        df_products, ops_index, contracts_index = client_data
+
+        client_rows = [client_row for _, client_row in df_products.iterrows()]
+        # Теги по правилам — одним векторным проходом по всей таблице, в цикле по клиентам остаются только LLM-теги
+        with self.metrics.timer("stage_seconds", stage="rule_tags"):
+            client_rule_tags = self.rule_tags_for_products(df_products, contracts_index)
+
+        pending_rows = client_rows
+        pending_rule_tags = client_rule_tags
+        pending_fingerprints = [None] * len(client_rows)
+        if checkpoint is not None:
+            config_version = self.config_version()
+            pending_rows, pending_rule_tags, pending_fingerprints = [], [], []
+            unchanged_ids = []
+            new_clients = 0
+            with self.metrics.timer("stage_seconds", stage="fingerprints"):
+                for client_row, rule_tags in zip(client_rows, client_rule_tags):
+                    fingerprint = self.client_fingerprint(
+                        client_row.to_dict(), ops_index, contracts_index, config_version, rule_tags
+                    )
+                    stored_fingerprint = checkpoint.fingerprint(client_row['CLI_ID'])
+                    if stored_fingerprint == fingerprint:
+                        unchanged_ids.append(client_row['CLI_ID'])
+                        continue
+                    if stored_fingerprint is None:
+                        new_clients += 1
+                    pending_rows.append(client_row)
+                    pending_rule_tags.append(rule_tags)
+                    pending_fingerprints.append(fingerprint)
+            logger.info(
+                f"Хранилище {checkpoint.path}: без изменений {len(client_rows) - len(pending_rows)} клиентов, "
+                f"к пересчету {len(pending_rows)} (новых или без отпечатка: {new_clients})"
+            )
+
+        # Режим шаблонов: LLM размечает уникальные шаблоны операций, теги клиентов получаются агрегацией
+        pending_llm_responses = None
+        if self.template_mode_enabled() and pending_rows:
+            with self.metrics.timer("stage_seconds", stage="template_classification"):
+                pending_llm_responses = self.template_llm_responses(pending_rows, ops_index)
+
+        # Режим упаковки: LLM-группы нескольких клиентов запрашиваются одним вызовом (и для выбросов режима шаблонов)
+        packing = self.packing_enabled() and pending_rows
+
+        progress = ProgressMeter(
+            len(pending_rows),
+            log_every_seconds=self.config.get("checkpoint", {}).get("progress_every_seconds", 30)
+        )
+        results = []
+        incomplete_clients = 0
+        try:
+            if packing:
+                tagged_clients = self.iter_packed_tagged_clients(
+                    pending_rows, ops_index, contracts_index, pending_rule_tags, pending_llm_responses
+                )
+            else:
+                tagged_clients = self.iter_tagged_clients(
+                    pending_rows, ops_index, contracts_index, pending_rule_tags, pending_llm_responses
+                )
+            for result, fingerprint in zip(tagged_clients, pending_fingerprints):
+                if result.pop(INCOMPLETE_GROUPS_KEY, None):
+                    # Без отпечатка: следующий прогон пересчитает клиента, а не перенесет теги по умолчанию
+                    fingerprint = None
+                    incomplete_clients += 1
+                if checkpoint is not None:
+                    checkpoint.add(result, fingerprint)
+                else:
+                    results.append(result)
+                if results_writer is not None:
+                    results_writer.add(result)
+                progress.update()
+                self.metrics.set_gauge("clients_per_second", round(progress.rate(), 3))
+        finally:
+            if checkpoint is not None:
+                checkpoint.flush()
+        progress.log()
+        if incomplete_clients:
+            logger.warning(
+                f"Клиентов без ответа LLM по части групп: {incomplete_clients} — теги этих групп по умолчанию"
+                + (", клиенты будут пересчитаны в следующем прогоне" if checkpoint is not None else "")
+            )
+
+        if checkpoint is not None:
+            if results_writer is not None:
+                for result in checkpoint.results(unchanged_ids):
+                    results_writer.add(result)
+            results = checkpoint.results(df_products['CLI_ID'])
+        self.log_llm_cache_stats()
+        self.log_preclassifier_stats()
+        self.log_usage_summary()
+        return results
+
+    def iter_tagged_clients(self, client_rows, ops_index, contracts_index, client_rule_tags, client_llm_responses=None):
+        """
+        Результаты тегирования в порядке client_rows; при llm_concurrency > 1 клиенты обрабатываются параллельно.
+        client_llm_responses — готовые ответы LLM по клиентам (режим шаблонов), запросы по клиентам не выполняются.
+        """
+        if client_llm_responses is None:
+            client_llm_responses = [None] * len(client_rows)
+        if self.llm_concurrency == 1:
+            for client_row, rule_tags, llm_responses in zip(client_rows, client_rule_tags, client_llm_responses):
+                yield self.tag_client(client_row, ops_index, contracts_index, llm_responses=llm_responses, rule_tags=rule_tags)
+            return
+
+        # Клиенты и их LLM-теги обрабатываются параллельно; map сохраняет порядок входных данных
+        with ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="client") as client_pool, \
+                ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="llm") as llm_pool:
+            self._llm_pool = llm_pool
+            try:
+                yield from client_pool.map(
+                    lambda client_row, rule_tags, llm_responses: self.tag_client(
+                        client_row, ops_index, contracts_index, llm_responses=llm_responses, rule_tags=rule_tags
+                    ),
+                    client_rows,
+                    client_rule_tags,
+                    client_llm_responses
+                )
+            finally:
+                self._llm_pool = None
+
+    # --- Режим шаблонов: классификация уникальных шаблонов операций по всему портфелю ---
+    def template_mode_enabled(self) -> bool:
+        return self.config.get("template_classification", {}).get("enabled", False) or self.semantic_tagger is not None
+
+    def template_labels_version(self) -> str:
+        """Версия разметки шаблонов: модель, промпты и схема ответа."""
+        payload = json.dumps(
+            {
+                "model": self.config.get("openai_model"),
+                "system_prompt": self.config.get("default_system_prompt"),
+                "user_prompt_template": self.config.get("user_prompt_template"),
+                "context": self.config.get("template_classification_context"),
+                "schema": TemplateLabels.model_json_schema(),
+            },
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def classify_template_chunk(self, templates) -> dict:
+        """Метки для пачки шаблонов одним запросом: {шаблон: {поле: bool}} (шаблоны без ответа пропускаются)."""
+        numbered_templates = "\n".join(f"{index}. {template}" for index, template in enumerate(templates))
+        structured_response: Optional[TemplateLabels] = self.get_llm_structured_output_with_pydantic(
+            tags_context=self.config["template_classification_context"].format(templates=numbered_templates),
+            pydantic_model=TemplateLabels
+        )
+        if structured_response is None:
+            return {}
+        return {
+            templates[label.index]: label.model_dump(exclude={"index"})
+            for label in structured_response.labels
+            if 0 <= label.index < len(templates)
+        }
+
+    def classify_templates(self, templates, template_store, labels_version) -> dict:
+        """Размечает шаблоны пачками по templates_per_request (пачки — параллельно), метки сразу пишутся в хранилище."""
+        chunk_size = max(1, int(self.config.get("template_classification", {}).get("templates_per_request", 50)))
+        chunks = [templates[i:i + chunk_size] for i in range(0, len(templates), chunk_size)]
+        template_labels = {}
+        with ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="llm") as llm_pool:
+            for chunk_labels in llm_pool.map(self.classify_template_chunk, chunks):
+                template_store.set_labels(chunk_labels, labels_version)
+                template_labels.update(chunk_labels)
+        missing = len(templates) - len(template_labels)
+        logger.info(
+            f"Размечено шаблонов: {len(template_labels)} из {len(templates)} за {len(chunks)} запросов к LLM"
+            + (f" (без ответа: {missing} — клиенты с ними обрабатываются запросами по клиенту, "
+               f"шаблоны будут отправлены в следующем прогоне)" if missing else "")
+        )
+        return template_labels
+
+    def template_group_responses(self, company_data, template_counts, template_labels) -> dict:
+        """Ответы групп для клиента, собранные из меток его шаблонов ({} — нет размеченных операций)."""
+        aggregated = aggregate_template_labels(template_counts, template_labels)
+        if not aggregated["labelled_operations"]:
+            return {}
+        kassa_comis_total = company_data.get('KASSA_COMIS', 0)
+        if pd.isna(kassa_comis_total): kassa_comis_total = 0
+        cash_high_min_share = self.config.get("template_classification", {}).get("cash_high_min_share", 0.2)
+        cash_is_high = aggregated["cash_share"] >= cash_high_min_share or self.has_cash_indicators(kassa_comis_total)
+        return {
+            "payments": PaymentTypes(
+                payments_to_suppliers=aggregated["payments_to_suppliers"],
+                payments_salary_related=aggregated["payments_salary_related"],
+                payments_tax=aggregated["payments_tax"],
+            ),
+            "cash": CashOperations(cash_activity_level="high" if cash_is_high else "low"),
+            "ved": VedSigns(has_ved_signs=aggregated["has_ved_signs"]),
+        }
+
+    def template_llm_responses(self, client_rows, ops_index) -> list:
+        """
+        Ответы LLM-групп для клиентов без запросов по клиентам: шаблоны операций всех клиентов
+        собираются в одну таблицу, новые шаблоны размечаются по ближайшим примерам (semantic_index)
+        и/или LLM, метки агрегируются по клиентам.
+        Число запросов зависит от числа уникальных шаблонов, а не от числа клиентов.
+        Клиенты, у которых остались неразмеченные шаблоны (выбросы при выключенной разметке через LLM
+        или шаблоны, на которые LLM не ответила), получают None — для них выполняются обычные запросы
+        по клиенту, а не теги по неполной разметке.
+        """
+        client_counts = [client_template_counts(ops_index.descriptions(client_row['CLI_ID'])) for client_row in client_rows]
+        portfolio_counts = Counter()
+        for template_counts in client_counts:
+            portfolio_counts.update(template_counts)
+
+        template_store = TemplateStore.from_config(self.config.get("template_classification"))
+        try:
+            template_store.update_counts(portfolio_counts)
+            labels_version = self.template_labels_version()
+            template_labels = template_store.labels(labels_version)
+            new_templates = [template for template, _ in portfolio_counts.most_common() if template not in template_labels]
+            logger.info(
+                f"Шаблонов операций: {len(portfolio_counts)} (операций: {sum(portfolio_counts.values())}), "
+                f"уже размечено: {len(portfolio_counts) - len(new_templates)}, к разметке: {len(new_templates)}"
+            )
+            if self.semantic_tagger is not None and new_templates:
+                semantic_labels, new_templates = self.semantic_tagger.label_templates(new_templates)
+                template_labels.update(semantic_labels)
+            classify_with_llm = self.config.get("template_classification", {}).get("enabled", False)
+            if classify_with_llm and new_templates:
+                template_labels.update(self.classify_templates(new_templates, template_store, labels_version))
+        finally:
+            template_store.close()
+
+        responses = []
+        for client_row, template_counts in zip(client_rows, client_counts):
+            if any(template not in template_labels for template in template_counts):
+                responses.append(None)
+            else:
+                responses.append(self.template_group_responses(client_row.to_dict(), template_counts, template_labels))
+        fallback_clients = sum(response is None for response in responses)
+        if fallback_clients:
+            logger.info(f"Клиентов с неразмеченными шаблонами (запросы к LLM по клиенту): {fallback_clients} из {len(responses)}")
+        return responses
+
+    def warm_template_labels(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file):
+        """
+        Размечает и кодирует шаблоны операций всего портфеля до запуска шардов (pipeline.py --workers):
+        шарды находят метки в хранилище шаблонов и векторы в semantic_index, а не размечают одни и те же шаблоны N раз.
+        """
+        if not self.template_mode_enabled():
+            return
+        client_data = self.load_client_data(products_file, outgoing_ops_file, incoming_ops_file, contracts_file)
+        if client_data is None:
+            return
+        df_products, ops_index, _ = client_data
+        self.template_llm_responses([client_row for _, client_row in df_products.iterrows()], ops_index)
+
+    # --- Режим упаковки: несколько клиентов в одном запросе к LLM ---
+    def packing_config(self) -> dict:
+        return self.config.get("llm_packing") or {}
+
+    def packing_enabled(self) -> bool:
+        return self.packing_config().get("enabled", False)
+
+    def iter_packed_tagged_clients(self, client_rows, ops_index, contracts_index, client_rule_tags, client_llm_responses=None):
+        """
+        Результаты тегирования в порядке client_rows с упаковкой LLM-запросов. Клиенты обрабатываются окнами
+        по llm_packing.window_clients: запросы окна выполняются до тегирования его клиентов, поэтому
+        результаты окна попадают в контрольную точку, не дожидаясь запросов по всему портфелю.
+        Клиенты с готовыми ответами (client_llm_responses) не упаковываются.
+        """
+        if client_llm_responses is None:
+            client_llm_responses = [None] * len(client_rows)
+        window = max(1, int(self.packing_config().get("window_clients", 2000)))
+        for start in range(0, len(client_rows), window):
+            rows = client_rows[start:start + window]
+            responses = list(client_llm_responses[start:start + window])
+            unresolved = [i for i, response in enumerate(responses) if response is None]
+            with self.metrics.timer("stage_seconds", stage="packed_llm_requests"):
+                packed = self.packed_llm_responses([rows[i] for i in unresolved], ops_index)
+            for i, response in zip(unresolved, packed):
+                responses[i] = response
+            yield from self.iter_tagged_clients(
+                rows, ops_index, contracts_index, client_rule_tags[start:start + window], responses
+            )
+
+    def packed_client_block(self, cli_id, evidence) -> str:
+        """Данные одного клиента в упакованном промпте: выборка описаний и кассовые показатели."""
+        descriptions = evidence["descriptions"]
+        return self.config["packed_client_context"].format(
+            cli_id=cli_id,
+            sample_descriptions=self.sample_descriptions(descriptions, 20) if descriptions else "Нет описаний транзакций для анализа.",
+            additional_cash_info_str=self.build_cash_additional_info(
+                evidence["kassa_comis_total"], evidence.get("cash_operations_count", 0)
+            ),
+        ).strip()
+
+    def build_packed_context(self, client_blocks, groups) -> str:
+        group_questions = "\n".join(
+            f"- {group}: {self.config['combined_group_questions'][group].strip()}" for group in groups
+        )
+        return self.config["packed_context"].format(clients="\n\n".join(client_blocks), group_questions=group_questions)
+
+    def request_packed_tags(self, groups, pack) -> dict:
+        """
+        Один запрос на пакет клиентов [(cli_id, блок промпта)] с одинаковым набором групп.
+        Возвращает {cli_id: {группа: ответ модели группы}} для клиентов с валидной записью в ответе.
+        """
+        packed_model = build_packed_model(build_combined_model(groups))
+        CURRENT_CLIENT.set(tuple(cli_id for cli_id, _ in pack)) # токены запроса делятся между клиентами пакета
+        structured_response = self.get_llm_structured_output_with_pydantic(
+            tags_context=self.build_packed_context([block for _, block in pack], groups),
+            pydantic_model=packed_model
+        )
+        if structured_response is None:
+            return {}
+        matched = match_packed_items(structured_response, [cli_id for cli_id, _ in pack])
+        return {cli_id: {group: getattr(item, group) for group in groups} for cli_id, item in matched.items()}
+
+    def plan_packs(self, groups, clients) -> list:
+        """
+        Пакеты клиентов [(cli_id, блок)] для набора групп: сколько клиентов в запросе — по бюджетам
+        llm_packing (входные токены с учетом промптов и схемы, ожидаемый ответ, предел клиентов).
+        """
+        packing_config = self.packing_config()
+        packed_model = build_packed_model(build_combined_model(groups))
+        overhead_tokens = count_request_tokens(self.build_chat_request(self.build_packed_context([], groups), packed_model))
+        return pack_by_token_budget(
+            [((cli_id, block), self.count_tokens(block) + 2) for cli_id, block in clients],
+            overhead_tokens,
+            max_prompt_tokens=packing_config.get("max_prompt_tokens", 12000),
+            max_items=packing_config.get("max_clients_per_request", 20),
+            completion_tokens_per_item=packing_config.get("completion_tokens_per_client", 80),
+            max_completion_tokens=packing_config.get("max_completion_tokens", 4000),
+        )
+
+    def packed_llm_responses(self, client_rows, ops_index) -> list:
+        """
+        Ответы LLM-групп для клиентов через упакованные запросы: клиенты с одинаковым набором групп
+        (после предклассификатора) раскладываются по пакетам, пакеты выполняются параллельно.
+        Клиенты, которых нет в ответе или чья запись невалидна, упаковываются заново (до llm_packing.max_attempts
+        попыток всего); оставшиеся получают None — для них выполняются обычные запросы по клиенту.
+        Клиенты с повторяющимся CLI_ID не упаковываются (ответ нельзя сопоставить со строкой) и тоже получают None.
+        """
+        responses = [None] * len(client_rows)
+        cli_id_counts = Counter(client_row['CLI_ID'] for client_row in client_rows)
+        duplicated = sum(count for count in cli_id_counts.values() if count > 1)
+        if duplicated:
+            logger.warning(f"Клиентов с повторяющимся CLI_ID: {duplicated}, для них выполняются запросы по клиенту")
+        pending = {} # набор групп -> [(номер клиента, cli_id, блок)]
+        for i, client_row in enumerate(client_rows):
             company_data = client_row.to_dict()
+            cli_id = company_data['CLI_ID']
+            if cli_id_counts[cli_id] > 1:
+                continue
+            evidence = self.client_evidence(company_data, ops_index)
+            contexts, resolved = self.split_llm_groups(evidence)
+            responses[i] = resolved
+            if contexts:
+                groups = tuple(group for group in self.enabled_llm_tag_groups() if group in contexts)
+                pending.setdefault(groups, []).append((i, cli_id, self.packed_client_block(cli_id, evidence)))
 
-            # 2. Транзакции для этого клиента
-            client_transactions_df = df_all_ops[df_all_ops['CLI_ID'] == cli_id]
-            transaction_descriptions = client_transactions_df['ENTRY_DESCR'].dropna().astype(str).tolist()
-            
-            kassa_comis_total_client = company_data.get('KASSA_COMIS', 0)
-            if pd.isna(kassa_comis_total_client): kassa_comis_total_client = 0
+        max_attempts = max(1, int(self.packing_config().get("max_attempts", 2)))
+        packed_clients = requests = requeued = 0
+        for attempt in range(max_attempts):
+            jobs = [
+                (groups, pack, {cli_id: i for i, cli_id, _ in clients})
+                for groups, clients in pending.items()
+                for pack in self.plan_packs(groups, [(cli_id, block) for _, cli_id, block in clients])
+            ]
+            if not jobs:
+                break
+            requests += len(jobs)
+            with ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="llm") as llm_pool:
+                results = list(llm_pool.map(lambda job: self.request_packed_tags(job[0], job[1]), jobs))
+            retry = {}
+            for (groups, pack, positions), matched in zip(jobs, results):
+                for cli_id, block in pack:
+                    if cli_id in matched:
+                        responses[positions[cli_id]].update(matched[cli_id])
+                        packed_clients += 1
+                    else:
+                        retry.setdefault(groups, []).append((positions[cli_id], cli_id, block))
+            pending = retry
+            missing = sum(len(clients) for clients in pending.values())
+            if missing and attempt + 1 < max_attempts:
+                requeued += missing
+                self.metrics.increment("llm_packed_clients_total", {"outcome": "requeued"}, missing)
+                logger.info(f"Клиентов без валидной записи в упакованном ответе: {missing}, отправляем повторно")
 
-            # 3. Контракты для этого клиента (для уточнения debt_load)
-            client_contracts_df_filtered = df_contracts[df_contracts['CLI_ID'] == cli_id]
+        fallback = [i for clients in pending.values() for i, _, _ in clients]
+        for i in fallback:
+            responses[i] = None
+        self.metrics.increment("llm_packed_requests_total", value=requests)
+        self.metrics.increment("llm_packed_clients_total", {"outcome": "ok"}, packed_clients)
+        if fallback:
+            self.metrics.increment("llm_packed_clients_total", {"outcome": "fallback"}, len(fallback))
+        if requests:
+            logger.info(
+                f"Упакованные запросы: {requests}, клиентов с ответом {packed_clients} "
+                f"(в среднем {packed_clients / requests:.1f} на запрос), повторно упаковано {requeued}, "
+                f"без ответа (запросы по клиенту): {len(fallback)}"
+            )
+        return responses
 
-            # Извлечение тегов
-            client_tags.update(self.get_company_size_tags(company_data.get("STAFF_GROUP")))
-            client_tags.update(self.get_company_age_tags(company_data.get("DT_BANK_OPEN")))
-            
-            client_tags.update(self.get_payment_type_tags_llm(transaction_descriptions))
-            client_tags.update(self.get_cash_operations_tags_llm(transaction_descriptions, kassa_comis_total_client))
-            
-            client_tags.update(self.get_geo_tags(company_data.get("CITY")))
-            client_tags.update(self.get_ved_tags(company_data.get("IS_VED"), transaction_descriptions))
-            
-            client_tags.update(self.get_acquiring_tags(company_data.get("IS_ACQ")))
-            # Передаем отфильтрованные контракты клиента
-            client_tags.update(self.get_debt_load_tags(company_data.get("IS_CREDIT"), client_contracts_df_filtered))
-            client_tags.update(self.get_salary_project_tag(company_data.get("IS_SAL")))
-            
-            client_tags.update(self.get_loyalty_tags(company_data.get("DT_BANK_OPEN")))
+    def log_usage_summary(self):
+        """
+        Итог по токенам за прогон и, если задан token_budget.usage_report_path, отчет по клиентам;
+        итог планировщика и запросы без ответа (llm_scheduler.dropped_report_path).
+        """
+        self.usage.log_summary()
+        self.scheduler.log_summary((self.config.get("llm_scheduler") or {}).get("dropped_report_path"))
+        report_path = (self.config.get("token_budget") or {}).get("usage_report_path")
+        if report_path:
+            self.usage.write_client_report(report_path)
 
-            results.append({
-                "CLI_ID": cli_id,
-                "CLN_NAME": company_data.get('CLN_NAME', 'N/A'),
-                "TAGS": list(client_tags)
-            })
-            
-            logger.info(f"Извлеченные теги для {cli_id}: {list(client_tags)}")
+    def start_metrics_snapshots(self):
+        """Запускает периодическую запись метрик, если задан metrics.snapshot_every_seconds."""
+        metrics_config = self.config.get("metrics") or {}
+        every_seconds = metrics_config.get("snapshot_every_seconds")
+        if metrics_config.get("enabled", True) and every_seconds:
+            self.metrics.start_snapshots(metrics_config.get("path", "metrics/run_metrics"), every_seconds)
+
+    def export_metrics(self):
+        """Пишет метрики прогона в metrics.path (.json и .prom) и выводит задержки LLM в лог."""
+        metrics_config = self.config.get("metrics") or {}
+        if not metrics_config.get("enabled", True):
+            return
+        path_prefix = metrics_config.get("path", "metrics/run_metrics")
+        try:
+            self.metrics.write(path_prefix)
+        except OSError as e:
+            logger.error(f"Не удалось записать метрики в '{path_prefix}': {e}")
+            return
+        histograms = self.metrics.snapshot()["histograms"]
+        llm_latency = {name: summary for name, summary in histograms.items() if name.startswith("llm_request_seconds")}
+        if llm_latency:
+            logger.info(f"Задержки запросов LLM (сек): {llm_latency}")
+        logger.info(f"Метрики прогона записаны в {path_prefix}.json и {path_prefix}.prom")
+
+    def log_llm_cache_stats(self):
+        if self.llm_cache is not None:
+            logger.info(f"Статистика кэша LLM: {self.llm_cache.stats()}")
+
+    def run_llm_taggers(self, llm_taggers):
+        """
+        Выполняет LLM-теггеры клиента (список пар (функция, аргументы)).
+        Если открыт пул, запросы по тегам идут параллельно. Порядок результатов совпадает с порядком теггеров.
+        """
+        if self._llm_pool is None:
+            return [tagger(*args) for tagger, args in llm_taggers]
+        # Контекст (текущий клиент) переносится в потоки пула
+        futures = [self._llm_pool.submit(contextvars.copy_context().run, tagger, *args) for tagger, args in llm_taggers]
+        return [future.result() for future in futures]
+
+    def row_rule_tags(self, company_data, client_contracts_df):
+        """Теги по правилам для одной строки продуктов (построчный вариант build_rule_tag_matrix)."""
+        client_tags = []
+        client_tags.extend(self.get_company_size_tags(company_data.get("STAFF_GROUP")))
+        client_tags.extend(self.get_company_age_tags(company_data.get("DT_BANK_OPEN")))
+        client_tags.extend(self.get_geo_tags(company_data.get("CITY")))
+        client_tags.extend(self.get_acquiring_tags(company_data.get("IS_ACQ")))
+        # Передаем отфильтрованные контракты клиента
+        client_tags.extend(self.get_debt_load_tags(company_data.get("IS_CREDIT"), client_contracts_df))
+        client_tags.extend(self.get_salary_project_tag(company_data.get("IS_SAL")))
+        client_tags.extend(self.get_loyalty_tags(company_data.get("DT_BANK_OPEN")))
+        return client_tags
+
+    def rule_tags_for_products(self, df_products, contracts_index) -> list:
+        """
+        Теги по правилам для всей таблицы продуктов сразу (векторно),
+        списками в порядке строк df_products.
+        """
+        df_contracts = contracts_index.df if isinstance(contracts_index, ClientIndex) else contracts_index.to_frame()
+        return rule_tag_lists(build_rule_tag_matrix(df_products, df_contracts))
+
+    def tag_client(self, client_row, ops_index, contracts_index, llm_responses=None, rule_tags=None):
+        """
+        Извлекает теги для одного клиента из строки таблицы продуктов.
+        llm_responses — готовые ответы LLM по группам (режим батча); без них запросы выполняются онлайн.
+        rule_tags — заранее посчитанные теги по правилам (rule_tags_for_products); без них считаются построчно.
+        """
+        started_at = time.perf_counter()
+        cli_id = client_row['CLI_ID']
+        CURRENT_CLIENT.set(cli_id) # для учета токенов по клиентам
+        logger.info(f"\n--- Обработка клиента CLI_ID: {cli_id} ({client_row.get('CLN_NAME', 'N/A')}) ---")
+
+        client_tags = set()
+
+        # 1. Данные из таблицы "Продукты" (company_data)
+        company_data = client_row.to_dict()
+
+        # 2. Транзакции и кассовые показатели этого клиента
+        evidence = self.client_evidence(company_data, ops_index)
+
+        # 3. Теги по правилам (контракты клиента нужны для уточнения debt_load)
+        if rule_tags is None:
+            rule_tags = self.row_rule_tags(company_data, contracts_index.rows(cli_id))
+        client_tags.update(rule_tags)
+
+        llm_tags, incomplete_groups = self.get_llm_tags(evidence, llm_responses)
+        client_tags.update(llm_tags)
+
+        logger.info(f"Извлеченные теги для {cli_id}: {list(client_tags)}")
+        self.metrics.observe("client_seconds", time.perf_counter() - started_at)
+        self.metrics.increment("clients_processed_total")
+
+        result = {
+            "CLI_ID": cli_id,
+            "CLN_NAME": company_data.get('CLN_NAME', 'N/A'),
+            "TAGS": list(client_tags)
+        }
+        if incomplete_groups:
+            logger.warning(f"Клиент {cli_id}: нет ответа LLM для групп {incomplete_groups}, теги этих групп — по умолчанию")
+            self.metrics.increment("clients_incomplete_total")
+            result[INCOMPLETE_GROUPS_KEY] = incomplete_groups
+        return result
+
+    # --- Оценка прогона до запуска ---
+    def estimate_llm_usage(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file) -> Optional[dict]:
+        """
+        Оценка прогона без запросов к LLM: сколько запросов понадобится (с учетом предклассификации
+        и кэша LLM), сколько входных токенов они займут и ожидаемые выходные токены
+        (token_budget.expected_completion_tokens на запрос). При заданных llm_quota.tpm/rpm —
+        минимальное время прогона в минутах.
+        """
+        client_data = self.load_client_data(products_file, outgoing_ops_file, incoming_ops_file, contracts_file)
+        if client_data is None:
+            return None
+        df_products, ops_index, _ = client_data
+
+        by_group = {}
+        cached_requests = 0
+        for _, client_row in df_products.iterrows():
+            evidence = self.client_evidence(client_row.to_dict(), ops_index)
+            for request_group, context, pydantic_model in self.plan_llm_requests(evidence):
+                request = self.build_chat_request(context, pydantic_model)
+                if self.llm_cache is not None and self.llm_cache.contains(self.chat_request_cache_key(request)):
+                    cached_requests += 1
+                    continue
+                group_estimate = by_group.setdefault(request_group, {"requests": 0, "prompt_tokens": 0})
+                group_estimate["requests"] += 1
+                group_estimate["prompt_tokens"] += count_request_tokens(request)
+
+        token_budget = self.config.get("token_budget") or {}
+        quota = self.config.get("llm_quota") or {}
+        requests = sum(group_estimate["requests"] for group_estimate in by_group.values())
+        prompt_tokens = sum(group_estimate["prompt_tokens"] for group_estimate in by_group.values())
+        completion_tokens = requests * token_budget.get("expected_completion_tokens", 0)
+        estimate = {
+            "clients": len(df_products),
+            "requests": requests,
+            "cached_requests": cached_requests,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens_expected": completion_tokens,
+            "prompt_tokens_per_client": round(prompt_tokens / len(df_products), 1) if len(df_products) else 0.0,
+            "by_group": by_group,
+        }
+        if quota.get("tpm"):
+            estimate["minutes_at_tpm"] = round((prompt_tokens + completion_tokens) / quota["tpm"], 1)
+        if quota.get("rpm"):
+            estimate["minutes_at_rpm"] = round(requests / quota["rpm"], 1)
+        logger.info(f"Оценка прогона: {estimate}")
+        self.log_preclassifier_stats()
+        return estimate
+
+    # --- Режим батча (OpenAI Batch API) ---
+    def plan_llm_requests(self, evidence, contexts=None) -> list:
+        """
+        Запросы к LLM, которые нужны клиенту: [(группа_запроса, контекст, модель)].
+        Составной запрос получает группу 'combined', как и в онлайн-режиме с llm_combined_call.
+        contexts — уже посчитанные контексты групп для LLM (split_llm_groups).
+        """
+        if contexts is None:
+            contexts, _ = self.split_llm_groups(evidence)
+        if self.config.get("llm_combined_call", False) and len(contexts) > 1:
+            groups = list(contexts)
+            return [(COMBINED_REQUEST_GROUP, self.build_combined_context(evidence, groups), build_combined_model(tuple(groups)))]
+        return [(group, context, LLM_TAG_GROUPS[group]) for group, context in contexts.items()]
+
+    def batch_writer(self, output_dir, prefix="batch_requests"):
+        batch_config = self.config.get("llm_batch", {})
+        return BatchRequestWriter(
+            output_dir,
+            prefix=prefix,
+            max_requests_per_file=batch_config.get("max_requests_per_file", 50000),
+            max_file_bytes=int(batch_config.get("max_file_mb", 190) * 1024 * 1024)
+        )
+
+    def prepare_llm_batch(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file, output_dir):
+        """
+        Фаза 1: записывает запросы всех клиентов в JSONL-файлы Batch API с custom_id 'CLI_ID:группа'.
+        Запросы, ответ на которые уже есть в кэше LLM, не записываются.
+        Возвращает список созданных файлов.
+        """
+        client_data = self.load_client_data(products_file, outgoing_ops_file, incoming_ops_file, contracts_file)
+        if client_data is None:
+            return []
+        df_products, ops_index, _ = client_data
+
+        skipped_cached = 0
+        with self.batch_writer(output_dir) as writer:
+            for _, client_row in df_products.iterrows():
+                evidence = self.client_evidence(client_row.to_dict(), ops_index)
+                for request_group, context, pydantic_model in self.plan_llm_requests(evidence):
+                    request = self.build_chat_request(context, pydantic_model)
+                    if self.llm_cache is not None and self.llm_cache.contains(self.chat_request_cache_key(request)):
+                        skipped_cached += 1
+                        continue
+                    writer.add(make_custom_id(client_row['CLI_ID'], request_group), request)
+
+        logger.info(
+            f"Подготовлено запросов батча: {writer.total_requests} в {len(writer.paths)} файлах "
+            f"(пропущено из кэша: {skipped_cached})"
+        )
+        self.log_preclassifier_stats()
+        self.export_metrics()
+        return writer.paths
+
+    def resolve_batch_response(self, custom_id, context, pydantic_model, batch_results):
+        """Ответ на запрос батча: из файла результатов, иначе из кэша LLM. None, если ответа нет."""
+        request = self.build_chat_request(context, pydantic_model)
+        cache_key = self.chat_request_cache_key(request) if self.llm_cache is not None else None
+
+        result = batch_results.get(custom_id)
+        if result and "arguments" in result and result["name"] == pydantic_model.__name__:
+            structured_output = self.parse_tool_arguments(result["arguments"], pydantic_model)
+            if structured_output is not None:
+                if cache_key is not None:
+                    self.llm_cache.set(cache_key, result["arguments"])
+                return structured_output
+
+        if cache_key is not None:
+            cached_arguments = self.llm_cache.get(cache_key)
+            if cached_arguments is not None:
+                return self.parse_tool_arguments(cached_arguments, pydantic_model)
+        return None
+
+    def batch_llm_responses(self, cli_id, evidence, batch_results):
+        """
+        Ответы по группам для клиента из результатов батча.
+        Возвращает (ответы {группа: модель}, группы без валидного ответа).
+        """
+        contexts, responses = self.split_llm_groups(evidence)
+
+        for request_group, context, pydantic_model in self.plan_llm_requests(evidence, contexts):
+            if request_group != COMBINED_REQUEST_GROUP:
+                continue
+            combined = self.resolve_batch_response(
+                make_custom_id(cli_id, request_group), context, pydantic_model, batch_results
+            )
+            if combined is not None:
+                responses.update({group: getattr(combined, group) for group in contexts})
+
+        # Группы без составного ответа ищем среди отдельных запросов (в т.ч. из повторного батча)
+        missing_groups = []
+        for group, context in contexts.items():
+            if group in responses:
+                continue
+            structured_output = self.resolve_batch_response(
+                make_custom_id(cli_id, group), context, LLM_TAG_GROUPS[group], batch_results
+            )
+            if structured_output is None:
+                missing_groups.append(group)
+            else:
+                responses[group] = structured_output
+        return responses, missing_groups
+
+    def ingest_llm_batch(self, products_file, outgoing_ops_file, incoming_ops_file, contracts_file, result_paths, retry_dir=None):
+        """
+        Фаза 2: читает результаты батча и строит теги тем же разбором и маппингом, что и онлайн-режим.
+        Если задан retry_dir, для групп без валидного ответа записываются отдельные запросы повторного батча.
+        """
+        client_data = self.load_client_data(products_file, outgoing_ops_file, incoming_ops_file, contracts_file)
+        if client_data is None:
+            return None
+        df_products, ops_index, contracts_index = client_data
+        batch_results = read_batch_results(result_paths)
+
+        known_clients = set(df_products['CLI_ID'])
+        unknown_ids = [custom_id for custom_id in batch_results if split_custom_id(custom_id)[0] not in known_clients]
+        if unknown_ids:
+            logger.warning(f"В результатах батча {len(unknown_ids)} ответов для неизвестных клиентов, например: {unknown_ids[:5]}")
+
+        results = []
+        missing_total = 0
+        client_rule_tags = self.rule_tags_for_products(df_products, contracts_index)
+        retry_writer = self.batch_writer(retry_dir, prefix="batch_retry_requests") if retry_dir else None
+        try:
+            for (_, client_row), rule_tags in zip(df_products.iterrows(), client_rule_tags):
+                cli_id = client_row['CLI_ID']
+                evidence = self.client_evidence(client_row.to_dict(), ops_index)
+                responses, missing_groups = self.batch_llm_responses(cli_id, evidence, batch_results)
+                missing_total += len(missing_groups)
+                if retry_writer is not None and missing_groups:
+                    contexts = self.build_llm_contexts(evidence)
+                    for group in missing_groups:
+                        retry_writer.add(
+                            make_custom_id(cli_id, group),
+                            self.build_chat_request(contexts[group], LLM_TAG_GROUPS[group])
+                        )
+                results.append(self.tag_client(
+                    client_row, ops_index, contracts_index, llm_responses=responses, rule_tags=rule_tags
+                ))
+        finally:
+            if retry_writer is not None:
+                retry_writer.close()
 
-        return results
\ No newline at end of file
+        logger.info(f"Групп без валидного ответа в батче: {missing_total}")
+        if retry_writer is not None and retry_writer.paths:
+            logger.info(f"Запросы повторного батча: {retry_writer.paths}")
+        self.log_llm_cache_stats()
+        self.log_preclassifier_stats()
+        self.log_usage_summary()
+        self.export_metrics()
+        return results
@@ -1,6 +1,19 @@
 import pandas as pd
+import openai
 from openai import OpenAI
 import os
+import re
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import List
+from pydantic import BaseModel, Field
+from client_index import ClientIndex, normalize_cli_id
+from ingest import IngestCache
+from llm_packing import PACKED_ID_FIELD, build_packed_model, match_packed_items
+from llm_scheduler import LLMRequestDropped, RequestScheduler
+from sampler import representative_sample
+from token_usage import CURRENT_CLIENT, UsageTracker, count_request_tokens, count_tokens
 
 # --- Конфигурация OpenAI ---
 try:
@@ -9,12 +22,26 @@ except Exception as e:
     print(f"Не удалось инициализировать OpenAI client: {e}")
     exit()
 
+# Расход токенов за прогон (по клиентам)
+usage_tracker = UsageTracker()
+# Повторы при 429/таймаутах и подстройка под лимиты из заголовков ответа (квоты в этом скрипте не задаются)
+scheduler = RequestScheduler(max_concurrency=1)
+# Выходных токенов на один предложенный тег (имя, значение, основание) — из него считается max_tokens
+TOKENS_PER_SUGGESTION = 90
+# Теги, которые уже извлекаются FetchTags: новые предложения не должны их повторять
+EXISTING_TAGS_INFO = """
+    - Основные типы платежей: payments_to_suppliers (true/false), payments_salary_related (true/false), payments_tax (true/false).
+    - Операции с наличными: cash_activity_level ('high' или 'low').
+    - Признаки ВЭД: has_ved_signs (true/false).
+    """
+
 # --- Функция запроса к LLM (остается такой же, как в предыдущем ответе) ---
 def suggest_additional_single_tags_from_transactions(
     sample_transaction_descriptions,
     existing_pydantic_tags_description,
     client_name_for_context="Не указан",
-    model="gpt-4.1-2025-04-14"
+    model="gpt-4.1-2025-04-14",
+    max_suggestions=10
 ):
     if not sample_transaction_descriptions:
         return "Не предоставлены примеры описаний транзакций для анализа."
@@ -24,7 +51,8 @@ def suggest_additional_single_tags_from_transactions(
     С помощью LLM я уже извлекаю информацию о следующих аспектах (на основе Pydantic моделей):
     {existing_pydantic_tags_description}
 
-    Вот примеры **последних исходящих транзакций (поле ENTRY_DESCR)** для этой компании:
+    Вот примеры **последних исходящих транзакций (поле ENTRY_DESCR)** для этой компании
+    (номера, даты и суммы заменены метками, повторяющиеся операции свернуты, «(×N)» — число повторов):
     ---
     {descriptions_text}
     ---
@@ -47,27 +75,35 @@ def suggest_additional_single_tags_from_transactions(
     Значение: [пояснение значения тега]
     Основание (ключевые слова/паттерны из транзакций): [примеры]
 
-    Важно: Предлагай именно **одиночные теги**, а не новые сложные категории.
+    Важно: Предлагай именно **одиночные теги**, а не новые сложные категории, не более {max_suggestions}.
     Цель - найти специфичные маркеры поведения или расходов.
     """
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "Ты - опытный бизнес-аналитик, специализирующийся на выявлении специфических поведенческих тегов из текстовых описаний финансовых операций МСБ."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.5,
+        # Ответу нужно не больше max_suggestions тегов, а не фиксированные 2000 токенов
+        "max_tokens": TOKENS_PER_SUGGESTION * max_suggestions + 100,
+    }
+    estimated_prompt_tokens = count_request_tokens(request)
+    print(f"Промпт: ~{estimated_prompt_tokens} токенов, лимит ответа: {request['max_tokens']}")
     try:
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "Ты - опытный бизнес-аналитик, специализирующийся на выявлении специфических поведенческих тегов из текстовых описаний финансовых операций МСБ."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5,
-            max_tokens=2000
-        )
+        completion = scheduler.create(client, request, estimated_prompt_tokens + request["max_tokens"], group="new_tags")
+        usage_tracker.record("new_tags", getattr(completion, "usage", None), estimated_prompt_tokens)
         return completion.choices[0].message.content.strip()
+    except LLMRequestDropped as e:
+        print(f"Запрос для клиента '{client_name_for_context}' не выполнен: {e}")
+        return None
     except Exception as e:
         print(f"Ошибка при обращении к OpenAI для клиента '{client_name_for_context}': {e}")
         return None
 
-# --- Функция для чтения уже обработанных клиентов ---
+# --- Чтение обработанных клиентов из отчета прошлых версий (для переноса в журнал) ---
 def get_processed_clients(processed_file_path):
-    """Читает файл и возвращает множество CLI_ID или имен уже обработанных клиентов."""
+    """Читает отчет mb_new_tags.md и возвращает множество CLI_ID или имен уже обработанных клиентов."""
     processed_identifiers = set()
     if not os.path.exists(processed_file_path):
         return processed_identifiers
@@ -81,7 +117,6 @@ def get_processed_clients(processed_file_path):
             # Если мы ищем по CLN_NAME, нужно быть осторожным с совпадениями.
             # Пока будем предполагать, что если имя клиента есть в файле, он обработан.
             # Для примера, будем извлекать то, что похоже на "Клиент: ИМЯ (CLI_ID: ID)"
-            import re
             matches_name = re.findall(r"Анализируем клиента: (.*?) \(CLI_ID:", content)
             matches_id = re.findall(r"\(CLI_ID: ([\d\w\s,-]+)\)", content) # Более общий паттерн для ID
             
@@ -94,26 +129,109 @@ def get_processed_clients(processed_file_path):
         print(f"Ошибка при чтении файла обработанных клиентов '{processed_file_path}': {e}")
     return processed_identifiers
 
-# --- Основная функция для обработки данных из Excel ---
-def analyze_clients_for_additional_single_tags(
-    products_file, 
-    outgoing_ops_file, 
-    processed_tags_file, # Путь к файлу mb_new_tags.md
-    num_clients_to_process=None, 
-    num_transactions_per_client=30
-    ):
+# --- Журнал обработанных клиентов ---
+class ProcessedLedger:
+    """
+    Журнал клиентов, уже рассмотренных поиском новых тегов: JSONL, по строке на клиента, только дописывается.
+    Проверка «клиент обработан» — по множеству CLI_ID и имен в памяти, без повторного чтения отчета.
+    Если журнала еще нет, а отчет прошлых версий есть, обработанные клиенты один раз переносятся из отчета.
+    """
+
+    def __init__(self, path, legacy_report_path=None):
+        self.path = path
+        self.records = 0
+        self._keys = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # недописанная строка после прерванного прогона
+                    self.records += 1
+                    self._remember(record.get('cli_id'), record.get('cln_name'))
+        elif legacy_report_path and os.path.exists(legacy_report_path):
+            identifiers = get_processed_clients(legacy_report_path)
+            for identifier in sorted(identifiers):
+                self.add(identifier, None, "legacy_report")
+            print(f"В журнал {path} перенесено идентификаторов из {legacy_report_path}: {len(identifiers)}")
+
+    def _remember(self, cli_id, cln_name):
+        for key in (cli_id, cln_name):
+            if key:
+                self._keys.add(str(key))
+
+    def __contains__(self, key):
+        return str(key) in self._keys
+
+    def keys(self) -> set:
+        return self._keys
+
+    def add(self, cli_id, cln_name, status, **fields):
+        """
+        Отмечает клиента обработанным; строка пишется сразу, чтобы прерванный прогон не повторял клиентов.
+        fields — дополнительные поля записи (например, предложенные теги).
+        """
+        record = {"cli_id": cli_id, "cln_name": cln_name, "status": status, "processed_at": round(time.time(), 3), **fields}
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self.records += 1
+        self._remember(cli_id, cln_name)
+
+    def read_records(self):
+        """Записи журнала по порядку (недописанные строки пропускаются)."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def default_ledger_path(processed_tags_file) -> str:
+    """Путь журнала рядом с отчетом: mb_new_tags.md -> mb_new_tags.processed.jsonl."""
+    return os.path.splitext(processed_tags_file)[0] + ".processed.jsonl"
+
+
+# --- Последние операции клиентов ---
+def recent_transactions_index(df_outgoing_ops, window) -> ClientIndex:
+    """
+    Последние window непустых описаний операций каждого клиента (свежие первыми) для всего портфеля:
+    одна общая сортировка по (CLI_ID, дата убыв.) и один проход groupby().head(window).
+    Операции без даты идут после датированных в исходном порядке.
+    """
+    ops = df_outgoing_ops[df_outgoing_ops['ENTRY_DESCR'].notna()]
+    if 'DT_ENTRY_Parsed' in ops.columns and ops['DT_ENTRY_Parsed'].notna().any():
+        ops = ops.sort_values(
+            ['CLI_ID', 'DT_ENTRY_Parsed'], ascending=[True, False], kind='stable', na_position='last'
+        )
+    else:
+        print("Предупреждение: Не удалось отсортировать транзакции по дате. Используется исходный порядок.")
+    recent = ops.groupby('CLI_ID', sort=False).head(window)[['CLI_ID', 'ENTRY_DESCR']]
+    return ClientIndex(recent)
+
+
+# --- Подготовка данных ---
+def load_exploration_data(products_file, outgoing_ops_file, ingest_cache=None, recent_transactions_window=300):
+    """
+    Клиенты портфеля (по убыванию числа исходящих операций, с колонкой transaction_count) и индекс
+    окон их последних операций. None, если файлы не прочитаны.
+    """
+    ingest_cache = ingest_cache or IngestCache()
     try:
-        df_products = pd.read_excel(products_file)
-        df_outgoing_ops = pd.read_excel(outgoing_ops_file)
+        df_products = ingest_cache.read(products_file, "products")
+        df_outgoing_ops = ingest_cache.read(outgoing_ops_file, "operations")
     except FileNotFoundError as e:
         print(f"Ошибка: Файл не найден. {e}")
-        return
+        return None
     except Exception as e:
         print(f"Ошибка при чтении Excel файла: {e}")
-        return
+        return None
 
-    df_products['CLI_ID'] = df_products['CLI_ID'].astype(str).str.replace(r'\.00$', '', regex=True)
-    df_outgoing_ops['CLI_ID'] = df_outgoing_ops['CLI_ID'].astype(str).str.replace(r'\.00$', '', regex=True)
+    df_products['CLI_ID'] = normalize_cli_id(df_products['CLI_ID'])
+    df_outgoing_ops['CLI_ID'] = normalize_cli_id(df_outgoing_ops['CLI_ID'])
 
     try:
         df_outgoing_ops['DT_ENTRY_Parsed'] = pd.to_datetime(df_outgoing_ops['DT_ENTRY'], dayfirst=True, errors='coerce')
@@ -126,6 +244,9 @@ def analyze_clients_for_additional_single_tags(
 
     # 1. Подсчет количества транзакций для каждого клиента
     client_transaction_counts = df_outgoing_ops.groupby('CLI_ID').size().rename('transaction_count')
+
+    # Окна последних операций всех клиентов — заранее, вместо фильтрации и сортировки на каждого клиента
+    recent_index = recent_transactions_index(df_outgoing_ops, recent_transactions_window)
     
     # Объединяем с df_products, чтобы получить имена и отсортировать
     df_products_with_counts = df_products.merge(client_transaction_counts, on='CLI_ID', how='left')
@@ -133,72 +254,99 @@ def analyze_clients_for_additional_single_tags(
     
     # Сортируем клиентов: сначала те, у кого больше транзакций
     sorted_clients_df = df_products_with_counts.sort_values(by='transaction_count', ascending=False)
+    return sorted_clients_df, recent_index
 
-    # 2. Получаем список уже обработанных клиентов
-    processed_identifiers = get_processed_clients(processed_tags_file)
-    print(f"Найдены следующие уже обработанные идентификаторы: {processed_identifiers if processed_identifiers else 'Нет'}")
 
+def unprocessed_clients(sorted_clients_df, ledger, limit=None) -> pd.DataFrame:
+    """Клиенты, которых нет в журнале (по CLI_ID или имени); limit — сколько новых взять."""
+    processed_keys = ledger.keys()
+    already_processed = sorted_clients_df['CLI_ID'].isin(processed_keys)
+    if 'CLN_NAME' in sorted_clients_df.columns:
+        already_processed |= sorted_clients_df['CLN_NAME'].astype(str).isin(processed_keys)
+    if already_processed.any():
+        print(f"Пропускаем уже обработанных клиентов: {int(already_processed.sum())}")
+    clients_df = sorted_clients_df[~already_processed]
+    return clients_df.head(limit) if limit is not None else clients_df
 
-    existing_pydantic_tags_info = """
-    - Основные типы платежей: payments_to_suppliers (true/false), payments_salary_related (true/false), payments_tax (true/false).
-    - Операции с наличными: cash_activity_level ('high' или 'low').
-    - Признаки ВЭД: has_ved_signs (true/false).
+
+# --- Основная функция для обработки данных из Excel ---
+def analyze_clients_for_additional_single_tags(
+    products_file, 
+    outgoing_ops_file, 
+    processed_tags_file, # Путь к файлу mb_new_tags.md
+    num_clients_to_process=None, 
+    num_transactions_per_client=30,
+    ingest_cache=None,
+    sample_max_tokens=600,
+    recent_transactions_window=300,
+    processed_ledger_file=None
+    ):
     """
-    
-    clients_to_iterate_df = sorted_clients_df
-    if num_clients_to_process is not None:
-        clients_to_iterate_df = sorted_clients_df.head(num_clients_to_process)
-
-    processed_count_in_session = 0
-    for index, client_row in clients_to_iterate_df.iterrows():
-        cli_id = client_row['CLI_ID']
-        cln_name = client_row.get('CLN_NAME', f"Клиент ID {cli_id}")
-        
-        # Проверяем, обработан ли клиент (по ID или по имени)
-        if cli_id in processed_identifiers or cln_name in processed_identifiers:
-            print(f"Клиент {cln_name} (CLI_ID: {cli_id}) уже обработан. Пропускаем.")
-            continue
-        
-        print(f"\n\n{'='*25}\nАнализируем клиента: {cln_name} (CLI_ID: {cli_id}), транзакций: {client_row['transaction_count']}\n{'='*25}")
+    Ищет кандидатов в новые одиночные теги по последним исходящим операциям клиентов.
+    Ответы LLM дописываются в отчет processed_tags_file, рассмотренные клиенты — в журнал
+    processed_ledger_file (по умолчанию рядом с отчетом); клиенты из журнала пропускаются.
+    Клиенты, по которым LLM не ответила, в журнал не пишутся и повторяются следующим прогоном.
+    Выборка шаблонов для промпта строится из recent_transactions_window последних операций клиента.
+    """
+    exploration_data = load_exploration_data(products_file, outgoing_ops_file, ingest_cache, recent_transactions_window)
+    if exploration_data is None:
+        return
+    sorted_clients_df, recent_index = exploration_data
+
+    # 2. Журнал уже обработанных клиентов
+    ledger = ProcessedLedger(
+        processed_ledger_file or default_ledger_path(processed_tags_file), legacy_report_path=processed_tags_file
+    )
+    print(f"Уже обработано клиентов (по журналу {ledger.path}): {ledger.records}")
 
-        client_ops_df = df_outgoing_ops[df_outgoing_ops['CLI_ID'] == cli_id]
 
-        if client_ops_df.empty:
+    # Обработанные клиенты отсеиваются до отбора num_clients_to_process, чтобы взять именно новых
+    clients_to_iterate_df = unprocessed_clients(sorted_clients_df, ledger, num_clients_to_process)
+
+    for client_row in clients_to_iterate_df.itertuples(index=False):
+        cli_id = client_row.CLI_ID
+        cln_name = getattr(client_row, 'CLN_NAME', f"Клиент ID {cli_id}")
+        
+        print(f"\n\n{'='*25}\nАнализируем клиента: {cln_name} (CLI_ID: {cli_id}), транзакций: {client_row.transaction_count}\n{'='*25}")
+
+        if client_row.transaction_count == 0:
             print("Исходящие транзакции для этого клиента не найдены.")
             # Записываем в файл, что клиент был рассмотрен, но без транзакций (чтобы не проверять снова)
             with open(processed_tags_file, 'a', encoding='utf-8') as f:
                 f.write(f"\n\n{'='*25}\nАнализируем клиента: {cln_name} (CLI_ID: {cli_id})\n{'='*25}\n")
                 f.write("Исходящие транзакции для этого клиента не найдены.\n")
+            ledger.add(cli_id, cln_name, "no_transactions")
             continue
-            
-        if 'DT_ENTRY_Parsed' in client_ops_df.columns and client_ops_df['DT_ENTRY_Parsed'].notna().any():
-            sorted_ops = client_ops_df.sort_values(by='DT_ENTRY_Parsed', ascending=False)
-        else:
-            print("Предупреждение: Не удалось отсортировать транзакции по дате. Используется исходный порядок.")
-            sorted_ops = client_ops_df 
 
-        last_n_ops = sorted_ops.head(num_transactions_per_client)
-        transaction_descriptions = last_n_ops['ENTRY_DESCR'].dropna().astype(str).tolist()
+        # Представительная выборка шаблонов операций (свежие операции первыми) вместо первых N строк
+        transaction_descriptions = representative_sample(
+            recent_index.descriptions(cli_id),
+            max_items=num_transactions_per_client,
+            max_tokens=sample_max_tokens,
+            token_counter=count_tokens
+        )
 
         if not transaction_descriptions:
             print("Описания транзакций для анализа не найдены.")
             with open(processed_tags_file, 'a', encoding='utf-8') as f:
                 f.write(f"\n\n{'='*25}\nАнализируем клиента: {cln_name} (CLI_ID: {cli_id})\n{'='*25}\n")
                 f.write("Описания транзакций для анализа не найдены.\n")
+            ledger.add(cli_id, cln_name, "no_descriptions")
             continue
             
-        print(f"Передаем {len(transaction_descriptions)} последних исходящих транзакций в LLM...")
+        print(f"Передаем {len(transaction_descriptions)} шаблонов исходящих транзакций в LLM...")
         
+        CURRENT_CLIENT.set(cli_id)
         suggestions = suggest_additional_single_tags_from_transactions(
             transaction_descriptions, 
-            existing_pydantic_tags_info,
+            EXISTING_TAGS_INFO,
             client_name_for_context=cln_name
         )
 
         # Записываем результат (или сообщение об ошибке) в файл mb_new_tags.md
         # Запись происходит сразу после получения ответа от LLM для данного клиента
         with open(processed_tags_file, 'a', encoding='utf-8') as f:
-            f.write(f"\n\n{'='*25}\nАнализируем клиента: {cln_name} (CLI_ID: {cli_id}), транзакций: {client_row['transaction_count']}\n{'='*25}\n")
+            f.write(f"\n\n{'='*25}\nАнализируем клиента: {cln_name} (CLI_ID: {cli_id}), транзакций: {client_row.transaction_count}\n{'='*25}\n")
             if suggestions:
                 f.write(f"\n--- Предложения по ДОПОЛНИТЕЛЬНЫМ ОДИНОЧНЫМ тегам для клиента {cln_name} ---\n")
                 f.write(suggestions)
@@ -210,14 +358,287 @@ def analyze_clients_for_additional_single_tags(
                 f.write("Не удалось получить предложения по дополнительным тегам от LLM для этого клиента.\n")
                 print("Не удалось получить предложения по дополнительным тегам от LLM для этого клиента.")
         
-        processed_count_in_session += 1
-        # Если num_clients_to_process был задан и мы обработали нужное количество *новых* клиентов
-        if num_clients_to_process is not None and processed_count_in_session >= num_clients_to_process:
-            print(f"\nОбработано {processed_count_in_session} новых клиентов, как было указано. Завершение.")
-            break
+        if suggestions:
+            ledger.add(cli_id, cln_name, "suggested")
+        # Клиент без ответа LLM в журнал не пишется — его возьмет следующий прогон
+
+    print(f"Расход токенов LLM: {usage_tracker.summary()}")
+
+
+
+# --- Пакетный поиск новых тегов: несколько клиентов в одном запросе, запросы параллельно ---
+class TagSuggestion(BaseModel):
+    tag: str = Field(description="Имя тега: коротко, snake_case, на английском (например, fuel_purchases)")
+    description: str = Field(description="Что означает тег, одним предложением")
+    evidence: str = Field(description="Какие операции клиента указывают на тег")
+
+class ClientTagSuggestions(BaseModel):
+    suggestions: List[TagSuggestion] = Field(description="Предложенные одиночные теги компании")
+
+# Ответ на пакет: по записи на компанию с ее CLI_ID (записи сопоставляются с клиентами по CLI_ID, не по порядку)
+BatchTagSuggestions = build_packed_model(ClientTagSuggestions)
+
+
+def build_batch_prompt(batch, existing_tags_info, max_suggestions) -> str:
+    """Промпт на пакет клиентов: у каждого CLI_ID, имя и выборка шаблонов операций."""
+    sections = []
+    for cli_id, cln_name, descriptions in batch:
+        lines = "\n".join(f"- {desc}" for desc in descriptions)
+        sections.append(f"### CLI_ID: {cli_id}\nКомпания: {cln_name}\n{lines}")
+    clients_text = "\n\n".join(sections)
+    return f"""
+    Я анализирую банковские транзакции компаний (МСБ) для их семантической сегментации.
+    С помощью LLM я уже извлекаю информацию о следующих аспектах:
+    {existing_tags_info}
+
+    Ниже — **последние исходящие транзакции (поле ENTRY_DESCR)** нескольких компаний
+    (номера, даты и суммы заменены метками, повторяющиеся операции свернуты, «(×N)» — число повторов).
+
+    {clients_text}
+
+    Для каждой компании предложи не более {max_suggestions} **одиночных тегов** — специфичных маркеров поведения
+    или расходов, которых нет среди уже извлекаемых аспектов. Одинаковые по смыслу теги разных компаний
+    называй одинаково. Ответ — вызов инструмента {BatchTagSuggestions.__name__}, по записи на каждую компанию
+    с ее CLI_ID без изменений в поле {PACKED_ID_FIELD}.
+    """
+
+
+def suggest_tags_for_client_batch(batch, existing_tags_info, request_scheduler, model="gpt-4.1-2025-04-14", max_suggestions=5):
+    """
+    Один структурированный запрос на пакет клиентов [(cli_id, cln_name, описания)].
+    Возвращает {cli_id: [TagSuggestion]} для клиентов с валидной записью в ответе; None, если ответ не получен.
+    """
+    tool_name = BatchTagSuggestions.__name__
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "Ты - опытный бизнес-аналитик, специализирующийся на выявлении специфических поведенческих тегов из текстовых описаний финансовых операций МСБ."},
+            {"role": "user", "content": build_batch_prompt(batch, existing_tags_info, max_suggestions)}
+        ],
+        "tools": [openai.pydantic_function_tool(BatchTagSuggestions, name=tool_name)],
+        "tool_choice": {"type": "function", "function": {"name": tool_name}},
+        "temperature": 0.5,
+        "max_tokens": (TOKENS_PER_SUGGESTION * max_suggestions + 20) * len(batch) + 50,
+    }
+    estimated_prompt_tokens = count_request_tokens(request)
+    try:
+        completion = request_scheduler.create(
+            client, request, estimated_prompt_tokens + request["max_tokens"], group="new_tags_batch"
+        )
+        usage_tracker.record(
+            "new_tags_batch", getattr(completion, "usage", None), estimated_prompt_tokens,
+            cli_id=tuple(cli_id for cli_id, _, _ in batch)
+        )
+        tool_calls = completion.choices[0].message.tool_calls
+        if not tool_calls or tool_calls[0].function.name != tool_name:
+            print(f"LLM не вызвала инструмент {tool_name} для пакета из {len(batch)} клиентов")
+            return None
+        parsed = BatchTagSuggestions(**json.loads(tool_calls[0].function.arguments))
+    except LLMRequestDropped as e:
+        print(f"Запрос для пакета из {len(batch)} клиентов не выполнен: {e}")
+        return None
+    except Exception as e: # невалидный JSON, pydantic.ValidationError, ошибки API
+        print(f"Ошибка при получении предложений для пакета из {len(batch)} клиентов: {e}")
+        return None
+    matched = match_packed_items(parsed, [cli_id for cli_id, _, _ in batch])
+    return {cli_id: item.suggestions for cli_id, item in matched.items()}
+
+
+def pack_client_batches(clients, clients_per_request, max_prompt_tokens):
+    """
+    Раскладывает клиентов [(cli_id, cln_name, описания)] по пакетам: не больше clients_per_request
+    клиентов и (если клиент не один) max_prompt_tokens токенов описаний на пакет.
+    """
+    batch, batch_tokens = [], 0
+    for cli_id, cln_name, descriptions in clients:
+        tokens = sum(count_tokens(desc) for desc in descriptions) + count_tokens(str(cln_name))
+        if batch and (len(batch) >= clients_per_request or batch_tokens + tokens > max_prompt_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append((cli_id, cln_name, descriptions))
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def normalize_tag_name(tag: str) -> str:
+    """Имя тега для дедупликации: нижний регистр, слова через «_» (Fuel-Purchases -> fuel_purchases)."""
+    return re.sub(r"[^\w]+", "_", str(tag).strip().lower()).strip("_")
+
+
+class TagCatalogue:
+    """
+    Каталог кандидатов в новые теги: предложения разных клиентов сводятся по нормализованному имени,
+    поддержка — число клиентов, у которых тег предложен. Описание — самое частое среди предложений,
+    основания и клиенты — первые несколько примеров.
+    """
+
+    def __init__(self, max_examples=3):
+        self.max_examples = max_examples
+        self._support = {}
+        self._descriptions = {}
+        self._evidence = {}
+        self._clients = {}
+
+    def add(self, cli_id, suggestions):
+        """Добавляет предложения клиента (TagSuggestion или словари); тег считается один раз на клиента."""
+        seen = set()
+        for suggestion in suggestions:
+            if isinstance(suggestion, BaseModel):
+                suggestion = suggestion.model_dump()
+            tag = normalize_tag_name(suggestion.get("tag", ""))
+            if not tag or tag in seen:
+                continue
+            seen.add(tag)
+            self._support[tag] = self._support.get(tag, 0) + 1
+            descriptions = self._descriptions.setdefault(tag, {})
+            description = str(suggestion.get("description") or "").strip()
+            if description:
+                descriptions[description] = descriptions.get(description, 0) + 1
+            evidence = self._evidence.setdefault(tag, [])
+            if suggestion.get("evidence") and len(evidence) < self.max_examples:
+                evidence.append(str(suggestion["evidence"]).strip())
+            clients = self._clients.setdefault(tag, [])
+            if len(clients) < self.max_examples:
+                clients.append(cli_id)
+
+    def __len__(self):
+        return len(self._support)
+
+    def ranked(self) -> list:
+        """Кандидаты по убыванию поддержки: [{tag, support, description, evidence, example_clients}]."""
+        return [
+            {
+                "tag": tag,
+                "support": support,
+                "description": max(self._descriptions[tag].items(), key=lambda item: item[1])[0] if self._descriptions[tag] else "",
+                "evidence": self._evidence[tag],
+                "example_clients": self._clients[tag],
+            }
+            for tag, support in sorted(self._support.items(), key=lambda item: (-item[1], item[0]))
+        ]
+
+    def write_markdown(self, path, clients_total):
+        """Каталог в виде таблицы Markdown (перезаписывается целиком)."""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"# Кандидаты в новые теги\n\nКлиентов с предложениями: {clients_total}, кандидатов: {len(self)}\n\n")
+            f.write("| # | Тег | Клиентов | Доля | Описание | Основания | Примеры CLI_ID |\n")
+            f.write("|---|---|---|---|---|---|---|\n")
+            for rank, entry in enumerate(self.ranked(), start=1):
+                share = entry["support"] / clients_total if clients_total else 0.0
+                cells = [
+                    str(rank), entry["tag"], str(entry["support"]), f"{share:.1%}", entry["description"],
+                    "; ".join(entry["evidence"]), ", ".join(str(cli_id) for cli_id in entry["example_clients"]),
+                ]
+                f.write("| " + " | ".join(cell.replace("|", "/").replace("\n", " ") for cell in cells) + " |\n")
+
+
+def discover_new_tags_batched(
+    products_file,
+    outgoing_ops_file,
+    suggestions_ledger_file, # JSONL: по строке на рассмотренного клиента с его предложениями
+    catalogue_file, # Markdown-каталог кандидатов, пересобирается из журнала после прогона
+    num_clients_to_process=None,
+    num_transactions_per_client=30,
+    clients_per_request=10,
+    max_batch_prompt_tokens=6000,
+    concurrency=8,
+    max_suggestions=5,
+    ingest_cache=None,
+    sample_max_tokens=600,
+    recent_transactions_window=300
+    ):
+    """
+    Пакетный поиск новых тегов: выборки шаблонов операций нескольких клиентов упаковываются в один
+    структурированный запрос (ответ — список предложений по клиентам), запросы выполняются параллельно
+    (до concurrency одновременно, с повторами и лимитами RequestScheduler). Предложения каждого клиента
+    пишутся в журнал suggestions_ledger_file, по журналу строится каталог кандидатов с поддержкой.
+    Клиенты без ответа в журнал не попадают и будут взяты следующим прогоном.
+    """
+    exploration_data = load_exploration_data(products_file, outgoing_ops_file, ingest_cache, recent_transactions_window)
+    if exploration_data is None:
+        return None
+    sorted_clients_df, recent_index = exploration_data
+    ledger = ProcessedLedger(suggestions_ledger_file)
+    print(f"Уже обработано клиентов (по журналу {ledger.path}): {ledger.records}")
+    clients_df = unprocessed_clients(sorted_clients_df, ledger, num_clients_to_process)
+
+    def client_samples():
+        for client_row in clients_df.itertuples(index=False):
+            cli_id = client_row.CLI_ID
+            cln_name = getattr(client_row, 'CLN_NAME', f"Клиент ID {cli_id}")
+            descriptions = representative_sample(
+                recent_index.descriptions(cli_id),
+                max_items=num_transactions_per_client,
+                max_tokens=sample_max_tokens,
+                token_counter=count_tokens
+            ) if client_row.transaction_count else []
+            if not descriptions:
+                ledger.add(cli_id, cln_name, "no_transactions" if not client_row.transaction_count else "no_descriptions")
+                continue
+            yield cli_id, cln_name, descriptions
+
+    request_scheduler = RequestScheduler(max_concurrency=concurrency)
+    stats = {"requests": 0, "failed_requests": 0, "suggested": 0, "missing": 0}
+
+    def record_batch(batch, result):
+        stats["requests"] += 1
+        if result is None:
+            stats["failed_requests"] += 1
+            stats["missing"] += len(batch)
+            return
+        for cli_id, cln_name, _descriptions in batch:
+            if cli_id not in result:
+                stats["missing"] += 1 # LLM пропустила клиента — повторим в следующем прогоне
+                continue
+            ledger.add(cli_id, cln_name, "suggested", suggestions=[s.model_dump() for s in result[cli_id]])
+            stats["suggested"] += 1
+
+    started_at = time.perf_counter()
+    # Журнал пишет только основной поток; в работе не больше 2×concurrency пакетов, выборки строятся по мере отправки
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="new_tags") as pool:
+        pending = {}
+        for batch in pack_client_batches(client_samples(), clients_per_request, max_batch_prompt_tokens):
+            future = pool.submit(suggest_tags_for_client_batch, batch, EXISTING_TAGS_INFO, request_scheduler, max_suggestions=max_suggestions)
+            pending[future] = batch
+            if len(pending) >= 2 * concurrency:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record_batch(pending.pop(future), future.result())
+        for future in as_completed(pending):
+            record_batch(pending[future], future.result())
+    elapsed = time.perf_counter() - started_at
+
+    catalogue = TagCatalogue()
+    clients_total = 0
+    for record in ledger.read_records():
+        if record.get("status") == "suggested":
+            catalogue.add(record.get("cli_id"), record.get("suggestions") or [])
+            clients_total += 1
+    catalogue.write_markdown(catalogue_file, clients_total)
+
+    print(
+        f"Пакетный поиск тегов: клиентов с предложениями {stats['suggested']}, без ответа {stats['missing']}, "
+        f"запросов {stats['requests']} (неудачных {stats['failed_requests']}) за {elapsed:.1f} с"
+    )
+    print(f"Каталог кандидатов ({len(catalogue)} тегов по {clients_total} клиентам) записан в {catalogue_file}")
+    for entry in catalogue.ranked()[:20]:
+        print(f"  {entry['tag']}: {entry['support']} — {entry['description']}")
+    print(f"Расход токенов LLM: {usage_tracker.summary()}")
+    request_scheduler.log_summary()
+    return catalogue
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Поиск кандидатов в новые теги по операциям клиентов")
+    parser.add_argument("--batched", action="store_true",
+                        help="Пакетный режим: несколько клиентов в запросе, запросы параллельно, каталог кандидатов")
+    parser.add_argument("--clients", type=int, default=None, help="Сколько новых клиентов обработать (по умолчанию 10, в пакетном режиме — всех)")
+    parser.add_argument("--clients-per-request", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
     products_file_path = "data/1. Продукты.xlsx"
     outgoing_ops_file_path = "data/2. Исходящие операции.xlsx"
     processed_tags_md_file = "mb_new_tags.md" # Имя файла для записи результатов и проверки
@@ -232,10 +653,22 @@ if __name__ == "__main__":
     NUMBER_OF_NEW_CLIENTS_TO_PROCESS = 10
     TRANSACTIONS_PER_CLIENT = 30
 
-    analyze_clients_for_additional_single_tags(
-        products_file_path, 
-        outgoing_ops_file_path,
-        processed_tags_md_file, # Передаем путь к файлу
-        num_clients_to_process=NUMBER_OF_NEW_CLIENTS_TO_PROCESS,
-        num_transactions_per_client=TRANSACTIONS_PER_CLIENT
-    )
\ No newline at end of file
+    if args.batched:
+        discover_new_tags_batched(
+            products_file_path,
+            outgoing_ops_file_path,
+            "new_tag_suggestions.jsonl",
+            "new_tags_catalogue.md",
+            num_clients_to_process=args.clients,
+            num_transactions_per_client=TRANSACTIONS_PER_CLIENT,
+            clients_per_request=args.clients_per_request,
+            concurrency=args.concurrency
+        )
+    else:
+        analyze_clients_for_additional_single_tags(
+            products_file_path, 
+            outgoing_ops_file_path,
+            processed_tags_md_file, # Передаем путь к файлу
+            num_clients_to_process=args.clients if args.clients is not None else NUMBER_OF_NEW_CLIENTS_TO_PROCESS,
+            num_transactions_per_client=TRANSACTIONS_PER_CLIENT
+        )
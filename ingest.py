@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+import pandas as pd
+from loguru import logger
+
+from client_index import normalize_cli_id
+
+# Колонки, которые нужны тегированию, и их типы:
+# id — CLI_ID (строка), text — строка, flag — флаг как строка ("1.0", "да"), number — float,
+# date / date_dayfirst — datetime64 (date_dayfirst для дат вида ДД.ММ.ГГГГ)
+TABLE_SCHEMAS = {
+    "products": {
+        "CLI_ID": "id",
+        "CLN_NAME": "text",
+        "STAFF_GROUP": "text",
+        "DT_BANK_OPEN": "date",
+        "CITY": "text",
+        "IS_VED": "flag",
+        "IS_ACQ": "flag",
+        "IS_CREDIT": "flag",
+        "IS_SAL": "flag",
+        "KASSA_COMIS": "number",
+    },
+    "operations": {
+        "CLI_ID": "id",
+        "ENTRY_DESCR": "text",
+        "DT_ENTRY": "date_dayfirst",
+    },
+    "contracts": {
+        "CLI_ID": "id",
+        "CON_TYPE": "text",
+    },
+}
+
+# Меняется при изменении схем или правил приведения типов — старый кэш становится недействительным
+INGEST_SCHEMA_VERSION = 1
+
+
+def file_sha256(path, chunk_size=1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """Оставляет колонки схемы (отсутствующие пропускаются) и приводит их к явным типам."""
+    df = df[[column for column in schema if column in df.columns]].copy()
+    for column in df.columns:
+        kind = schema[column]
+        if kind == "id":
+            df[column] = normalize_cli_id(df[column])
+        elif kind in ("text", "flag"):
+            df[column] = df[column].map(lambda value: None if pd.isna(value) else str(value)).astype("string")
+        elif kind == "number":
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("float64")
+        elif kind in ("date", "date_dayfirst"):
+            df[column] = pd.to_datetime(df[column], errors="coerce", format="mixed", dayfirst=kind == "date_dayfirst")
+    return df
+
+
+def read_source(path, schema: dict) -> pd.DataFrame:
+    """Читает исходный файл (xlsx/xls/csv/parquet), только колонки из схемы."""
+    extension = os.path.splitext(path)[1].lower()
+    wanted = lambda column: column in schema
+    if extension in (".xlsx", ".xlsm", ".xls"):
+        df = pd.read_excel(path, usecols=wanted)
+    elif extension == ".csv":
+        df = pd.read_csv(path, usecols=wanted, dtype={"CLI_ID": str})
+    elif extension == ".parquet":
+        df = pd.read_parquet(path)
+    else:
+        raise ValueError(f"Неподдерживаемый формат файла: {path}")
+    return apply_schema(df, schema)
+
+
+def iter_source_chunks(path, schema: dict, chunksize: int):
+    """Читает исходный файл частями по chunksize строк, не загружая его целиком."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".xlsx", ".xlsm"):
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            positions = [(i, column) for i, column in enumerate(header) if column in schema]
+            columns = [column for _, column in positions]
+            buffer = []
+            for row in rows:
+                buffer.append([row[i] if i < len(row) else None for i, _ in positions])
+                if len(buffer) >= chunksize:
+                    yield apply_schema(pd.DataFrame(buffer, columns=columns), schema)
+                    buffer = []
+            if buffer:
+                yield apply_schema(pd.DataFrame(buffer, columns=columns), schema)
+        finally:
+            workbook.close()
+    elif extension == ".csv":
+        for chunk in pd.read_csv(path, usecols=lambda column: column in schema, dtype={"CLI_ID": str}, chunksize=chunksize):
+            yield apply_schema(chunk, schema)
+    elif extension == ".parquet":
+        yield from iter_parquet_chunks(path, schema, chunksize)
+    else:
+        # Для остальных форматов (.xls) потоковое чтение недоступно
+        yield read_source(path, schema)
+
+
+def iter_parquet_chunks(path, schema: dict, chunksize: int):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(path)
+    columns = [column for column in schema if column in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield apply_schema(batch.to_pandas(), schema)
+
+
+class IngestCache:
+    """
+    Колоночный кэш исходных таблиц: каждый Excel-файл один раз конвертируется в Parquet
+    (только нужные колонки с явными типами), дальше читается из кэша.
+    Кэш сбрасывается при изменении mtime/размера файла (и sha256 при verify_hash).
+    """
+
+    def __init__(self, cache_dir=".cache/ingest", enabled=True, verify_hash=False):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.verify_hash = verify_hash
+
+    @classmethod
+    def from_config(cls, ingest_config: Optional[dict]):
+        ingest_config = ingest_config or {}
+        return cls(
+            cache_dir=ingest_config.get("cache_dir", ".cache/ingest"),
+            enabled=ingest_config.get("enabled", True),
+            verify_hash=ingest_config.get("verify_hash", False),
+        )
+
+    def cache_paths(self, path, table):
+        source_key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+        stem = f"{os.path.splitext(os.path.basename(path))[0]}.{table}.{source_key}"
+        base = os.path.join(self.cache_dir, stem)
+        return base + ".parquet", base + ".meta.json"
+
+    def source_signature(self, path, with_hash=False) -> dict:
+        stat = os.stat(path)
+        signature = {
+            "source": os.path.abspath(path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "schema_version": INGEST_SCHEMA_VERSION,
+        }
+        if with_hash:
+            signature["sha256"] = file_sha256(path)
+        return signature
+
+    def is_fresh(self, path, meta_path) -> bool:
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        signature = self.source_signature(path)
+        if meta.get("schema_version") != INGEST_SCHEMA_VERSION or meta.get("size") != signature["size"]:
+            return False
+        if meta.get("mtime_ns") == signature["mtime_ns"]:
+            return True
+        # mtime изменился (например, файл скопирован заново) — сверяем содержимое по хэшу
+        if self.verify_hash and meta.get("sha256") and meta["sha256"] == file_sha256(path):
+            meta["mtime_ns"] = signature["mtime_ns"]
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            return True
+        return False
+
+    def read(self, path, table: str) -> pd.DataFrame:
+        """Таблица из кэша или из исходного файла (с записью в кэш)."""
+        schema = TABLE_SCHEMAS[table]
+        if not self.enabled or path.lower().endswith(".parquet"):
+            return read_source(path, schema)
+
+        parquet_path, meta_path = self.cache_paths(path, table)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if os.path.exists(parquet_path) and self.is_fresh(path, meta_path):
+            logger.info(f"Чтение '{path}' из колоночного кэша {parquet_path}")
+            return pd.read_parquet(parquet_path)
+
+        logger.info(f"Конвертация '{path}' в колоночный кэш {parquet_path}")
+        df = read_source(path, schema)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            df.to_parquet(parquet_path, index=False)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(self.source_signature(path, with_hash=self.verify_hash), f, ensure_ascii=False)
+        except ImportError as e: # Нет pyarrow — работаем без кэша
+            logger.warning(f"Колоночный кэш недоступен ({e}), файл будет читаться напрямую.")
+        return df
+
+    def iter_chunks(self, path, table: str, chunksize: int):
+        """
+        Потоковое чтение таблицы частями. Если кэш актуален — читается Parquet по батчам,
+        иначе исходный файл читается потоково и одновременно записывается в кэш.
+        """
+        schema = TABLE_SCHEMAS[table]
+        if not self.enabled or path.lower().endswith(".parquet"):
+            yield from iter_source_chunks(path, schema, chunksize)
+            return
+
+        parquet_path, meta_path = self.cache_paths(path, table)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if os.path.exists(parquet_path) and self.is_fresh(path, meta_path):
+            logger.info(f"Потоковое чтение '{path}' из колоночного кэша {parquet_path}")
+            yield from iter_parquet_chunks(parquet_path, schema, chunksize)
+            return
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            logger.warning(f"Колоночный кэш недоступен ({e}), файл будет читаться напрямую.")
+            yield from iter_source_chunks(path, schema, chunksize)
+            return
+
+        logger.info(f"Потоковая конвертация '{path}' в колоночный кэш {parquet_path}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = parquet_path + ".tmp"
+        writer = None
+        try:
+            for chunk in iter_source_chunks(path, schema, chunksize):
+                arrow_table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, arrow_table.schema)
+                writer.write_table(arrow_table.cast(writer.schema))
+                yield chunk
+        finally:
+            if writer is not None:
+                writer.close()
+        # Сюда доходим только если файл прочитан полностью — недочитанный кэш не публикуется
+        if writer is not None:
+            os.replace(tmp_path, parquet_path)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(self.source_signature(path, with_hash=self.verify_hash), f, ensure_ascii=False)
+
+    def warm(self, path, table: str, chunksize: int = 200000):
+        """Строит кэш файла, если его нет или он устарел, не загружая таблицу в память целиком."""
+        if not self.enabled or path.lower().endswith(".parquet"):
+            return
+        parquet_path, meta_path = self.cache_paths(path, table)
+        if os.path.exists(parquet_path) and self.is_fresh(path, meta_path):
+            return
+        for _ in self.iter_chunks(path, table, chunksize):
+            pass
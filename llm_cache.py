@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+
+class LLMCache:
+    """
+    Локальный кэш ответов LLM в SQLite с адресацией по содержимому запроса.
+
+    Ключ — sha256 от модели, системного промпта, пользовательского промпта, схемы инструмента
+    и параметров генерации. Значение — JSON аргументов вызова инструмента.
+    Режимы: "use" — читать и писать, "refresh" — только перезаписывать, "bypass" — не использовать.
+    Устаревшие записи (ttl) и записи сверх лимита размера (по давности использования) удаляются.
+    """
+
+    MODES = ("use", "refresh", "bypass")
+
+    def __init__(self, path, mode="use", ttl_seconds=None, max_size_bytes=None, evict_every=500):
+        if mode not in self.MODES:
+            raise ValueError(f"Неизвестный режим кэша LLM '{mode}', ожидается одно из {self.MODES}")
+        self.path = path
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = max_size_bytes
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Хранилище общее для шардов pipeline.py --workers: при блокировке ждем, а не падаем с database is locked
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+        self._conn.commit()
+        self.evict()
+
+    @classmethod
+    def from_config(cls, cache_config: Optional[dict]):
+        """Создает кэш по секции llm_cache из config.yaml (None, если кэш выключен)."""
+        if not cache_config or not cache_config.get("enabled", False):
+            return None
+        ttl_days = cache_config.get("ttl_days")
+        max_size_mb = cache_config.get("max_size_mb")
+        return cls(
+            path=cache_config.get("path", ".cache/llm_cache.sqlite"),
+            mode=cache_config.get("mode", "use"),
+            ttl_seconds=ttl_days * 86400 if ttl_days else None,
+            max_size_bytes=int(max_size_mb * 1024 * 1024) if max_size_mb else None,
+        )
+
+    @staticmethod
+    def make_key(model, system_prompt, user_prompt, tool_schema, **params) -> str:
+        payload = json.dumps(
+            {
+                "model": model,
+                "system_prompt": system_prompt,
+                "user_prompt": user_prompt,
+                "tool_schema": tool_schema,
+                "params": params,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key) -> Optional[str]:
+        if self.mode != "use":
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def contains(self, key) -> bool:
+        """Есть ли актуальный ответ по ключу. Только чтение: не продлевает запись и не влияет на счетчики hits/misses."""
+        if self.mode != "use":
+            return False
+        with self._lock:
+            row = self._conn.execute("SELECT created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return row is not None and not (self.ttl_seconds and time.time() - row[0] > self.ttl_seconds)
+
+    def set(self, key, value: str):
+        if self.mode == "bypass":
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+            self.writes += 1
+            need_eviction = self.writes % self.evict_every == 0
+        if need_eviction:
+            self.evict()
+
+    def evict(self):
+        """Удаляет просроченные записи и самые давно использованные сверх лимита размера."""
+        with self._lock:
+            removed = 0
+            if self.ttl_seconds:
+                cursor = self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+                removed += cursor.rowcount
+            if self.max_size_bytes:
+                total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+                if total_size > self.max_size_bytes:
+                    excess = total_size - self.max_size_bytes
+                    keys_to_delete = []
+                    for key, size in self._conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at"):
+                        if excess <= 0:
+                            break
+                        keys_to_delete.append((key,))
+                        excess -= size
+                    self._conn.executemany("DELETE FROM llm_cache WHERE key = ?", keys_to_delete)
+                    removed += len(keys_to_delete)
+            self._conn.commit()
+            self.evicted += removed
+        if removed:
+            logger.info(f"Кэш LLM: удалено {removed} записей")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total_size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "writes": self.writes,
+            "evicted": self.evicted,
+            "entries": entries,
+            "size_bytes": total_size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
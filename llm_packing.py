@@ -0,0 +1,78 @@
+from functools import lru_cache
+from typing import List
+
+from pydantic import BaseModel, Field, ValidationError, create_model, field_validator
+
+# Поле записи упакованного ответа, по которому запись сопоставляется с клиентом запроса
+PACKED_ID_FIELD = "cli_id"
+
+
+@lru_cache(maxsize=None)
+def build_packed_model(client_model: type[BaseModel]) -> type[BaseModel]:
+    """
+    Модель упакованного ответа: список записей client_model, у каждой — CLI_ID клиента.
+    Записи, не прошедшие валидацию, отбрасываются при разборе, а не делают невалидным весь ответ:
+    такие клиенты считаются пропущенными и отправляются повторно.
+    """
+    item_fields = {PACKED_ID_FIELD: (str, Field(description="CLI_ID компании из запроса, без изменений"))}
+    item_fields.update({name: (field.annotation, field) for name, field in client_model.model_fields.items()})
+    item_model = create_model(f"{client_model.__name__}Item", **item_fields)
+
+    def drop_malformed_items(cls, value):
+        if not isinstance(value, list):
+            return value
+        items = []
+        for item in value:
+            try:
+                items.append(item_model.model_validate(item))
+            except ValidationError:
+                continue
+        return items
+
+    return create_model(
+        f"Packed{client_model.__name__}",
+        clients=(List[item_model], Field(description="По одной записи на каждую компанию из запроса")),
+        __validators__={"drop_malformed_items": field_validator("clients", mode="before")(drop_malformed_items)},
+    )
+
+
+def pack_by_token_budget(items, overhead_tokens, max_prompt_tokens, max_items,
+                         completion_tokens_per_item=0, max_completion_tokens=None) -> list:
+    """
+    Раскладывает элементы [(элемент, токенов)] по пакетам в исходном порядке. В пакет добавляется,
+    пока overhead_tokens + токены элементов не превышают max_prompt_tokens, ожидаемый ответ
+    (completion_tokens_per_item на элемент) — max_completion_tokens и элементов не больше max_items.
+    Элемент, который не помещается даже один, уходит отдельным пакетом.
+    """
+    max_items = max(1, max_items)
+    if max_completion_tokens and completion_tokens_per_item:
+        max_items = max(1, min(max_items, max_completion_tokens // completion_tokens_per_item))
+    packs, pack, pack_tokens = [], [], overhead_tokens
+    for item, tokens in items:
+        if pack and (len(pack) >= max_items or pack_tokens + tokens > max_prompt_tokens):
+            packs.append(pack)
+            pack, pack_tokens = [], overhead_tokens
+        pack.append(item)
+        pack_tokens += tokens
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def match_packed_items(packed_response, expected_ids) -> dict:
+    """
+    Записи упакованного ответа по CLI_ID: {cli_id: запись}. Записи с CLI_ID не из запроса отбрасываются.
+    Одинаковые повторы записи клиента схлопываются; клиент с несовпадающими записями считается
+    пропущенным — неясно, какой из ответов к нему относится.
+    """
+    expected = {str(cli_id).strip(): cli_id for cli_id in expected_ids}
+    matched, conflicting = {}, set()
+    for item in packed_response.clients:
+        cli_id = expected.get(str(getattr(item, PACKED_ID_FIELD)).strip())
+        if cli_id is None:
+            continue
+        if cli_id not in matched:
+            matched[cli_id] = item
+        elif matched[cli_id].model_dump(exclude={PACKED_ID_FIELD}) != item.model_dump(exclude={PACKED_ID_FIELD}):
+            conflicting.add(cli_id)
+    return {cli_id: item for cli_id, item in matched.items() if cli_id not in conflicting}
@@ -0,0 +1,334 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+import openai
+from loguru import logger
+
+from token_usage import CURRENT_CLIENT
+
+# HTTP-статусы, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Код 429, который означает исчерпанный баланс, а не превышение частоты: повтор не поможет
+PERMANENT_RATE_LIMIT_CODES = {"insufficient_quota"}
+
+
+class LLMRequestDropped(Exception):
+    """Запрос к LLM не выполнен: постоянная ошибка или исчерпаны повторы."""
+
+    def __init__(self, reason: str, error: Exception):
+        super().__init__(f"{reason}: {error}")
+        self.reason = reason
+        self.error = error
+
+
+def parse_duration(value) -> Optional[float]:
+    """Длительность из заголовков OpenAI ("1s", "6m0s", "120ms", "0.5") в секундах."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def header_number(headers, name) -> Optional[float]:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateBudget:
+    """Ведро токенов на per_minute единиц в минуту; емкость — burst_seconds равномерного расхода."""
+
+    def __init__(self, per_minute, burst_seconds=10.0):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount, now) -> float:
+        """Через сколько секунд хватит amount единиц (запрос больше емкости ждет полного ведра)."""
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        self.level -= amount
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов chat.completions.
+
+    Перед отправкой запрос ждет свободный слот (лимит одновременных запросов) и бюджет RPM/TPM
+    (квоты из конфига или выученные из заголовков x-ratelimit-*; при remaining = 0 — пауза до reset).
+    Лимит одновременных запросов меняется по AIMD: +1/лимит за успешный ответ, ×decrease_factor
+    при 429 или всплеске задержки (не чаще раза за cooldown). Повторяемые ошибки (429, таймауты,
+    обрывы соединения, 5xx) повторяются с экспоненциальной задержкой со случайным разбросом
+    (не меньше Retry-After); постоянные ошибки и исчерпанные повторы — LLMRequestDropped,
+    такие запросы попадают в отчет dropped.
+    """
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, rpm=None, tpm=None, max_retries=6,
+                 backoff_base_seconds=0.5, backoff_max_seconds=60.0, timeout_seconds=None, decrease_factor=0.5,
+                 latency_spike_factor=3.0, cooldown_seconds=2.0, burst_seconds=10.0, metrics=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.timeout_seconds = timeout_seconds
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.burst_seconds = burst_seconds
+        self.metrics = metrics
+
+        self._requests_budget = RateBudget(rpm, burst_seconds) if rpm else None
+        self._tokens_budget = RateBudget(tpm, burst_seconds) if tpm else None
+        self._configured_quota = bool(rpm or tpm)
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._last_decrease_at = 0.0
+        self._latency_ewma = None
+        self._latency_samples = 0
+        self._cond = threading.Condition()
+        self._stats = {"requests": 0, "ok": 0, "retries": 0, "dropped": 0, "rate_limited": 0, "wait_seconds": 0.0}
+        self.dropped = []
+
+    @classmethod
+    def from_config(cls, scheduler_config: Optional[dict], quota_config: Optional[dict] = None, max_concurrency=8, metrics=None):
+        scheduler_config = scheduler_config or {}
+        quota_config = quota_config or {}
+        keys = (
+            "min_concurrency", "max_retries", "backoff_base_seconds", "backoff_max_seconds", "timeout_seconds",
+            "decrease_factor", "latency_spike_factor", "cooldown_seconds", "burst_seconds",
+        )
+        return cls(
+            max_concurrency=max_concurrency,
+            rpm=quota_config.get("rpm"),
+            tpm=quota_config.get("tpm"),
+            metrics=metrics,
+            **{key: scheduler_config[key] for key in keys if scheduler_config.get(key) is not None},
+        )
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(self.min_concurrency, int(self._limit))
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["wait_seconds"] = round(stats["wait_seconds"], 3)
+            stats["concurrency_limit"] = self.concurrency_limit
+            stats["rpm"] = self._requests_budget.per_minute if self._requests_budget else None
+            stats["tpm"] = self._tokens_budget.per_minute if self._tokens_budget else None
+        return stats
+
+    # --- Слоты и бюджеты ---
+    def _acquire(self, tokens):
+        started_at = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._in_flight >= self.concurrency_limit:
+                    self._cond.wait(0.5)
+                    continue
+                wait = self._blocked_until - now
+                if self._requests_budget is not None:
+                    wait = max(wait, self._requests_budget.wait_time(1, now))
+                if self._tokens_budget is not None:
+                    wait = max(wait, self._tokens_budget.wait_time(tokens, now))
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                if self._requests_budget is not None:
+                    self._requests_budget.consume(1)
+                if self._tokens_budget is not None:
+                    self._tokens_budget.consume(tokens)
+                self._in_flight += 1
+                self._stats["requests"] += 1
+                self._stats["wait_seconds"] += now - started_at
+                break
+        if self.metrics is not None:
+            self.metrics.observe("llm_scheduler_wait_seconds", now - started_at)
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _decrease(self, reason):
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease_at < self.cooldown_seconds:
+                return
+            self._last_decrease_at = now
+            self._limit = max(float(self.min_concurrency), self._limit * self.decrease_factor)
+            limit = self.concurrency_limit
+        logger.info(f"Планировщик LLM: лимит одновременных запросов снижен до {limit} ({reason})")
+        if self.metrics is not None:
+            self.metrics.increment("llm_concurrency_decreases_total", {"reason": reason})
+            self.metrics.set_gauge("llm_concurrency_limit", limit)
+
+    def _on_success(self, latency):
+        with self._cond:
+            self._stats["ok"] += 1
+            baseline = self._latency_ewma
+            self._latency_ewma = latency if baseline is None else 0.9 * baseline + 0.1 * latency
+            self._latency_samples += 1
+            spike = baseline is not None and self._latency_samples > 10 and latency > self.latency_spike_factor * baseline
+            if not spike:
+                self._limit = min(float(self.max_concurrency), self._limit + 1.0 / max(self._limit, 1.0))
+            limit = self.concurrency_limit
+        if spike:
+            self._decrease("latency_spike")
+        elif self.metrics is not None:
+            self.metrics.set_gauge("llm_concurrency_limit", limit)
+
+    def _apply_headers(self, headers, estimated_tokens=0, actual_tokens=None):
+        """Учитывает x-ratelimit-* ответа: выученные квоты, пауза при исчерпании, поправка расхода токенов."""
+        if headers is None:
+            return
+        with self._cond:
+            now = time.monotonic()
+            if not self._configured_quota:
+                # Квоты не заданы в конфиге — берем лимиты организации из заголовков
+                limit_requests = header_number(headers, "x-ratelimit-limit-requests")
+                limit_tokens = header_number(headers, "x-ratelimit-limit-tokens")
+                if limit_requests and (self._requests_budget is None or self._requests_budget.per_minute != limit_requests):
+                    self._requests_budget = RateBudget(limit_requests, self.burst_seconds)
+                if limit_tokens and (self._tokens_budget is None or self._tokens_budget.per_minute != limit_tokens):
+                    self._tokens_budget = RateBudget(limit_tokens, self.burst_seconds)
+            for kind in ("requests", "tokens"):
+                remaining = header_number(headers, f"x-ratelimit-remaining-{kind}")
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining is not None and remaining <= 0 and reset:
+                    self._blocked_until = max(self._blocked_until, now + reset)
+            if self._tokens_budget is not None and actual_tokens is not None:
+                self._tokens_budget.consume(actual_tokens - estimated_tokens)
+
+    # --- Ошибки и повторы ---
+    @staticmethod
+    def classify(error: Exception) -> Optional[str]:
+        """Причина для повтора (rate_limited, timeout, connection, server_error) или None для постоянной ошибки."""
+        if isinstance(error, openai.APITimeoutError):
+            return "timeout"
+        if isinstance(error, openai.APIConnectionError):
+            return "connection"
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code == 429:
+                return None if getattr(error, "code", None) in PERMANENT_RATE_LIMIT_CODES else "rate_limited"
+            if error.status_code in RETRYABLE_STATUSES:
+                return "timeout" if error.status_code == 408 else "server_error"
+        return None
+
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        retry_after_ms = header_number(response.headers, "retry-after-ms")
+        if retry_after_ms is not None:
+            return retry_after_ms / 1000
+        return parse_duration(response.headers.get("retry-after"))
+
+    def backoff(self, attempt, retry_after=None) -> float:
+        """Задержка перед повтором: случайная в [0, base·2^attempt] (full jitter), не меньше Retry-After."""
+        delay = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    def _drop(self, group, reason, error):
+        record = {"cli_id": CURRENT_CLIENT.get(), "group": group, "reason": reason, "error": str(error)[:500]}
+        with self._cond:
+            self._stats["dropped"] += 1
+            self.dropped.append(record)
+        if self.metrics is not None:
+            self.metrics.increment("llm_dropped_total", {"group": group, "reason": reason})
+        logger.warning(f"Запрос к LLM не выполнен (клиент {record['cli_id']}, группа {group}): {reason}: {error}")
+        return LLMRequestDropped(reason, error)
+
+    def create(self, client, request: dict, estimated_tokens=0, group=None):
+        """
+        Выполняет chat.completions.create(**request) с учетом бюджетов, лимита и повторов.
+        Встроенные повторы клиента OpenAI отключаются — ими управляет планировщик.
+        """
+        options = {"max_retries": 0}
+        if self.timeout_seconds:
+            options["timeout"] = self.timeout_seconds
+        completions = client.with_options(**options).chat.completions
+        attempt = 0
+        while True:
+            self._acquire(estimated_tokens)
+            started_at = time.perf_counter()
+            try:
+                raw_response = completions.with_raw_response.create(**request)
+            except openai.APIError as e:
+                self._release()
+                reason = self.classify(e)
+                if reason == "rate_limited":
+                    with self._cond:
+                        self._stats["rate_limited"] += 1
+                    self._decrease(reason)
+                    response = getattr(e, "response", None)
+                    self._apply_headers(response.headers if response is not None else None)
+                if reason is None:
+                    raise self._drop(group, f"permanent_{type(e).__name__}", e) from e
+                if attempt >= self.max_retries:
+                    raise self._drop(group, f"retries_exhausted_{reason}", e) from e
+                delay = self.backoff(attempt, self.retry_after(e))
+                attempt += 1
+                with self._cond:
+                    self._stats["retries"] += 1
+                if self.metrics is not None:
+                    self.metrics.increment("llm_retries_total", {"group": group, "reason": reason})
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._release()
+                raise
+            latency = time.perf_counter() - started_at
+            self._release()
+            if self.metrics is not None:
+                self.metrics.observe("llm_request_seconds", latency, {"group": group})
+            completion = raw_response.parse()
+            usage = getattr(completion, "usage", None)
+            self._apply_headers(raw_response.headers, estimated_tokens, getattr(usage, "total_tokens", None))
+            self._on_success(latency)
+            return completion
+
+    def log_summary(self, dropped_report_path=None):
+        """Итог планировщика в лог; неудавшиеся запросы — в JSONL dropped_report_path (если задан)."""
+        logger.info(f"Планировщик LLM: {self.stats()}")
+        if not self.dropped:
+            return
+        reasons = {}
+        for record in self.dropped:
+            reasons[record["reason"]] = reasons.get(record["reason"], 0) + 1
+        logger.warning(f"Запросов к LLM без ответа: {len(self.dropped)} по причинам {reasons} — теги этих групп не определены LLM")
+        if dropped_report_path:
+            directory = os.path.dirname(dropped_report_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(dropped_report_path, "w", encoding="utf-8") as f:
+                for record in self.dropped:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            logger.warning(f"Список запросов без ответа записан в {dropped_report_path}")
@@ -0,0 +1,167 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from loguru import logger
+
+# Границы корзин гистограмм длительностей (секунды): от 1 мс до ~30 минут, шаг ×1.5
+HISTOGRAM_BUCKETS = tuple(round(0.001 * 1.5 ** i, 6) for i in range(36))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def metric_key(name, labels: Optional[dict]):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными корзинами: память не растет с числом наблюдений."""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q) -> float:
+        """Оценка квантиля по верхней границе корзины (для последней корзины — максимум)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(HISTOGRAM_BUCKETS[i], self.max) if i < len(HISTOGRAM_BUCKETS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        summary = {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6)}
+        summary["mean"] = round(self.sum / self.count, 6) if self.count else 0.0
+        for q in QUANTILES:
+            summary[f"p{int(q * 100)}"] = round(self.quantile(q), 6)
+        return summary
+
+
+class Metrics:
+    """
+    Метрики прогона: счетчики (в т.ч. ошибки по классам), гистограммы длительностей по этапам
+    и значения (gauges). Экспорт в JSON и в текстовый формат Prometheus, периодические снимки.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._snapshot_thread = None
+        self._snapshot_stop = threading.Event()
+
+    def increment(self, name, labels: Optional[dict] = None, value=1):
+        key = metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels: Optional[dict] = None):
+        with self._lock:
+            self._gauges[metric_key(name, labels)] = value
+
+    def observe(self, name, seconds, labels: Optional[dict] = None):
+        key = metric_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Замеряет длительность блока в гистограмму name (секунды), в том числе при исключении."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: histogram.summary() for key, histogram in self._histograms.items()}
+        as_name = lambda key: key[0] + format_labels(key[1])
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "counters": {as_name(key): value for key, value in sorted(counters.items())},
+            "gauges": {as_name(key): value for key, value in sorted(gauges.items())},
+            "histograms": {as_name(key): summary for key, summary in sorted(histograms.items())},
+        }
+
+    def to_prometheus(self, prefix="fi_semantic_") -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, bucket_count in zip((*HISTOGRAM_BUCKETS, "+Inf"), histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{prefix}{name}_bucket{format_labels((*labels, ('le', bound)))} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path_prefix):
+        """Пишет метрики в path_prefix.json и path_prefix.prom (атомарно, через временные файлы)."""
+        directory = os.path.dirname(path_prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        for extension, content in (
+            (".json", json.dumps(self.snapshot(), ensure_ascii=False, indent=2)),
+            (".prom", self.to_prometheus()),
+        ):
+            tmp_path = path_prefix + extension + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path_prefix + extension)
+
+    def start_snapshots(self, path_prefix, every_seconds):
+        """Периодически перезаписывает файлы метрик в фоновом потоке (до stop_snapshots)."""
+        if self._snapshot_thread is not None:
+            return
+        self._snapshot_stop.clear()
+
+        def run():
+            while not self._snapshot_stop.wait(every_seconds):
+                try:
+                    self.write(path_prefix)
+                except OSError as e:
+                    logger.warning(f"Не удалось записать снимок метрик: {e}")
+
+        self._snapshot_thread = threading.Thread(target=run, name="metrics-snapshots", daemon=True)
+        self._snapshot_thread.start()
+
+    def stop_snapshots(self):
+        if self._snapshot_thread is None:
+            return
+        self._snapshot_stop.set()
+        self._snapshot_thread.join()
+        self._snapshot_thread = None
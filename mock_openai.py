@@ -0,0 +1,264 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from loguru import logger
+
+from sampler import estimate_tokens
+
+
+# Идентификаторы клиентов в упакованном промпте («CLI_ID: …»)
+PROMPT_CLIENT_ID_PATTERN = re.compile(r"CLI_ID:\s*(\S+)")
+
+
+def resolve_schema(schema: dict, defs: dict) -> dict:
+    while "$ref" in schema:
+        schema = defs[schema["$ref"].split("/")[-1]]
+    return schema
+
+
+def fill_schema(schema: dict, rng: random.Random, defs: Optional[dict] = None, client_ids=()):
+    """
+    Случайное значение, соответствующее JSON-схеме параметров инструмента (как их строит pydantic).
+    client_ids — CLI_ID из промпта: массив записей с полем cli_id получает по записи на каждого клиента.
+    """
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return fill_schema(resolve_schema(schema, defs), rng, defs, client_ids)
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if "const" in schema:
+        return schema["const"]
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"] or schema["anyOf"]
+        return fill_schema(options[0], rng, defs, client_ids)
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {name: fill_schema(prop, rng, defs, client_ids) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        items = schema.get("items", {})
+        if client_ids and "cli_id" in resolve_schema(items, defs).get("properties", {}):
+            return [{**fill_schema(items, rng, defs), "cli_id": cli_id} for cli_id in client_ids]
+        return [fill_schema(items, rng, defs, client_ids) for _ in range(max(schema.get("minItems", 1), 1))]
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    if schema_type == "integer":
+        return rng.randint(0, 10)
+    if schema_type == "number":
+        return round(rng.random(), 3)
+    return "тег"
+
+
+class MockChatCompletions:
+    """
+    Поведение заглушки chat.completions: задержка ответа, доля ответов 429 и вызов инструмента
+    с аргументами по схеме запроса. Счетчики запросов доступны через stats().
+    """
+
+    def __init__(self, latency_ms=200.0, latency_jitter_ms=50.0, rate_limit_rate=0.0, invalid_rate=0.0,
+                 rpm_limit=10_000, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.rate_limit_rate = rate_limit_rate
+        self.invalid_rate = invalid_rate
+        self.rpm_limit = rpm_limit
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "ok": 0, "rate_limited": 0, "invalid": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._by_tool = {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "by_tool": dict(self._by_tool)}
+
+    def reset(self):
+        with self._lock:
+            self._stats = dict.fromkeys(self._stats, 0)
+            self._by_tool = {}
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self._stats[key] += value
+
+    def rate_limit_headers(self) -> dict:
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm_limit),
+            "x-ratelimit-remaining-requests": str(max(self.rpm_limit - 1, 0)),
+        }
+
+    def respond(self, request: dict):
+        """(HTTP-статус, заголовки, тело ответа) для запроса chat.completions."""
+        with self._lock:
+            delay = max(0.0, self._rng.gauss(self.latency_ms, self.latency_jitter_ms)) / 1000
+            rate_limited = self._rng.random() < self.rate_limit_rate
+            invalid = self._rng.random() < self.invalid_rate
+            seed = self._rng.random()
+        self._count(requests=1)
+        time.sleep(delay)
+
+        if rate_limited:
+            self._count(rate_limited=1)
+            headers = {**self.rate_limit_headers(), "x-ratelimit-remaining-requests": "0", "retry-after-ms": "50"}
+            body = {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}
+            return 429, headers, body
+
+        prompt_tokens = sum(estimate_tokens(str(message.get("content") or "")) for message in request.get("messages", []))
+        message = {"role": "assistant", "content": None}
+        finish_reason = "stop"
+        tools = request.get("tools") or []
+        if tools:
+            function = self.choose_tool(tools, request.get("tool_choice"))
+            prompt = "\n".join(str(message.get("content") or "") for message in request.get("messages", []))
+            arguments = json.dumps(
+                fill_schema(function.get("parameters", {}), random.Random(seed), client_ids=PROMPT_CLIENT_ID_PATTERN.findall(prompt)),
+                ensure_ascii=False
+            )
+            if invalid:
+                self._count(invalid=1)
+                arguments = arguments[: len(arguments) // 2] # обрезанный JSON
+            message["tool_calls"] = [{
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": function["name"], "arguments": arguments},
+            }]
+            finish_reason = "tool_calls"
+            completion_text = arguments
+            with self._lock:
+                self._by_tool[function["name"]] = self._by_tool.get(function["name"], 0) + 1
+        else:
+            completion_text = "Тег: пример\nЗначение: да\nОснование: заглушка"
+            message["content"] = completion_text
+        completion_tokens = estimate_tokens(completion_text)
+        self._count(ok=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+        body = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+        return 200, self.rate_limit_headers(), body
+
+    @staticmethod
+    def choose_tool(tools, tool_choice) -> dict:
+        if isinstance(tool_choice, dict):
+            name = tool_choice.get("function", {}).get("name")
+            for tool in tools:
+                if tool["function"]["name"] == name:
+                    return tool["function"]
+        return tools[0]["function"]
+
+
+class MockOpenAIServer:
+    """
+    Локальный HTTP-сервер, совместимый с POST /v1/chat/completions (для бенчмарков без ключа API).
+    Клиент: OpenAI(base_url=server.base_url, api_key="mock") или переменная окружения OPENAI_BASE_URL.
+    GET /stats — счетчики запросов.
+    """
+
+    def __init__(self, completions: MockChatCompletions, host="127.0.0.1", port=0):
+        self.completions = completions
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler_class(self):
+        completions = self.completions
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_json(self, status, body, headers=None):
+                payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError as e:
+                    self.send_json(400, {"error": {"message": f"Invalid JSON: {e}", "type": "invalid_request_error"}})
+                    return
+                status, headers, body = completions.respond(request)
+                self.send_json(status, body, headers)
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/stats":
+                    self.send_json(200, completions.stats())
+                else:
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def log_message(self, format, *args): # access-лог каждого запроса не нужен
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        logger.info(f"Заглушка OpenAI слушает {self.base_url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка OpenAI chat.completions для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="Доля ответов с невалидными аргументами инструмента")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    completions = MockChatCompletions(
+        latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+        rate_limit_rate=args.rate_limit_rate, invalid_rate=args.invalid_rate, seed=args.seed
+    )
+    server = MockOpenAIServer(completions, host=args.host, port=args.port).start()
+    print(f"OPENAI_BASE_URL={server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
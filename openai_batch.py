@@ -0,0 +1,143 @@
+import glob
+import json
+import os
+from typing import Optional
+
+from loguru import logger
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMBINED_REQUEST_GROUP = "combined" # custom_id для составного запроса по всем группам
+
+
+def make_custom_id(cli_id, request_group) -> str:
+    return f"{cli_id}:{request_group}"
+
+
+def split_custom_id(custom_id: str):
+    cli_id, request_group = custom_id.rsplit(":", 1)
+    return cli_id, request_group
+
+
+def list_jsonl_files(path) -> list:
+    """Список JSONL-файлов: сам файл или все *.jsonl в директории (в алфавитном порядке)."""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.jsonl")))
+    return [path]
+
+
+class BatchRequestWriter:
+    """
+    Пишет запросы в JSONL-файлы формата OpenAI Batch API.
+    Новый файл начинается при достижении лимита числа запросов или размера файла.
+    """
+
+    def __init__(self, output_dir, prefix="batch_requests", max_requests_per_file=50000, max_file_bytes=190 * 1024 * 1024):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_requests_per_file = max_requests_per_file
+        self.max_file_bytes = max_file_bytes
+        self.paths = []
+        self.total_requests = 0
+        self._file = None
+        self._file_requests = 0
+        self._file_bytes = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open_next_file(self):
+        self.close()
+        path = os.path.join(self.output_dir, f"{self.prefix}_{len(self.paths):04d}.jsonl")
+        self._file = open(path, "w", encoding="utf-8")
+        self._file_requests = 0
+        self._file_bytes = 0
+        self.paths.append(path)
+
+    def add(self, custom_id: str, body: dict):
+        line = json.dumps(
+            {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+            ensure_ascii=False
+        ) + "\n"
+        line_bytes = len(line.encode("utf-8"))
+        if (
+            self._file is None
+            or self._file_requests >= self.max_requests_per_file
+            or self._file_bytes + line_bytes > self.max_file_bytes
+        ):
+            self._open_next_file()
+        self._file.write(line)
+        self._file_requests += 1
+        self._file_bytes += line_bytes
+        self.total_requests += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def extract_tool_call(response_body: dict) -> Optional[dict]:
+    """Имя и аргументы первого вызова инструмента из тела ответа chat.completions."""
+    try:
+        message = response_body["choices"][0]["message"]
+        tool_call = (message.get("tool_calls") or [])[0]
+        return {"name": tool_call["function"]["name"], "arguments": tool_call["function"]["arguments"]}
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def read_batch_results(paths) -> dict:
+    """
+    Читает JSONL результатов Batch API.
+    Возвращает {custom_id: {"name": ..., "arguments": ...}} для успешных ответов
+    и {custom_id: {"error": ...}} для ошибок.
+    """
+    results = {}
+    for path in paths:
+        for result_path in list_jsonl_files(path):
+            with open(result_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    custom_id = record.get("custom_id")
+                    response = record.get("response") or {}
+                    if record.get("error") or response.get("status_code") != 200:
+                        results.setdefault(custom_id, {"error": record.get("error") or response.get("body")})
+                        continue
+                    tool_call = extract_tool_call(response.get("body") or {})
+                    # Успешный ответ (например, из повторного батча) важнее ранее прочитанной ошибки
+                    results[custom_id] = tool_call if tool_call else {"error": "ответ без вызова инструмента"}
+    logger.info(f"Прочитано результатов батча: {len(results)}")
+    return results
+
+
+def run_batch_locally(request_paths, output_dir, client) -> list:
+    """
+    Локальная замена Batch API: выполняет запросы из JSONL через client.chat.completions
+    и пишет результаты в том же формате, что и OpenAI Batch API.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = []
+    for request_path in request_paths:
+        output_path = os.path.join(output_dir, os.path.basename(request_path).replace("requests", "results"))
+        with open(request_path, "r", encoding="utf-8") as f_in, open(output_path, "w", encoding="utf-8") as f_out:
+            for line in f_in:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                record = {"id": None, "custom_id": request["custom_id"], "response": None, "error": None}
+                try:
+                    completion = client.chat.completions.create(**request["body"])
+                    body = completion.model_dump() if hasattr(completion, "model_dump") else completion
+                    record["response"] = {"status_code": 200, "body": body}
+                except Exception as e:
+                    record["error"] = {"code": type(e).__name__, "message": str(e)}
+                f_out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        output_paths.append(output_path)
+        logger.info(f"Локально выполнен батч {request_path} -> {output_path}")
+    return output_paths
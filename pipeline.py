@@ -1,4 +1,10 @@
 import os
+import argparse
+import cProfile
+import pstats
+import subprocess
+import sys
+import yaml
 import pandas as pd
 from datetime import datetime, date
 from openai import OpenAI
@@ -8,35 +14,229 @@ from typing import List, Optional, Literal
 from dotenv import load_dotenv
 import json
 from fetch_tags import FetchTags
+from openai_batch import list_jsonl_files, run_batch_locally
+from checkpoint import CheckpointStore
+from ingest import IngestCache
+from results_output import DEFAULT_RESULTS_PARQUET_PATH, ResultsParquetWriter, new_run_id, read_run_id
+from results_store import DEFAULT_RESULTS_STORE_PATH, ResultsStore
+from sharding import Shard, merge_shard_results, shard_path
+
+# Укажи пути к твоим Excel файлам
+PRODUCTS_FILE_PATH = "data/" + "1. Продукты.xlsx"  # Замени на реальное имя файла
+OUTGOING_OPS_FILE_PATH = "data/" + "2. Исходящие операции.xlsx" # Замени
+INCOMING_OPS_FILE_PATH = "data/" + "3.Входящие операции.xlsx" # Замени
+# DYNAMICS_FILE_PATH = "data/" + "4. Динамика остатков.xlsx" # Пока не используется для этих тегов
+CONTRACTS_FILE_PATH = "data/" + "5. Договора.xlsx" # Замени
+INPUT_FILES = (PRODUCTS_FILE_PATH, OUTGOING_OPS_FILE_PATH, INCOMING_OPS_FILE_PATH, CONTRACTS_FILE_PATH)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Тегирование клиентов МСБ")
+    parser.add_argument("--checkpoint", metavar="PATH",
+                        help="Файл контрольных точек и результатов с отпечатками клиентов "
+                             "(по умолчанию checkpoint.path из config.yaml). Повторный прогон пересчитывает только изменившихся клиентов")
+    parser.add_argument("--no-checkpoint", action="store_true",
+                        help="Не использовать контрольные точки: все результаты в памяти до конца прогона")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Очистить контрольные точки и пересчитать всех клиентов")
+    parser.add_argument("--estimate", action="store_true",
+                        help="Оценить число запросов к LLM и токенов без выполнения запросов и завершиться")
+    parser.add_argument("--batch-prepare", metavar="DIR",
+                        help="Фаза 1 батча: записать запросы к LLM в JSONL-файлы в DIR и завершиться")
+    parser.add_argument("--batch-run-local", nargs=2, metavar=("REQUESTS", "RESULTS_DIR"),
+                        help="Локально выполнить JSONL-запросы батча (файл или директория) и записать результаты в RESULTS_DIR")
+    parser.add_argument("--batch-ingest", nargs="+", metavar="RESULTS",
+                        help="Фаза 2 батча: построить теги по JSONL-результатам (файлы или директории)")
+    parser.add_argument("--batch-retry-dir", metavar="DIR",
+                        help="Куда записать повторные запросы для групп без валидного ответа в батче")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Профилировать прогон через cProfile: статистика в PATH, топ-30 функций по cumulative — в stdout")
+    parser.add_argument("--shard", type=Shard.parse, metavar="I/N",
+                        help="Обработать только шард I из N (клиенты по crc32 от CLI_ID). Контрольные точки, метрики "
+                             "и Parquet результатов шарда пишутся в свои файлы (*.shard-I-of-N), хранилище дашборда — при --merge")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="Запустить N процессов-шардов на этой машине и объединить их результаты")
+    parser.add_argument("--merge", type=int, metavar="N",
+                        help="Объединить результаты N шардов (например, с разных узлов) в итоговый Parquet и хранилище дашборда")
+    parser.add_argument("--run-id", help="Идентификатор прогона в результатах (общий для всех шардов одного прогона)")
+    args = parser.parse_args()
+    batch_mode = args.estimate or args.batch_prepare or args.batch_run_local or args.batch_ingest
+    if (args.shard or args.workers or args.merge) and batch_mode:
+        parser.error("--shard, --workers и --merge не совместимы с --estimate и режимами батча")
+    if args.workers is not None and args.workers < 1 or args.merge is not None and args.merge < 1:
+        parser.error("Число шардов должно быть положительным")
+    return args
+
+
+def save_results(client_tagged_data, results_config=None):
+    print("\n\n--- Итоговые результаты тегирования ---")
+    for client_info in client_tagged_data:
+        print(f"Клиент: {client_info['CLN_NAME']} (CLI_ID: {client_info['CLI_ID']})")
+        print(f"Теги: {', '.join(client_info['TAGS']) if client_info['TAGS'] else 'Нет тегов'}")
+        print("-" * 30)
+
+    # Хранилище для дашборда (app.py): поиск, фильтры и страницы — запросами, без чтения всего файла результатов
+    results_path = (results_config or {}).get("path", DEFAULT_RESULTS_STORE_PATH)
+    try:
+        ResultsStore.write(results_path, client_tagged_data)
+        print(f"Результаты сохранены в хранилище {results_path}")
+    except Exception as e:
+        print(f"Не удалось сохранить результаты в хранилище {results_path}: {e}")
 
-# --- Пример использования ---
-if __name__ == "__main__":
-    # Укажи пути к твоим Excel файлам
-    products_file_path = "data/" + "1. Продукты.xlsx"  # Замени на реальное имя файла
-    outgoing_ops_file_path = "data/" + "2. Исходящие операции.xlsx" # Замени
-    incoming_ops_file_path = "data/" + "3.Входящие операции.xlsx" # Замени
-    # dynamics_file_path = "data/" + "4. Динамика остатков.xlsx" # Пока не используется для этих тегов
-    contracts_file_path = "data/" + "5. Договора.xlsx" # Замени
-    
-    fecth_tags = FetchTags()
-    client_tagged_data = fecth_tags.process_excel_files(
-        products_file_path,
-        outgoing_ops_file_path,
-        incoming_ops_file_path,
-        contracts_file_path
-    )
 
+def load_config(config_path="config.yaml"):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
+
+
+def run_workers(args):
+    """Запускает args.workers процессов pipeline.py --shard I/N и объединяет их результаты."""
+    run_id = args.run_id or new_run_id()
+    passthrough = [flag for flag, enabled in (("--no-checkpoint", args.no_checkpoint), ("--fresh", args.fresh)) if enabled]
+    if args.checkpoint:
+        passthrough += ["--checkpoint", args.checkpoint]
+    # Колоночный кэш исходных файлов строится один раз здесь, иначе шарды одновременно конвертировали бы одни и те же файлы
+    config = load_config()
+    ingest_cache = IngestCache.from_config(config.get("ingest_cache"))
+    chunksize = (config.get("streaming") or {}).get("chunksize", 200000)
+    for path, table in zip(INPUT_FILES, ("products", "operations", "operations", "contracts")):
+        ingest_cache.warm(path, table, chunksize)
+    # Шаблоны операций по той же причине размечаются здесь: шарды получат готовые метки и векторы
+    FetchTags().warm_template_labels(*INPUT_FILES)
+
+    processes = [
+        subprocess.Popen([
+            sys.executable, os.path.abspath(__file__), "--shard", str(Shard(index, args.workers)), "--run-id", run_id, *passthrough
+        ])
+        for index in range(args.workers)
+    ]
+    failed = [index for index, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print(f"Шарды завершились с ошибкой: {failed}. Объединение не выполнено, перезапустите их с --shard I/{args.workers}")
+        sys.exit(1)
+    merge_shards(args.workers, config, run_id)
+
+
+def merge_shards(shard_count, config, run_id=None):
+    """Итоговые результаты из Parquet шардов: порядок клиентов как в таблице продуктов."""
+    output_config = config.get("results_output") or {}
+    parquet_path = output_config.get("parquet_path", DEFAULT_RESULTS_PARQUET_PATH)
+    try:
+        client_order = IngestCache.from_config(config.get("ingest_cache")).read(PRODUCTS_FILE_PATH, "products")["CLI_ID"]
+    except Exception as e:
+        print(f"Не удалось прочитать таблицу продуктов ({e}), результаты упорядочиваются по CLI_ID")
+        client_order = None
+    merged = merge_shard_results(parquet_path, shard_count, client_order)
+    run_id = run_id or read_run_id(shard_path(parquet_path, Shard(0, shard_count)))
+
+    client_tagged_data = [
+        {"CLI_ID": cli_id, "CLN_NAME": name, "TAGS": list(tags)}
+        for cli_id, name, tags in zip(merged["CLI_ID"], merged["CLN_NAME"], merged["TAGS"])
+    ]
+    with ResultsParquetWriter.from_config(output_config, run_id=run_id) as results_writer:
+        for result in client_tagged_data:
+            results_writer.add(result)
     if client_tagged_data:
-        print("\n\n--- Итоговые результаты тегирования ---")
-        for client_info in client_tagged_data:
-            print(f"Клиент: {client_info['CLN_NAME']} (CLI_ID: {client_info['CLI_ID']})")
-            print(f"Теги: {', '.join(client_info['TAGS']) if client_info['TAGS'] else 'Нет тегов'}")
-            print("-" * 30)
-        
-        # Опционально: сохранение результатов в новый Excel или CSV
-        df_results = pd.DataFrame(client_tagged_data)
-        try:
-            df_results.to_csv("client_tags_results_csv.csv", index=False)
-            print("\nРезультаты сохранены в client_tags_results_csv.csv")
-        except Exception as e:
-            print(f"Не удалось сохранить результаты в CSV: {e}")
\ No newline at end of file
+        save_results(client_tagged_data, config.get("results_store"))
+
+
+def use_shard_outputs(config, shard: Shard):
+    """Пути контрольных точек, результатов, метрик и отчета о токенах шарда — отдельные файлы *.shard-I-of-N."""
+    for section, key, default in (
+        ("checkpoint", "path", "checkpoints/client_tags.sqlite"),
+        ("results_output", "parquet_path", DEFAULT_RESULTS_PARQUET_PATH),
+        ("metrics", "path", "metrics/run_metrics"),
+        ("token_budget", "usage_report_path", None),
+        ("llm_scheduler", "dropped_report_path", None),
+    ):
+        section_config = config[section] = config.get(section) or {}
+        path = section_config.get(key, default)
+        if path:
+            section_config[key] = shard_path(path, shard)
+
+
+def run(args):
+    if args.workers:
+        run_workers(args)
+        return
+    if args.merge:
+        merge_shards(args.merge, load_config(), args.run_id)
+        return
+
+    input_files = INPUT_FILES
+
+    fecth_tags = FetchTags()
+    if args.shard:
+        fecth_tags.shard = args.shard
+        use_shard_outputs(fecth_tags.config, args.shard)
+
+    if args.batch_run_local:
+        requests_path, results_dir = args.batch_run_local
+        run_batch_locally(list_jsonl_files(requests_path), results_dir, fecth_tags.client)
+        return
+
+    if args.estimate:
+        fecth_tags.estimate_llm_usage(*input_files)
+        return
+
+    if args.batch_prepare:
+        batch_files = fecth_tags.prepare_llm_batch(*input_files, output_dir=args.batch_prepare)
+        print(f"Файлы запросов батча: {batch_files}")
+        return
+
+    # Типизированный результат прогона (Parquet): пишется группами строк по мере готовности клиентов
+    results_writer = ResultsParquetWriter.from_config(fecth_tags.config.get("results_output"), run_id=args.run_id)
+    try:
+        if args.batch_ingest:
+            client_tagged_data = fecth_tags.ingest_llm_batch(
+                *input_files, result_paths=args.batch_ingest, retry_dir=args.batch_retry_dir
+            )
+            for result in client_tagged_data or []:
+                results_writer.add(result)
+        elif args.no_checkpoint:
+            client_tagged_data = fecth_tags.process_excel_files(*input_files, results_writer=results_writer)
+        else:
+            checkpoint_path = shard_path(args.checkpoint, args.shard) if args.checkpoint and args.shard else args.checkpoint
+            checkpoint = CheckpointStore.from_config(fecth_tags.config.get("checkpoint"), path=checkpoint_path)
+            if args.fresh:
+                checkpoint.clear()
+            try:
+                client_tagged_data = fecth_tags.process_excel_files(
+                    *input_files, checkpoint=checkpoint, results_writer=results_writer
+                )
+            finally:
+                checkpoint.close()
+    except BaseException:
+        results_writer.abort()
+        raise
+
+    if args.shard and client_tagged_data is not None:
+        # Шард без клиентов — тоже результат: при объединении нужен файл каждого шарда
+        results_writer.close()
+        print(f"Шард {args.shard}: клиентов {len(client_tagged_data)}, результаты в {results_writer.path}")
+    elif client_tagged_data:
+        results_writer.close()
+        save_results(client_tagged_data, fecth_tags.config.get("results_store"))
+    else:
+        results_writer.abort() # Результат прошлого прогона не перезаписывается пустым
+        if args.shard:
+            sys.exit(1)
+
+
+def run_profiled(args):
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        print(f"\nПрофиль записан в {args.profile}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+
+
+# --- Пример использования ---
+if __name__ == "__main__":
+    args = parse_args()
+    if args.profile:
+        run_profiled(args)
+    else:
+        run(args)
@@ -0,0 +1,121 @@
+import re
+import threading
+from typing import Optional
+
+from loguru import logger
+
+
+class KeywordPreClassifier:
+    """
+    Детерминированная предклассификация LLM-групп по ключевым словам в описаниях операций.
+
+    Все strong-шаблоны из конфига собираются в одно регулярное выражение с именованными группами,
+    описания клиента просматриваются за один проход. Совпадение со strong-шаблоном поля — True.
+    Группа определяется без LLM, только если strong-признак найден для каждого ее поля (все поля True).
+    Отсутствие ключевых слов не доказывает False (описание «Перечисление ООО Ромашка» — тоже оплата поставщику),
+    поэтому группа, в которой хоть одно поле без strong-совпадения, целиком уходит в LLM.
+    Группа cash определяется как "low", если у клиента нет ни кассовых комиссий, ни операций с признаками наличных,
+    и как "high", если есть кассовые комиссии и доля операций с наличными не меньше cash_high_min_share.
+    """
+
+    def __init__(self, rules: dict, cash_low_without_indicators=True, cash_high_min_share=None):
+        self.rules = rules
+        self.cash_low_without_indicators = cash_low_without_indicators
+        self.cash_high_min_share = cash_high_min_share
+        self._slots = [] # имя группы в регулярке -> (группа тегов, поле)
+        alternatives = []
+        for group, fields in rules.items():
+            for field, field_rules in fields.items():
+                patterns = field_rules.get("strong") or []
+                if not patterns:
+                    continue
+                name = f"k{len(self._slots)}"
+                self._slots.append((group, field))
+                alternatives.append(f"(?P<{name}>{'|'.join(f'(?:{pattern})' for pattern in patterns)})")
+        self._regex = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+        self.clients = 0
+        self.resolved_groups = {}
+        self.requests_planned = 0
+        self.requests_avoided = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, preclassifier_config: Optional[dict]):
+        """Создает классификатор по секции keyword_preclassifier из config.yaml (None, если выключен)."""
+        if not preclassifier_config or not preclassifier_config.get("enabled", False):
+            return None
+        return cls(
+            preclassifier_config.get("rules", {}),
+            cash_low_without_indicators=preclassifier_config.get("cash_low_without_indicators", True),
+            cash_high_min_share=preclassifier_config.get("cash_high_min_share"),
+        )
+
+    def keyword_hits(self, descriptions) -> set:
+        """Множество (группа, поле) со strong-совпадением в описаниях."""
+        if self._regex is None or not descriptions:
+            return set()
+        hits = set()
+        for match in self._regex.finditer("\n".join(descriptions)):
+            hits.add(self._slots[int(match.lastgroup[1:])])
+            if len(hits) == len(self._slots):
+                break
+        return hits
+
+    def resolve(self, evidence, groups) -> dict:
+        """
+        Значения полей для групп, определенных без LLM: {группа: {поле: значение}}.
+        evidence — данные клиента из FetchTags.client_evidence.
+        """
+        resolved = {}
+        descriptions = evidence["descriptions"]
+        hits = self.keyword_hits(descriptions) if descriptions else set()
+        for group in groups:
+            if group == "cash":
+                level = self.resolve_cash_level(evidence)
+                if level is not None:
+                    resolved[group] = {"cash_activity_level": level}
+                continue
+            if group not in self.rules or not descriptions:
+                continue
+            # Схема ответа LLM требует все поля группы: группу с полем без strong-признака целиком решает LLM
+            if all((group, field) in hits for field in self.rules[group]):
+                resolved[group] = dict.fromkeys(self.rules[group], True)
+        return resolved
+
+    def resolve_cash_level(self, evidence) -> Optional[str]:
+        kassa_comis_total = evidence["kassa_comis_total"]
+        has_kassa_comis = bool(kassa_comis_total and kassa_comis_total > 0)
+        cash_operations_count = evidence.get("cash_operations_count", 0)
+        if self.cash_low_without_indicators and not cash_operations_count and not has_kassa_comis:
+            return "low"
+        operations_count = evidence.get("operations_count", 0)
+        if (
+            self.cash_high_min_share is not None
+            and has_kassa_comis
+            and operations_count
+            and cash_operations_count / operations_count >= self.cash_high_min_share
+        ):
+            return "high"
+        return None
+
+    def record(self, resolved_groups, requests_planned, requests_avoided):
+        with self._lock:
+            self.clients += 1
+            for group in resolved_groups:
+                self.resolved_groups[group] = self.resolved_groups.get(group, 0) + 1
+            self.requests_planned += requests_planned
+            self.requests_avoided += requests_avoided
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": self.clients,
+                "resolved_groups": dict(self.resolved_groups),
+                "llm_requests_without_preclassifier": self.requests_planned,
+                "llm_requests_avoided": self.requests_avoided,
+                "avoided_rate": round(self.requests_avoided / self.requests_planned, 4) if self.requests_planned else 0.0,
+            }
+
+    def log_stats(self):
+        logger.info(f"Предклассификация по ключевым словам: {self.stats()}")
@@ -0,0 +1,157 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+from rule_tags import RULE_TAGS
+
+DEFAULT_RESULTS_PARQUET_PATH = "results/client_tags.parquet"
+
+# Теги, которые выставляются по ответам LLM (FetchTags.*_tags_from_response)
+LLM_TAGS = [
+    "payments_to_suppliers",
+    "payments_salary_related",
+    "payments_tax",
+    "cash_operations_high",
+    "cash_operations_low",
+    "ved_active",
+    "ved_absent",
+]
+
+# Булевы колонки тегов в выходном Parquet, в порядке колонок.
+# TAG_SCHEMA_VERSION увеличивается при любом изменении списка, чтобы потребители могли проверить схему
+TAG_SCHEMA = RULE_TAGS + LLM_TAGS
+TAG_SCHEMA_VERSION = 1
+
+
+def new_run_id() -> str:
+    return f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+def optional_text(value) -> Optional[str]:
+    if value is None or (isinstance(value, float) and value != value): # None или NaN из pandas
+        return None
+    return str(value)
+
+
+def results_arrow_schema(run_id: str) -> pa.Schema:
+    fields = [
+        pa.field("run_id", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("tag_schema_version", pa.int16()),
+        pa.field("CLI_ID", pa.string()),
+        pa.field("CLN_NAME", pa.string()),
+        pa.field("TAGS", pa.list_(pa.string())),
+    ]
+    fields.extend(pa.field(tag, pa.bool_()) for tag in TAG_SCHEMA)
+    metadata = {
+        "run_id": run_id,
+        "tag_schema_version": str(TAG_SCHEMA_VERSION),
+        "tag_schema": json.dumps(TAG_SCHEMA),
+    }
+    return pa.schema(fields, metadata=metadata)
+
+
+class ResultsParquetWriter:
+    """
+    Результаты тегирования в Parquet: теги — колонка-список строк и по булевой колонке на тег из TAG_SCHEMA,
+    в каждой строке run_id прогона и версия схемы тегов. Строки пишутся группами по row_group_size
+    по мере поступления результатов, в память попадает только текущая группа.
+    Файл пишется во временный и подменяет path при close, поэтому читатели не видят его частично записанным.
+    """
+
+    def __init__(self, path, run_id=None, row_group_size=10000):
+        self.path = path
+        self.run_id = run_id or new_run_id()
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.schema = results_arrow_schema(self.run_id)
+        self._pending = []
+        self._unknown_tags = set()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._tmp_path = path + ".tmp"
+        self._writer = pq.ParquetWriter(self._tmp_path, self.schema)
+
+    @classmethod
+    def from_config(cls, output_config: Optional[dict], run_id=None):
+        output_config = output_config or {}
+        return cls(
+            output_config.get("parquet_path", DEFAULT_RESULTS_PARQUET_PATH),
+            run_id=run_id,
+            row_group_size=output_config.get("row_group_size", 10000),
+        )
+
+    def add(self, result: dict):
+        """Добавляет результат клиента ({CLI_ID, CLN_NAME, TAGS}); запись — группами строк."""
+        self._pending.append(result)
+        if len(self._pending) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        tag_lists = [[str(tag) for tag in result.get("TAGS") or []] for result in self._pending]
+        tag_sets = [set(tags) for tags in tag_lists]
+        self._unknown_tags.update(tag for tags in tag_sets for tag in tags if tag not in TAG_SCHEMA)
+        columns = {
+            "run_id": pa.array([self.run_id] * len(self._pending)).dictionary_encode(),
+            "tag_schema_version": pa.array([TAG_SCHEMA_VERSION] * len(self._pending), pa.int16()),
+            "CLI_ID": pa.array([str(result["CLI_ID"]) for result in self._pending], pa.string()),
+            "CLN_NAME": pa.array([optional_text(result.get("CLN_NAME")) for result in self._pending], pa.string()),
+            "TAGS": pa.array(tag_lists, pa.list_(pa.string())),
+        }
+        for tag in TAG_SCHEMA:
+            columns[tag] = pa.array([tag in tags for tags in tag_sets], pa.bool_())
+        self._writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+        self.rows += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+        if self._unknown_tags:
+            logger.warning(
+                f"Теги вне схемы v{TAG_SCHEMA_VERSION} (только в колонке TAGS): {sorted(self._unknown_tags)}"
+            )
+        logger.info(f"Результаты прогона {self.run_id} записаны в {self.path}: клиентов {self.rows}")
+
+    def abort(self):
+        """Закрывает и удаляет незавершенный файл: результат прошлого прогона остается на месте."""
+        self._writer.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_results(path, columns=None):
+    """
+    Результаты прогона из Parquet как DataFrame (TAGS — списки, теги схемы — булевы колонки).
+    Предупреждает, если файл записан с другой версией схемы тегов.
+    """
+    import pandas as pd
+    metadata = pq.read_schema(path).metadata or {}
+    version = metadata.get(b"tag_schema_version", b"").decode("utf-8")
+    if version != str(TAG_SCHEMA_VERSION):
+        logger.warning(f"Файл {path} записан со схемой тегов v{version or '?'}, текущая — v{TAG_SCHEMA_VERSION}")
+    return pd.read_parquet(path, columns=columns)
+
+
+def read_run_id(path) -> Optional[str]:
+    """run_id из метаданных Parquet результатов (None, если его там нет)."""
+    run_id = (pq.read_schema(path).metadata or {}).get(b"run_id")
+    return run_id.decode("utf-8") if run_id else None
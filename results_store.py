@@ -0,0 +1,171 @@
+import ast
+import json
+import os
+import sqlite3
+from typing import Iterable, Optional
+
+import pandas as pd
+from loguru import logger
+
+DEFAULT_RESULTS_STORE_PATH = "results/client_tags.sqlite"
+
+
+def parse_tags_value(value) -> list:
+    """Список тегов из значения колонки TAGS: список, строка-список "['a', 'b']" или строка "a, b"."""
+    if isinstance(value, (list, tuple)):
+        return [str(tag) for tag in value]
+    if not isinstance(value, str) or not value.strip():
+        return []
+    text = value.strip()
+    if text.startswith('[') and text.endswith(']'):
+        try:
+            parsed = ast.literal_eval(text)
+            if isinstance(parsed, (list, tuple)):
+                return [str(tag) for tag in parsed]
+        except (ValueError, SyntaxError):
+            text = text[1:-1]
+    return [tag.strip().strip("'\"") for tag in text.split(',') if tag.strip()]
+
+
+class ResultsStore:
+    """
+    Результаты тегирования для дашборда в SQLite.
+
+    clients — строка на клиента (теги в JSON для отображения), client_tags — инвертированный индекс
+    (тег → клиенты) с первичным ключом (tag_id, row_id). Поиск по наименованию, фильтр «все выбранные теги»,
+    число клиентов по тегам и страница результатов считаются запросами; в память попадает только страница.
+    Хранилище перезаписывается целиком (write) через временный файл, читатели не видят его частично записанным.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Только чтение: запись — через write, которая подменяет файл
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+    @classmethod
+    def from_config(cls, results_config: Optional[dict]):
+        return cls((results_config or {}).get("path", DEFAULT_RESULTS_STORE_PATH))
+
+    @staticmethod
+    def write(path, results: Iterable[dict], batch_size=10000):
+        """Записывает результаты ({CLI_ID, CLN_NAME, TAGS}) в новое хранилище по пути path."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE clients ("
+                " row_id INTEGER PRIMARY KEY,"
+                " cli_id TEXT NOT NULL,"
+                " cln_name TEXT,"
+                " cln_name_lower TEXT,"
+                " tags TEXT NOT NULL)"
+            )
+            conn.execute("CREATE TABLE tags (tag_id INTEGER PRIMARY KEY, tag TEXT NOT NULL UNIQUE)")
+            conn.execute(
+                "CREATE TABLE client_tags (tag_id INTEGER NOT NULL, row_id INTEGER NOT NULL,"
+                " PRIMARY KEY (tag_id, row_id)) WITHOUT ROWID"
+            )
+            tag_ids = {}
+            client_rows, tag_rows = [], []
+            clients = 0
+
+            def flush():
+                conn.executemany("INSERT INTO clients VALUES (?, ?, ?, ?, ?)", client_rows)
+                conn.executemany("INSERT OR IGNORE INTO client_tags VALUES (?, ?)", tag_rows)
+                client_rows.clear()
+                tag_rows.clear()
+
+            for row_id, result in enumerate(results):
+                name = result.get("CLN_NAME")
+                name = None if pd.isna(name) else str(name)
+                tags = [str(tag) for tag in result.get("TAGS") or []]
+                client_rows.append((
+                    row_id, str(result["CLI_ID"]), name, name.lower() if name else None, json.dumps(tags, ensure_ascii=False)
+                ))
+                for tag in tags:
+                    if tag not in tag_ids:
+                        tag_ids[tag] = len(tag_ids)
+                    tag_rows.append((tag_ids[tag], row_id))
+                clients += 1
+                if len(client_rows) >= batch_size:
+                    flush()
+            flush()
+            conn.executemany("INSERT INTO tags VALUES (?, ?)", [(tag_id, tag) for tag, tag_id in tag_ids.items()])
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+        logger.info(f"Результаты записаны в хранилище {path}: клиентов {clients}, тегов {len(tag_ids)}")
+
+    @classmethod
+    def import_csv(cls, csv_path, path):
+        """Строит хранилище из CSV результатов прошлых прогонов (TAGS — строка-список)."""
+        df = pd.read_csv(csv_path)
+        cls.write(path, (
+            {"CLI_ID": cli_id, "CLN_NAME": name, "TAGS": parse_tags_value(tags)}
+            for cli_id, name, tags in zip(df["CLI_ID"], df["CLN_NAME"], df["TAGS"])
+        ))
+
+    @classmethod
+    def import_parquet(cls, parquet_path, path, batch_size=10000):
+        """Строит хранилище из Parquet результатов pipeline.py (TAGS — колонка-список, без разбора строк)."""
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(parquet_path)
+
+        def iter_results():
+            for batch in parquet_file.iter_batches(batch_size=batch_size, columns=["CLI_ID", "CLN_NAME", "TAGS"]):
+                yield from batch.to_pylist()
+
+        cls.write(path, iter_results(), batch_size=batch_size)
+
+    def _where(self, name=None, tags=()) -> tuple:
+        clauses, params = [], []
+        if name:
+            # instr по строке в нижнем регистре: LIKE в SQLite не учитывает регистр только для латиницы
+            clauses.append("instr(c.cln_name_lower, ?) > 0")
+            params.append(name.lower())
+        for tag in tags:
+            clauses.append(
+                "c.row_id IN (SELECT ct.row_id FROM client_tags ct JOIN tags t ON t.tag_id = ct.tag_id WHERE t.tag = ?)"
+            )
+            params.append(tag)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def tags(self) -> list:
+        return [row[0] for row in self._conn.execute("SELECT tag FROM tags ORDER BY tag")]
+
+    def count(self, name=None, tags=()) -> int:
+        where, params = self._where(name, tags)
+        return self._conn.execute(f"SELECT COUNT(*) FROM clients c{where}", params).fetchone()[0]
+
+    def tag_counts(self, name=None, tags=()) -> pd.Series:
+        """Число клиентов по тегам среди отфильтрованных, по убыванию."""
+        where, params = self._where(name, tags)
+        filtered = f" WHERE ct.row_id IN (SELECT c.row_id FROM clients c{where})" if where else ""
+        rows = self._conn.execute(
+            "SELECT t.tag, COUNT(*) AS clients FROM client_tags ct JOIN tags t ON t.tag_id = ct.tag_id"
+            f"{filtered} GROUP BY ct.tag_id ORDER BY clients DESC, t.tag",
+            params,
+        ).fetchall()
+        return pd.Series([count for _, count in rows], index=[tag for tag, _ in rows], dtype="int64")
+
+    def page(self, name=None, tags=(), limit=100, offset=0) -> pd.DataFrame:
+        """Страница отфильтрованных клиентов в порядке записи: CLI_ID, CLN_NAME, TAGS (список)."""
+        where, params = self._where(name, tags)
+        rows = self._conn.execute(
+            f"SELECT c.cli_id, c.cln_name, c.tags FROM clients c{where} ORDER BY c.row_id LIMIT ? OFFSET ?",
+            [*params, limit, offset],
+        ).fetchall()
+        return pd.DataFrame(
+            [(cli_id, name, json.loads(tags)) for cli_id, name, tags in rows], columns=["CLI_ID", "CLN_NAME", "TAGS"]
+        )
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,124 @@
+from datetime import date
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Теги, которые определяются правилами по таблицам продуктов и договоров (без LLM), в порядке колонок матрицы
+RULE_TAGS = [
+    "company_size_micro",
+    "company_size_small",
+    "company_size_medium",
+    "company_age_new",
+    "company_age_established",
+    "geo_moscow_smb",
+    "geo_region_smb",
+    "acquiring_user_active",
+    "acquiring_absent_or_low",
+    "salary_project_user",
+    "debt_load_present",
+    "debt_load_absent",
+    "loyalty_long_term_client_smb",
+]
+
+TRUE_FLAG_VALUES = ['да', 'yes', 'true']
+CREDIT_CONTRACT_PATTERN = 'кредит|credit|loan'
+
+
+def parse_boolean_flag(value) -> bool:
+    """
+    Значение флага (1.00, 0.00, " 1 ", "да", "нет") как bool: пропуск — False, число — не ноль,
+    строка — слово из TRUE_FLAG_VALUES или число, не равное нулю (пробелы по краям и регистр не важны).
+    """
+    if pd.isna(value):
+        return False
+    if isinstance(value, (bool, int, float, np.number)):
+        return bool(value)
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in TRUE_FLAG_VALUES:
+            return True
+        number = pd.to_numeric(text, errors="coerce")
+        return bool(number) if not pd.isna(number) else False
+    return False
+
+
+def parse_boolean_flags(series: pd.Series) -> pd.Series:
+    """Векторный аналог parse_boolean_flag для колонки флагов (в том числе со значениями разных типов)."""
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return series.fillna(0).astype(bool)
+    text = series.astype("string").str.strip().str.lower()
+    numbers = pd.to_numeric(text, errors="coerce")
+    return (text.isin(TRUE_FLAG_VALUES).fillna(False) | numbers.fillna(0).ne(0)).astype(bool)
+
+
+def parse_dates(series: pd.Series) -> pd.Series:
+    """Векторный аналог FetchTags.parse_date_value: даты без времени (NaT, если не распознаны)."""
+    if not pd.api.types.is_datetime64_any_dtype(series):
+        series = pd.to_datetime(series, errors='coerce', format='mixed')
+    return series.dt.normalize()
+
+
+def contains_any(series: pd.Series, substrings) -> pd.Series:
+    mask = pd.Series(False, index=series.index)
+    for substring in substrings:
+        mask |= series.str.contains(substring, regex=False).fillna(False).astype(bool)
+    return mask
+
+
+def credit_clients(df_contracts: Optional[pd.DataFrame]) -> set:
+    """CLI_ID клиентов, у которых есть кредитный договор (по CON_TYPE)."""
+    if df_contracts is None or df_contracts.empty or 'CON_TYPE' not in df_contracts:
+        return set()
+    is_credit = df_contracts['CON_TYPE'].astype(str).str.lower().str.contains(CREDIT_CONTRACT_PATTERN)
+    has_credit = is_credit.groupby(df_contracts['CLI_ID'], sort=False).any()
+    return set(has_credit.index[has_credit.to_numpy()])
+
+
+def build_rule_tag_matrix(df_products: pd.DataFrame, df_contracts: Optional[pd.DataFrame] = None, today: date = None) -> pd.DataFrame:
+    """
+    Булева матрица «клиент × тег» для всех правил сразу (колонки — RULE_TAGS, индекс как у df_products).
+    Повторяет логику get_company_size_tags, get_company_age_tags, get_geo_tags, get_acquiring_tags,
+    get_salary_project_tag, get_debt_load_tags и get_loyalty_tags, но по всей таблице.
+    """
+    today = today or date.today()
+    empty = pd.Series([pd.NA] * len(df_products), index=df_products.index, dtype="string")
+    column = lambda name: df_products[name] if name in df_products else empty
+    matrix = pd.DataFrame(False, index=df_products.index, columns=RULE_TAGS)
+
+    staff_group = column("STAFF_GROUP").astype("string").str.lower()
+    is_micro = contains_any(staff_group, ["1-24", "до 15", "микро"])
+    is_small = ~is_micro & contains_any(staff_group, ["25-100", "16-100", "малое"])
+    is_medium = ~is_micro & ~is_small & contains_any(staff_group, ["101-250", "среднее"])
+    matrix["company_size_micro"] = is_micro
+    matrix["company_size_small"] = is_small
+    matrix["company_size_medium"] = is_medium
+
+    bank_open = parse_dates(column("DT_BANK_OPEN"))
+    age_years = (pd.Timestamp(today) - bank_open).dt.days / 365.25
+    matrix["company_age_new"] = (age_years < 3).fillna(False).astype(bool)
+    matrix["company_age_established"] = (age_years >= 3).fillna(False).astype(bool)
+    matrix["loyalty_long_term_client_smb"] = matrix["company_age_established"]
+
+    city = column("CITY")
+    is_moscow = city.astype("string").str.lower().str.contains("москва", regex=False).fillna(False).astype(bool)
+    matrix["geo_moscow_smb"] = city.notna() & is_moscow
+    matrix["geo_region_smb"] = city.notna() & ~is_moscow
+
+    is_acquiring = parse_boolean_flags(column("IS_ACQ"))
+    matrix["acquiring_user_active"] = is_acquiring
+    matrix["acquiring_absent_or_low"] = ~is_acquiring
+
+    matrix["salary_project_user"] = parse_boolean_flags(column("IS_SAL"))
+
+    has_credit = parse_boolean_flags(column("IS_CREDIT")) | df_products['CLI_ID'].isin(credit_clients(df_contracts))
+    matrix["debt_load_present"] = has_credit
+    matrix["debt_load_absent"] = ~has_credit
+
+    return matrix
+
+
+def rule_tag_lists(matrix: pd.DataFrame) -> list:
+    """Списки тегов по строкам матрицы (в порядке строк)."""
+    tag_names = np.array(matrix.columns, dtype=object)
+    return [tag_names[row].tolist() for row in matrix.to_numpy(dtype=bool)]
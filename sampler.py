@@ -0,0 +1,83 @@
+import math
+import re
+
+# Порядок важен: сначала длинные идентификаторы и даты, потом суммы и остальные числа
+NORMALIZATION_PATTERNS = [
+    (re.compile(r"\b\d{20,25}\b"), "<счет>"), # номера счетов
+    (re.compile(r"\b\d{1,4}[./-]\d{1,2}[./-]\d{1,4}(?:\s*г\.?)?"), "<дата>"),
+    (re.compile(r"\b\d{1,3}(?:[  ]\d{3})+(?:[.,-]\d{1,2})?\b|\b\d+[.,-]\d{2}\b"), "<сумма>"),
+    (re.compile(r"\d+"), "#"),
+]
+WHITESPACE_PATTERN = re.compile(r"\s+")
+WORD_PATTERN = re.compile(r"[^\W\d_]{3,}")
+
+
+def normalize_description(description: str) -> str:
+    """Шаблон описания операции: номера счетов, даты, суммы и прочие числа заменены метками."""
+    text = str(description)
+    for pattern, placeholder in NORMALIZATION_PATTERNS:
+        text = pattern.sub(placeholder, text)
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (для кириллицы ~3 символа на токен)."""
+    return len(text) // 3 + 1
+
+
+def collapse_descriptions(descriptions) -> list:
+    """Схлопывает описания с одинаковым шаблоном: [(шаблон, число повторов)] в порядке первого появления."""
+    counts = {}
+    templates = {}
+    for description in descriptions:
+        template = normalize_description(description)
+        if not template:
+            continue
+        key = template.lower()
+        if key not in counts:
+            templates[key] = template
+            counts[key] = 0
+        counts[key] += 1
+    return [(templates[key], count) for key, count in counts.items()]
+
+
+def format_sample_line(template: str, count: int) -> str:
+    return f"{template} (×{count})" if count > 1 else template
+
+
+def representative_sample(descriptions, max_items=20, max_tokens=None, token_counter=estimate_tokens) -> list:
+    """
+    Разнообразная выборка шаблонов операций клиента в пределах max_items строк и max_tokens токенов.
+
+    Описания нормализуются и схлопываются с подсчетом повторов, затем шаблоны выбираются жадно:
+    первым — самый частый, дальше — шаблон с наибольшей долей еще не встречавшихся слов
+    (при равенстве — более частый). Так редкие сигналы (зарплата, валюта) не вытесняются десятками
+    одинаковых «Оплата по счету №…». Возвращает строки вида «шаблон (×N)».
+    token_counter — функция подсчета токенов строки (по умолчанию грубая оценка по длине).
+    """
+    candidates = [
+        (template, count, set(WORD_PATTERN.findall(template.lower())))
+        for template, count in collapse_descriptions(descriptions)
+    ]
+    candidates.sort(key=lambda candidate: -candidate[1])
+
+    sample = []
+    covered_words = set()
+    tokens_used = 0
+    while candidates and len(sample) < max_items:
+        best_index = 0 if not sample else max(
+            range(len(candidates)),
+            key=lambda i: (
+                len(candidates[i][2] - covered_words) / (len(candidates[i][2]) + 1) + 0.01 * math.log1p(candidates[i][1]),
+                -i,
+            ),
+        )
+        template, count, words = candidates.pop(best_index)
+        line = format_sample_line(template, count)
+        line_tokens = token_counter(line)
+        if max_tokens is not None and sample and tokens_used + line_tokens > max_tokens:
+            break # первая строка берется всегда, дальше — пока хватает бюджета
+        sample.append(line)
+        covered_words |= words
+        tokens_used += line_tokens
+    return sample
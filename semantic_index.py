@@ -0,0 +1,222 @@
+import json
+import os
+import re
+import uuid
+import zlib
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from template_store import TEMPLATE_LABEL_FIELDS, template_key
+
+WORD_PATTERN = re.compile(r"[^\W_]+|<[^>]+>")
+
+
+class HashingEncoder:
+    """
+    Локальный векторизатор без обучения и сети: символьные n-граммы внутри слов и сами слова
+    хэшируются (crc32 со знаком) в n_features измерений, вектор нормируется по L2.
+    Близкие по написанию описания («оплата налога усн», «уплата налога по усн») получают близкие векторы.
+    """
+
+    def __init__(self, n_features=1024, ngram_range=(3, 5)):
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+
+    def params(self) -> dict:
+        return {"n_features": self.n_features, "ngram_range": list(self.ngram_range)}
+
+    def features(self, text: str):
+        """Хэши признаков текста: слова целиком и символьные n-граммы слов с границами."""
+        min_n, max_n = self.ngram_range
+        for word in WORD_PATTERN.findall(text.lower()):
+            yield zlib.crc32(f"w:{word}".encode("utf-8"))
+            padded = f" {word} "
+            for n in range(min_n, max_n + 1):
+                for start in range(max(len(padded) - n + 1, 1)):
+                    yield zlib.crc32(padded[start:start + n].encode("utf-8"))
+
+    def encode(self, texts) -> np.ndarray:
+        """Матрица float32 (len(texts) × n_features) с нормированными строками."""
+        matrix = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature_hash in self.features(text):
+                rows.append(row)
+                columns.append(feature_hash % self.n_features)
+                signs.append(1.0 if feature_hash & 0x80000000 else -1.0)
+        if rows:
+            np.add.at(matrix, (np.asarray(rows), np.asarray(columns)), np.asarray(signs, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+class TemplateVectorStore:
+    """
+    Векторы шаблонов операций на диске: матрица .npy (float32 или int8), открываемая через memmap,
+    и список ключей шаблонов в порядке строк. Новые шаблоны дописываются, уже закодированные
+    повторно не кодируются. При смене параметров кодировщика или типа матрица строится заново.
+
+    Список ключей (template_keys.json) ссылается на файл матрицы по имени. Дописывание пишет новую матрицу
+    в файл с уникальным именем и атомарно подменяет список ключей, поэтому ключи и матрица всегда согласованы,
+    даже если кэш одновременно дописывают несколько процессов (последний записавший побеждает).
+    """
+
+    def __init__(self, cache_dir, encoder: HashingEncoder, dtype="float32"):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Неподдерживаемый тип векторов '{dtype}', ожидается float32 или int8")
+        self.cache_dir = cache_dir
+        self.encoder = encoder
+        self.dtype = dtype
+        self.vectors_path = os.path.join(cache_dir, "template_vectors.npy") # кэши без vectors_file в списке ключей
+        self.keys_path = os.path.join(cache_dir, "template_keys.json")
+        self.keys = []
+        self.rows = {}
+        self.matrix = None
+        self._load()
+
+    def meta(self) -> dict:
+        return {"encoder": self.encoder.params(), "dtype": self.dtype}
+
+    def _load(self):
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        if stored.get("meta") != self.meta():
+            logger.info("Параметры векторизатора изменились, векторы шаблонов будут построены заново")
+            return
+        vectors_path = os.path.join(self.cache_dir, stored["vectors_file"]) if stored.get("vectors_file") else self.vectors_path
+        try:
+            matrix = np.load(vectors_path, mmap_mode="r")
+        except FileNotFoundError: # матрицу успел заменить другой процесс — при следующем ensure список перечитается
+            return
+        self.vectors_path = vectors_path
+        self.keys = stored["keys"]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.matrix = matrix
+
+    def quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return np.round(vectors * 127).astype(np.int8)
+        return vectors
+
+    def dequantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return vectors.astype(np.float32) / 127
+        return np.asarray(vectors, dtype=np.float32)
+
+    def ensure(self, keys, batch_size=10000) -> np.ndarray:
+        """Номера строк матрицы для шаблонов keys; недостающие шаблоны кодируются и дописываются на диск."""
+        if any(key not in self.rows for key in keys):
+            self._load() # другие процессы могли дописать шаблоны
+        new_keys = list(dict.fromkeys(key for key in keys if key not in self.rows))
+        if new_keys:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            old_rows = len(self.keys)
+            vectors_file = f"template_vectors-{uuid.uuid4().hex[:12]}.npy"
+            vectors_path = os.path.join(self.cache_dir, vectors_file)
+            matrix = np.lib.format.open_memmap(
+                vectors_path, mode="w+", dtype=np.dtype(self.dtype), shape=(old_rows + len(new_keys), self.encoder.n_features)
+            )
+            for start in range(0, old_rows, batch_size):
+                end = min(start + batch_size, old_rows)
+                matrix[start:end] = self.matrix[start:end]
+            for start in range(0, len(new_keys), batch_size):
+                chunk = new_keys[start:start + batch_size]
+                matrix[old_rows + start:old_rows + start + len(chunk)] = self.quantize(self.encoder.encode(chunk))
+            matrix.flush()
+            del matrix
+            keys = self.keys + new_keys
+            tmp_keys_path = f"{self.keys_path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            with open(tmp_keys_path, "w", encoding="utf-8") as f:
+                json.dump({"meta": self.meta(), "keys": keys, "vectors_file": vectors_file}, f, ensure_ascii=False)
+            os.replace(tmp_keys_path, self.keys_path)
+            previous_path = self.vectors_path
+            self.matrix = None
+            self.vectors_path = vectors_path
+            self.keys = keys
+            self.rows.update((key, old_rows + i) for i, key in enumerate(new_keys))
+            self.matrix = np.load(self.vectors_path, mmap_mode="r")
+            if previous_path != vectors_path and os.path.exists(previous_path):
+                try:
+                    os.remove(previous_path) # открытые другими процессами memmap продолжают работать
+                except OSError:
+                    pass
+            logger.info(f"Закодировано новых шаблонов: {len(new_keys)}, всего векторов: {len(self.keys)}")
+        return np.fromiter((self.rows[key] for key in keys), dtype=np.int64, count=len(keys))
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        return self.dequantize(self.matrix[rows])
+
+
+class ExemplarIndex:
+    """Индекс ближайших соседей по небольшому набору размеченных примеров (косинусная близость, полный перебор)."""
+
+    def __init__(self, exemplars, encoder: HashingEncoder):
+        if not exemplars:
+            raise ValueError("В semantic_index не заданы размеченные примеры (exemplars)")
+        self.texts = [exemplar["text"] for exemplar in exemplars]
+        self.labels = [set(exemplar.get("labels") or []) for exemplar in exemplars]
+        unknown = set().union(*self.labels) - set(TEMPLATE_LABEL_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные метки в примерах semantic_index: {sorted(unknown)}")
+        self.matrix = encoder.encode([template_key(text) for text in self.texts])
+
+    def search(self, vectors: np.ndarray):
+        """Для каждой строки vectors — номер ближайшего примера и косинусная близость к нему."""
+        similarities = vectors @ self.matrix.T
+        best = similarities.argmax(axis=1)
+        return best, similarities[np.arange(len(best)), best]
+
+
+class SemanticTagger:
+    """
+    Разметка шаблонов операций по ближайшему размеченному примеру без обращения к LLM.
+    Шаблоны с близостью ниже min_similarity считаются выбросами и остаются за LLM.
+    """
+
+    def __init__(self, exemplars, cache_dir=".cache/semantic", n_features=1024, dtype="float32",
+                 min_similarity=0.6, batch_size=8192):
+        self.encoder = HashingEncoder(n_features=n_features)
+        self.index = ExemplarIndex(exemplars, self.encoder)
+        self.store = TemplateVectorStore(cache_dir, self.encoder, dtype=dtype)
+        self.min_similarity = min_similarity
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_config(cls, semantic_config: Optional[dict]):
+        """Создает разметчик по секции semantic_index из config.yaml (None, если выключен)."""
+        if not semantic_config or not semantic_config.get("enabled", False):
+            return None
+        return cls(
+            semantic_config.get("exemplars", []),
+            cache_dir=semantic_config.get("cache_dir", ".cache/semantic"),
+            n_features=semantic_config.get("n_features", 1024),
+            dtype=semantic_config.get("dtype", "float32"),
+            min_similarity=semantic_config.get("min_similarity", 0.6),
+        )
+
+    def label_templates(self, templates):
+        """
+        Метки шаблонов по ближайшему примеру. Возвращает ({шаблон: {поле: bool}}, выбросы).
+        Поиск идет пачками по batch_size строк матрицы, вся матрица в память не загружается.
+        """
+        rows = self.store.ensure(templates)
+        template_labels = {}
+        outliers = []
+        for start in range(0, len(templates), self.batch_size):
+            best, similarity = self.index.search(self.store.vectors(rows[start:start + self.batch_size]))
+            for template, exemplar, score in zip(templates[start:start + self.batch_size], best, similarity):
+                if score < self.min_similarity:
+                    outliers.append(template)
+                    continue
+                labels = self.index.labels[exemplar]
+                template_labels[template] = {field: field in labels for field in TEMPLATE_LABEL_FIELDS}
+        logger.info(
+            f"Семантическая разметка шаблонов: по примерам {len(template_labels)}, "
+            f"выбросов (близость < {self.min_similarity}) {len(outliers)}"
+        )
+        return template_labels, outliers
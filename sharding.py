@@ -0,0 +1,85 @@
+import os
+import zlib
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from client_index import normalize_cli_id
+
+
+class Shard(NamedTuple):
+    """Шард прогона: клиенты, у которых stable_hash(CLI_ID) % count == index."""
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """Шард из строки вида «I/N» (I от 0 до N-1)."""
+        try:
+            index, count = (int(part) for part in str(value).split("/"))
+        except ValueError:
+            raise ValueError(f"Шард '{value}' должен иметь вид I/N, например 0/4") from None
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Номер шарда {index} вне диапазона 0..{count - 1}")
+        return cls(index, count)
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+def shard_numbers(cli_ids: pd.Series, shard_count: int) -> np.ndarray:
+    """
+    Номер шарда для каждого CLI_ID: crc32 нормализованного идентификатора по модулю shard_count.
+    Не зависит от процесса, порядка строк и PYTHONHASHSEED, поэтому одинаков на всех узлах.
+    """
+    hashes = np.fromiter(
+        (zlib.crc32(cli_id.encode("utf-8")) for cli_id in normalize_cli_id(cli_ids)), dtype=np.int64, count=len(cli_ids)
+    )
+    return hashes % shard_count
+
+
+def in_shard(df: pd.DataFrame, shard: Shard, key: str = "CLI_ID") -> pd.DataFrame:
+    """Строки таблицы, относящиеся к шарду (индекс сбрасывается)."""
+    if shard.count == 1:
+        return df
+    return df[shard_numbers(df[key], shard.count) == shard.index].reset_index(drop=True)
+
+
+def shard_path(path, shard: Shard) -> str:
+    """Путь выходного файла шарда: results/client_tags.parquet -> results/client_tags.shard-0-of-4.parquet."""
+    base, extension = os.path.splitext(path)
+    return f"{base}.shard-{shard.index}-of-{shard.count}{extension}"
+
+
+def merge_shard_results(parquet_path, shard_count, client_order=None) -> pd.DataFrame:
+    """
+    Объединяет Parquet-результаты шардов в один DataFrame (CLI_ID, CLN_NAME, TAGS).
+    Порядок детерминирован: как в client_order (CLI_ID таблицы продуктов), иначе по CLI_ID.
+    Если клиент встречается в нескольких шардах (шарды считались с разным числом), берется результат шарда с большим номером.
+    """
+    frames = []
+    missing = []
+    for index in range(shard_count):
+        path = shard_path(parquet_path, Shard(index, shard_count))
+        if not os.path.exists(path):
+            missing.append(path)
+            continue
+        frames.append(pd.read_parquet(path, columns=["CLI_ID", "CLN_NAME", "TAGS"]))
+    if missing:
+        raise FileNotFoundError(f"Нет результатов шардов: {missing}")
+
+    merged = pd.concat(frames, ignore_index=True).drop_duplicates("CLI_ID", keep="last")
+    if client_order is not None:
+        order = pd.Index(normalize_cli_id(pd.Series(client_order)).drop_duplicates())
+        positions = order.get_indexer(merged["CLI_ID"])
+        unknown = int((positions < 0).sum())
+        if unknown:
+            logger.warning(f"Клиентов в результатах шардов, которых нет в таблице продуктов: {unknown} (в конце)")
+        positions = np.where(positions < 0, len(order), positions)
+        merged = merged.assign(_position=positions).sort_values(["_position", "CLI_ID"], kind="stable")
+        merged = merged.drop(columns="_position")
+    else:
+        merged = merged.sort_values("CLI_ID", kind="stable")
+    return merged.reset_index(drop=True)
@@ -0,0 +1,208 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+# Готовые масштабы портфеля для бенчмарков
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+
+# Имена файлов как в data/ (pipeline.py), расширение зависит от формата
+FILE_STEMS = {
+    "products": "1. Продукты",
+    "outgoing": "2. Исходящие операции",
+    "incoming": "3.Входящие операции",
+    "contracts": "5. Договора",
+}
+
+# Шаблоны описаний операций и их относительные частоты: частые «оплата по счету» и редкие сигналы
+# (зарплата, налоги, наличные, ВЭД), как в реальных выписках. {n} — номер, {d} — дата, {a} — сумма, {acc} — счет
+OUTGOING_TEMPLATES = [
+    ("Оплата по счету №{n} от {d} за товары. Сумма {a}, в т.ч. НДС", 30),
+    ("Оплата по договору поставки №{n} от {d}", 15),
+    ("Оплата за услуги связи по счету {n}", 6),
+    ("Арендная плата за помещение по договору {n} за {d}", 5),
+    ("Перечисление заработной платы за {d} по реестру №{n}", 6),
+    ("Аванс по зарплате сотрудникам, реестр {n}", 3),
+    ("Уплата налога УСН за {d}", 4),
+    ("Страховые взносы на ОПС за {d}", 3),
+    ("НДФЛ с заработной платы за {d}", 2),
+    ("Выдача наличных на хоз. нужды, чек {n}", 3),
+    ("Комиссия за снятие наличных по карте {n}", 2),
+    ("Оплата по контракту №{n} SWIFT USD {a}", 1),
+    ("Перевод валюты по инвойсу {n}, паспорт сделки {d}", 1),
+    ("Возврат займа по договору {n} от {d}", 2),
+    ("Перевод собственных средств на счет {acc}", 3),
+    ("Комиссия банка за ведение счета за {d}", 4),
+]
+INCOMING_TEMPLATES = [
+    ("Оплата по счету №{n} от {d} за продукцию", 35),
+    ("Поступление выручки по эквайрингу за {d}", 10),
+    ("Взнос наличных через банкомат {n}", 4),
+    ("Поступление по контракту №{n} из-за рубежа, EUR {a}", 1),
+    ("Возврат излишне уплаченного налога за {d}", 1),
+    ("Предоставление займа по договору {n}", 2),
+    ("Перевод собственных средств со счета {acc}", 3),
+]
+
+STAFF_GROUPS = ["1-24", "25-100", "101-250", "251-1000", None]
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург", "Краснодар"]
+CONTRACT_TYPES = ["Кредит", "Кредитная линия", "Овердрафт", "РКО", "Депозит", "Эквайринг", "Зарплатный проект"]
+
+
+def client_ids(start, count) -> np.ndarray:
+    return np.arange(1_000_000 + start, 1_000_000 + start + count, dtype=np.int64)
+
+
+def generate_products(start, count, rng) -> pd.DataFrame:
+    """Таблица «Продукты» для клиентов с номерами [start, start + count)."""
+    ids = client_ids(start, count)
+    open_days = rng.integers(0, 15 * 365, size=count)
+    open_dates = (pd.Timestamp("2025-01-01") - pd.to_timedelta(open_days, unit="D")).strftime("%Y-%m-%d")
+    flag = lambda share: np.where(rng.random(count) < share, 1.0, 0.0)
+    return pd.DataFrame({
+        "CLI_ID": ids.astype(np.float64), # в выгрузках CLI_ID приходит числом с плавающей точкой
+        "CLN_NAME": [f"ООО Клиент {cli_id}" for cli_id in ids],
+        "STAFF_GROUP": rng.choice(np.array(STAFF_GROUPS, dtype=object), size=count, p=[0.55, 0.25, 0.1, 0.05, 0.05]),
+        "DT_BANK_OPEN": np.where(rng.random(count) < 0.02, None, np.asarray(open_dates, dtype=object)),
+        "CITY": rng.choice(np.array(CITIES, dtype=object), size=count),
+        "IS_VED": flag(0.08),
+        "IS_ACQ": flag(0.3),
+        "IS_CREDIT": flag(0.2),
+        "IS_SAL": flag(0.25),
+        "KASSA_COMIS": np.where(rng.random(count) < 0.15, np.round(rng.gamma(2.0, 500.0, size=count), 2), 0.0),
+    })
+
+
+def render_descriptions(templates, size, rng) -> np.ndarray:
+    """Описания операций: шаблон по частотам и случайные номера, даты, суммы и счета."""
+    weights = np.array([weight for _, weight in templates], dtype=np.float64)
+    chosen = rng.choice(len(templates), size=size, p=weights / weights.sum())
+    numbers = rng.integers(1, 99_999, size=size)
+    days = rng.integers(1, 29, size=size)
+    months = rng.integers(1, 13, size=size)
+    amounts = np.round(rng.lognormal(10, 1.5, size=size), 2)
+    accounts = rng.integers(10**15, 10**16, size=size) # 16 цифр после «4070» — 20-значный счет
+    return np.array([
+        templates[template_index][0].format(
+            n=numbers[i], d=f"{days[i]:02d}.{months[i]:02d}.2024", a=f"{amounts[i]:.2f}", acc=f"4070{accounts[i]}"
+        )
+        for i, template_index in enumerate(chosen)
+    ], dtype=object)
+
+
+def generate_operations(start, count, rng, templates, mean_operations) -> pd.DataFrame:
+    """Операции клиентов [start, start + count): число операций на клиента — с длинным хвостом (лог-нормальное)."""
+    ids = client_ids(start, count)
+    sigma = 1.0
+    per_client = rng.lognormal(np.log(max(mean_operations, 1)) - sigma ** 2 / 2, sigma, size=count).astype(np.int64)
+    per_client[rng.random(count) < 0.03] = 0 # клиенты без операций
+    total = int(per_client.sum())
+    days = rng.integers(1, 29, size=total)
+    months = rng.integers(1, 13, size=total)
+    return pd.DataFrame({
+        "CLI_ID": np.repeat(ids, per_client).astype(np.float64),
+        "ENTRY_DESCR": render_descriptions(templates, total, rng),
+        "DT_ENTRY": [f"{day:02d}.{month:02d}.2024" for day, month in zip(days, months)],
+        "AMOUNT": np.round(rng.lognormal(10, 1.5, size=total), 2),
+    })
+
+
+def generate_contracts(start, count, rng) -> pd.DataFrame:
+    ids = client_ids(start, count)
+    per_client = rng.poisson(1.2, size=count)
+    total = int(per_client.sum())
+    return pd.DataFrame({
+        "CLI_ID": np.repeat(ids, per_client).astype(np.float64),
+        "CON_TYPE": rng.choice(np.array(CONTRACT_TYPES, dtype=object), size=total),
+    })
+
+
+class TableWriter:
+    """Пишет таблицу частями: в Parquet — группами строк без накопления в памяти, в Excel/CSV — целиком в конце."""
+
+    def __init__(self, path, file_format):
+        self.path = path
+        self.file_format = file_format
+        self.rows = 0
+        self._writer = None
+        self._frames = []
+
+    def write(self, df: pd.DataFrame):
+        self.rows += len(df)
+        if self.file_format != "parquet":
+            self._frames.append(df)
+            return
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self.file_format == "parquet":
+            if self._writer is not None:
+                self._writer.close()
+            return
+        df = pd.concat(self._frames, ignore_index=True) if self._frames else pd.DataFrame()
+        if self.file_format == "xlsx":
+            df.to_excel(self.path, index=False)
+        else:
+            df.to_csv(self.path, index=False)
+
+
+def dataset_paths(output_dir, file_format="parquet") -> dict:
+    return {table: os.path.join(output_dir, f"{stem}.{file_format}") for table, stem in FILE_STEMS.items()}
+
+
+def generate_dataset(output_dir, clients, file_format="parquet", seed=42, mean_outgoing=12, mean_incoming=6,
+                     chunk_clients=50_000) -> dict:
+    """
+    Синтетический портфель из clients клиентов в output_dir: продукты, исходящие и входящие операции, договоры.
+    Клиенты генерируются частями по chunk_clients, поэтому память не растет с масштабом (для parquet).
+    Возвращает {таблица: путь} с ключами FILE_STEMS.
+    """
+    if file_format not in ("parquet", "xlsx", "csv"):
+        raise ValueError(f"Неподдерживаемый формат '{file_format}', ожидается parquet, xlsx или csv")
+    os.makedirs(output_dir, exist_ok=True)
+    paths = dataset_paths(output_dir, file_format)
+    writers = {table: TableWriter(path, file_format) for table, path in paths.items()}
+    rng = np.random.default_rng(seed)
+    try:
+        for start in range(0, clients, chunk_clients):
+            count = min(chunk_clients, clients - start)
+            writers["products"].write(generate_products(start, count, rng))
+            writers["outgoing"].write(generate_operations(start, count, rng, OUTGOING_TEMPLATES, mean_outgoing))
+            writers["incoming"].write(generate_operations(start, count, rng, INCOMING_TEMPLATES, mean_incoming))
+            writers["contracts"].write(generate_contracts(start, count, rng))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if file_format == "xlsx" and max(writer.rows for writer in writers.values()) > 1_048_575:
+        logger.warning("Таблица превышает лимит строк Excel, используйте формат parquet")
+    logger.info(
+        f"Синтетический портфель в {output_dir}: клиентов {clients}, "
+        + ", ".join(f"{table} {writer.rows} строк" for table, writer in writers.items())
+    )
+    return paths
+
+
+def parse_scale(value) -> int:
+    return SCALES.get(str(value).lower()) or int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Генератор синтетических таблиц для бенчмарков тегирования")
+    parser.add_argument("output_dir")
+    parser.add_argument("--clients", default="1k", help="Число клиентов или масштаб: 1k, 100k, 1m")
+    parser.add_argument("--format", default="parquet", choices=["parquet", "xlsx", "csv"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mean-outgoing", type=int, default=12, help="Среднее число исходящих операций на клиента")
+    parser.add_argument("--mean-incoming", type=int, default=6, help="Среднее число входящих операций на клиента")
+    args = parser.parse_args()
+    generate_dataset(
+        args.output_dir, parse_scale(args.clients), file_format=args.format, seed=args.seed,
+        mean_outgoing=args.mean_outgoing, mean_incoming=args.mean_incoming
+    )
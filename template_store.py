@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from sampler import normalize_description
+
+# Метки шаблона операции (поля модели TemplateLabel без index)
+TEMPLATE_LABEL_FIELDS = (
+    "payments_to_suppliers",
+    "payments_salary_related",
+    "payments_tax",
+    "cash_operation",
+    "has_ved_signs",
+)
+
+
+def template_key(description) -> str:
+    """Ключ шаблона операции для всего портфеля (нормализованное описание в нижнем регистре)."""
+    return normalize_description(description).lower()
+
+
+def client_template_counts(descriptions) -> Counter:
+    """Шаблоны операций клиента с числом операций по каждому."""
+    counts = Counter(template_key(description) for description in descriptions)
+    counts.pop("", None)
+    return counts
+
+
+class TemplateStore:
+    """
+    Таблица уникальных шаблонов описаний операций по всему портфелю и их меток от LLM (SQLite).
+
+    Шаблон классифицируется один раз; метки хранятся вместе с версией классификации
+    (модель и промпт), поэтому следующие прогоны отправляют в LLM только новые шаблоны
+    или шаблоны, размеченные другой версией.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Хранилище общее для шардов pipeline.py --workers: при блокировке ждем, а не падаем с database is locked
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS templates ("
+            " template TEXT PRIMARY KEY,"
+            " operations_count INTEGER NOT NULL,"
+            " labels TEXT,"
+            " labels_version TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @classmethod
+    def from_config(cls, template_config: dict):
+        template_config = template_config or {}
+        return cls(template_config.get("path", "checkpoints/template_labels.sqlite"))
+
+    def update_counts(self, template_counts: dict):
+        """Записывает число операций по шаблонам в текущем прогоне (новые шаблоны добавляются без меток)."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO templates (template, operations_count, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(template) DO UPDATE SET operations_count = excluded.operations_count, updated_at = excluded.updated_at",
+                [(template, int(count), now) for template, count in template_counts.items()],
+            )
+            self._conn.commit()
+
+    def labels(self, labels_version) -> dict:
+        """Метки всех шаблонов, размеченных версией labels_version: {шаблон: {поле: bool}}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT template, labels FROM templates WHERE labels IS NOT NULL AND labels_version = ?", (labels_version,)
+            ).fetchall()
+        return {template: json.loads(labels) for template, labels in rows}
+
+    def set_labels(self, template_labels: dict, labels_version):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE templates SET labels = ?, labels_version = ?, updated_at = ? WHERE template = ?",
+                [
+                    (json.dumps(labels, ensure_ascii=False), labels_version, now, template)
+                    for template, labels in template_labels.items()
+                ],
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def aggregate_template_labels(template_counts: Counter, template_labels: dict) -> dict:
+    """
+    Сводит метки шаблонов клиента: булевы поля — «есть хотя бы одна операция с меткой»,
+    cash_share — доля операций клиента с меткой cash_operation. Шаблоны без меток не учитываются.
+    """
+    aggregated = {field: False for field in TEMPLATE_LABEL_FIELDS}
+    labelled_operations = 0
+    cash_operations = 0
+    for template, count in template_counts.items():
+        labels = template_labels.get(template)
+        if labels is None:
+            continue
+        labelled_operations += count
+        for field in TEMPLATE_LABEL_FIELDS:
+            if labels.get(field):
+                aggregated[field] = True
+        if labels.get("cash_operation"):
+            cash_operations += count
+    aggregated["labelled_operations"] = labelled_operations
+    aggregated["cash_share"] = cash_operations / labelled_operations if labelled_operations else 0.0
+    return aggregated
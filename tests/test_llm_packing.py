@@ -0,0 +1,63 @@
+from pydantic import BaseModel, Field
+
+from llm_packing import build_packed_model, match_packed_items, pack_by_token_budget
+
+
+class Flags(BaseModel):
+    has_ved_signs: bool = Field(description="Признаки ВЭД")
+
+
+PackedFlags = build_packed_model(Flags)
+
+
+def packed(*items):
+    return PackedFlags.model_validate({"clients": list(items)})
+
+
+def test_pack_by_token_budget_respects_prompt_budget():
+    items = [("a", 40), ("b", 40), ("c", 40)]
+    assert pack_by_token_budget(items, overhead_tokens=20, max_prompt_tokens=100, max_items=10) == [["a", "b"], ["c"]]
+
+
+def test_pack_by_token_budget_respects_item_and_completion_limits():
+    items = [(name, 1) for name in "abcde"]
+    assert pack_by_token_budget(items, 0, 1000, max_items=2) == [["a", "b"], ["c", "d"], ["e"]]
+    packs = pack_by_token_budget(items, 0, 1000, max_items=10, completion_tokens_per_item=50, max_completion_tokens=150)
+    assert packs == [["a", "b", "c"], ["d", "e"]]
+
+
+def test_pack_by_token_budget_oversized_item_goes_alone():
+    items = [("a", 10), ("big", 500), ("b", 10)]
+    assert pack_by_token_budget(items, 0, 100, max_items=10) == [["a"], ["big"], ["b"]]
+
+
+def test_build_packed_model_drops_malformed_items():
+    response = packed(
+        {"cli_id": "1", "has_ved_signs": True},
+        {"cli_id": "2"},
+        {"has_ved_signs": False},
+        "не запись",
+    )
+    assert [item.cli_id for item in response.clients] == ["1"]
+
+
+def test_match_packed_items_by_cli_id():
+    response = packed(
+        {"cli_id": " 2 ", "has_ved_signs": True},
+        {"cli_id": "1", "has_ved_signs": False},
+        {"cli_id": "99", "has_ved_signs": True},
+    )
+    matched = match_packed_items(response, [1, 2, 3])
+    assert set(matched) == {1, 2}
+    assert matched[2].has_ved_signs and not matched[1].has_ved_signs
+
+
+def test_match_packed_items_conflicting_duplicates_are_missing():
+    response = packed(
+        {"cli_id": "1", "has_ved_signs": True},
+        {"cli_id": "1", "has_ved_signs": False},
+        {"cli_id": "2", "has_ved_signs": True},
+        {"cli_id": "2", "has_ved_signs": True},
+    )
+    matched = match_packed_items(response, ["1", "2"])
+    assert set(matched) == {"2"}
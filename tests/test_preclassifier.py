@@ -0,0 +1,41 @@
+import os
+
+import yaml
+
+from preclassifier import KeywordPreClassifier
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "config.yaml")
+
+
+def config_preclassifier():
+    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+        return KeywordPreClassifier.from_config(yaml.safe_load(f)["keyword_preclassifier"])
+
+
+def evidence(descriptions):
+    return {"descriptions": descriptions, "kassa_comis_total": 0, "cash_operations_count": 0, "operations_count": len(descriptions)}
+
+
+def test_group_with_field_without_strong_hit_goes_to_llm():
+    preclassifier = config_preclassifier()
+    resolved = preclassifier.resolve(
+        evidence(["Перечисление по контракту 7 ООО Ромашка", "Налог УСН за 2 кв"]), ["payments", "ved"]
+    )
+    assert "payments" not in resolved
+    assert "ved" not in resolved
+
+
+def test_group_resolved_when_every_field_has_strong_hit():
+    preclassifier = config_preclassifier()
+    resolved = preclassifier.resolve(
+        evidence(["Оплата по счету 15 за товар", "Зарплата за май", "Налог УСН за 2 кв", "Оплата импорт SWIFT"]),
+        ["payments", "ved"]
+    )
+    assert resolved["payments"] == {"payments_to_suppliers": True, "payments_salary_related": True, "payments_tax": True}
+    assert resolved["ved"] == {"has_ved_signs": True}
+
+
+def test_peni_matches_whole_word_only():
+    preclassifier = config_preclassifier()
+    assert ("payments", "payments_tax") in preclassifier.keyword_hits(["Уплата пени по НДС"])
+    assert ("payments", "payments_tax") not in preclassifier.keyword_hits(["Оплата за ступени лестницы"])
@@ -0,0 +1,45 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from fetch_tags import FetchTags
+from rule_tags import RULE_TAGS, build_rule_tag_matrix, parse_boolean_flags
+
+
+def fetch_tags(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("llm_concurrency: 1\n", encoding="utf-8")
+    return FetchTags(str(config_path))
+
+
+def test_parse_boolean_flags_mixed_types():
+    flags = pd.Series([2, "2", "2.0", " 1 ", "Да", " true", "0", "0.0", "нет", "", None, np.nan, 1.0, 0, True, "abc"], dtype=object)
+    expected = [True, True, True, True, True, True, False, False, False, False, False, False, True, False, True, False]
+    assert parse_boolean_flags(flags).tolist() == expected
+
+
+def test_rule_tag_matrix_matches_row_rule_tags_on_mixed_flag_columns(tmp_path, monkeypatch):
+    flag_values = [2, "2", "2.0", " 1 ", "да", "0", "нет", None, np.nan, 1.0, 0, True]
+    rows = len(flag_values)
+    df_products = pd.DataFrame({
+        "CLI_ID": list(range(rows)),
+        "STAFF_GROUP": ["1-24", "25-100", "101-250", None] * (rows // 4),
+        "DT_BANK_OPEN": ["2015-03-01", "2024-01-10", None, "01.02.2010"] * (rows // 4),
+        "CITY": ["Москва", "Казань", None, "г. Москва"] * (rows // 4),
+        "IS_ACQ": pd.Series(flag_values, dtype=object),
+        "IS_SAL": pd.Series(flag_values[::-1], dtype=object),
+        "IS_CREDIT": pd.Series(flag_values[3:] + flag_values[:3], dtype=object),
+    })
+    df_contracts = pd.DataFrame({"CLI_ID": [1, 4, 4], "CON_TYPE": ["Кредит", "Расчетный счет", "Loan"]})
+    today = date.today()
+
+    matrix = build_rule_tag_matrix(df_products, df_contracts, today=today)
+
+    tagger = fetch_tags(tmp_path, monkeypatch)
+    for position, (_, row) in enumerate(df_products.iterrows()):
+        client_contracts = df_contracts[df_contracts["CLI_ID"] == row["CLI_ID"]]
+        row_tags = set(tagger.row_rule_tags(row.to_dict(), client_contracts))
+        matrix_tags = {tag for tag in RULE_TAGS if matrix.iloc[position][tag]}
+        assert matrix_tags == row_tags, f"строка {position}: {row.to_dict()}"
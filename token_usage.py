@@ -0,0 +1,121 @@
+import contextvars
+import csv
+import json
+import threading
+from functools import lru_cache
+
+from loguru import logger
+
+from sampler import estimate_tokens
+
+# Клиент, для которого сейчас выполняются запросы к LLM (для учета токенов по клиентам);
+# кортеж CLI_ID — упакованный запрос, токены которого делятся между клиентами пакета
+CURRENT_CLIENT = contextvars.ContextVar("current_client", default=None)
+
+# Служебные токены на каждое сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+USAGE_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "cached_tokens", "estimated_prompt_tokens")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Кодировка tiktoken для модели (None, если tiktoken не установлен)."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model=None) -> int:
+    """Число токенов текста: точно через tiktoken, если он установлен, иначе оценка по длине."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_request_tokens(request: dict) -> int:
+    """Оценка входных токенов запроса chat.completions: сообщения и схема инструментов."""
+    model = request.get("model")
+    tokens = sum(count_tokens(message["content"] or "", model) + MESSAGE_OVERHEAD_TOKENS for message in request["messages"])
+    if request.get("tools"):
+        tokens += count_tokens(json.dumps(request["tools"], ensure_ascii=False), model)
+    return tokens
+
+
+class UsageTracker:
+    """
+    Учет токенов LLM: запросы, prompt/completion/cached токены (из completion.usage)
+    и оценка входных токенов до отправки — по клиентам и по группам тегов.
+    """
+
+    def __init__(self):
+        self._by_client = {}
+        self._lock = threading.Lock()
+
+    def record(self, group, usage=None, estimated_prompt_tokens=0, cli_id=None):
+        """
+        Добавляет запрос группы group; usage — completion.usage ответа (None, если ответа нет).
+        cli_id — кортеж CLI_ID для упакованного запроса: счетчики делятся между клиентами поровну
+        (остаток — первым клиентам), итоги по группам не меняются.
+        """
+        details = getattr(usage, "prompt_tokens_details", None)
+        counts = {
+            "requests": 1,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "estimated_prompt_tokens": estimated_prompt_tokens,
+        }
+        cli_id = cli_id if cli_id is not None else CURRENT_CLIENT.get()
+        cli_ids = list(cli_id) if isinstance(cli_id, (list, tuple)) and cli_id else [cli_id]
+        with self._lock:
+            for position, client in enumerate(cli_ids):
+                client_usage = self._by_client.setdefault(client, {})
+                group_usage = client_usage.setdefault(group, dict.fromkeys(USAGE_FIELDS, 0))
+                for field, value in counts.items():
+                    share, remainder = divmod(value, len(cli_ids))
+                    group_usage[field] += share + (1 if position < remainder else 0)
+
+    def by_group(self) -> dict:
+        totals = {}
+        with self._lock:
+            for client_usage in self._by_client.values():
+                for group, group_usage in client_usage.items():
+                    group_totals = totals.setdefault(group, dict.fromkeys(USAGE_FIELDS, 0))
+                    for field in USAGE_FIELDS:
+                        group_totals[field] += group_usage[field]
+        return totals
+
+    def summary(self) -> dict:
+        by_group = self.by_group()
+        totals = {field: sum(group_usage[field] for group_usage in by_group.values()) for field in USAGE_FIELDS}
+        with self._lock:
+            clients = sum(1 for cli_id in self._by_client if cli_id is not None)
+        return {
+            "total": totals,
+            "by_group": by_group,
+            "clients": clients,
+            "prompt_tokens_per_client": round(totals["prompt_tokens"] / clients, 1) if clients else 0.0,
+        }
+
+    def write_client_report(self, path):
+        """CSV с расходом токенов по клиентам и группам."""
+        with self._lock:
+            rows = [
+                {"CLI_ID": cli_id if cli_id is not None else "", "group": group, **group_usage}
+                for cli_id, client_usage in self._by_client.items()
+                for group, group_usage in client_usage.items()
+            ]
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["CLI_ID", "group", *USAGE_FIELDS])
+            writer.writeheader()
+            writer.writerows(rows)
+        logger.info(f"Расход токенов по клиентам записан в {path}")
+
+    def log_summary(self):
+        logger.info(f"Расход токенов LLM: {self.summary()}")